@@ -27,6 +27,8 @@ export const API_ENDPOINTS = {
   FETCH_IDENTIFIERS: `${BASE_URL}/upload/api/fetch_identifiers`,
   CREATE_IDENTIFIER: `${BASE_URL}/upload/api/create_identifier`,
   UPLOAD_SAMPLE: `${BASE_URL}/upload/api/upload_sample`,
+  UPDATE_INVENTORY: `${BASE_URL}/upload/api/update_inventory`,
+  INVENTORY_HISTORY: `${BASE_URL}/upload/api/inventory_history`,
   WORKFLOW_COMMIT: `${BASE_URL}/upload/api/workflow_commit`,
   FETCH_LOCKED_WORKFLOW: `${BASE_URL}/upload/api/fetch_locked_workflow`,
   FETCH_ALL_WORKFLOW: `${BASE_URL}/upload/api/fetch_all_workflow`,
@@ -3,6 +3,7 @@ from flask import Flask
 from flask_cors import CORS                     # enable frontend backend connection, API request
 from app.config import Config                   # correct way of importing config.py file
 from flask_mailman import Mail                  # import for creating the mail object
+from app.indexes import ensure_indexes          # index registry applied on startup
 
 
 # create flask object and enable request from all origins
@@ -31,6 +32,17 @@ def create_app():
         # register blueprint 
         register_all_blueprints(app)
 
+        # create missing indexes, see app/indexes.py
+        ensure_indexes()
+
+        # periodic cleanup of files nothing refers to anymore
+        from app.upload.models import FileGarbageCollector
+        FileGarbageCollector.start_background(app.config['FILE_GC_INTERVAL'])
+
+        # perceptual hashes of sample images for the similar images search
+        from app.similarity import ImageIndex
+        ImageIndex.load()
+
 
     return app
 
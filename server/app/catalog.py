@@ -0,0 +1,147 @@
+import time
+import threading
+from collections import defaultdict
+from datetime import datetime
+from bson import ObjectId
+from pymongo import UpdateOne
+from app.database import db
+from app.logger import logger
+
+
+# searchable fields per collection, kept in db.field_catalog by the write paths:
+# one document per (collection, path), path being a top level key or additional_fields.<key>
+#   {_id: "<collection>:<path>", collection, path, field, additional, count, types: {type name: count}}
+# - count: documents inserted with the field, types: values seen per type over every write
+# - deletes do not decrement, utils/migrate.py field_catalog rebuilds a collection from its documents
+# get_keys() is served from a per process copy that is refreshed every CACHE_TTL seconds,
+# writes of this process refresh it right away
+class FieldCatalog:
+    CACHE_TTL = 30
+    # internal / sensitive fields never offered for search
+    EXCLUDED = {"_id", "quantity", "password", "role", "authToken", "image_path", "search_text"}
+
+    _cache = {}         # collection -> (loaded_at, [entries])
+    _lock = threading.Lock()
+
+
+    @staticmethod
+    def type_name(value):
+        if value is None:
+            return "null"
+        if isinstance(value, bool):
+            return "bool"
+        if isinstance(value, int):
+            return "int"
+        if isinstance(value, float):
+            return "double"
+        if isinstance(value, str):
+            return "string"
+        if isinstance(value, list):
+            return "array"
+        if isinstance(value, dict):
+            return "object"
+        if isinstance(value, datetime):
+            return "date"
+        if isinstance(value, ObjectId):
+            return "objectId"
+        return type(value).__name__
+
+
+    @staticmethod
+    def _fields(document):
+        # (path, field name, value) of every catalogued key of one document or $set
+        for key, value in document.items():
+            if key == 'additional_fields' and isinstance(value, dict):
+                for field, field_value in value.items():
+                    yield f"additional_fields.{field}", field, field_value
+            elif key.startswith('additional_fields.'):
+                yield key, key.split('.', 1)[1], value
+            elif key not in FieldCatalog.EXCLUDED:
+                yield key, key, value
+
+
+    @staticmethod
+    def operations(collection_name, inserted=(), updated=()):
+        # inserted: whole documents, updated: the $set part of updates (types only, no count)
+        counts = defaultdict(int)
+        types = defaultdict(lambda: defaultdict(int))
+        names = {}
+        for documents, counted in [(inserted, True), (updated, False)]:
+            for document in documents:
+                for path, field, value in FieldCatalog._fields(document):
+                    names[path] = field
+                    types[path][FieldCatalog.type_name(value)] += 1
+                    if counted:
+                        counts[path] += 1
+
+        operations = []
+        for path, field in names.items():
+            increments = {"count": counts[path]}
+            increments.update({f"types.{name}": n for name, n in types[path].items()})
+            operations.append(UpdateOne(
+                {"_id": f"{collection_name}:{path}"},
+                {
+                    "$inc": increments,
+                    "$set": {"collection": collection_name, "path": path, "field": field,
+                             "additional": path.startswith('additional_fields.')}
+                },
+                upsert=True
+            ))
+        return operations
+
+
+    @staticmethod
+    def record(collection_name, inserted=(), updated=()):
+        # the catalog only feeds the search UI, a failed update must not fail the write it describes
+        operations = FieldCatalog.operations(collection_name, inserted, updated)
+        if not operations:
+            return
+        try:
+            db.field_catalog.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Could not update field catalog of {collection_name}: {e}")
+        FieldCatalog.invalidate(collection_name)
+
+
+    @staticmethod
+    def invalidate(collection_name=None):
+        with FieldCatalog._lock:
+            if collection_name is None:
+                FieldCatalog._cache.clear()
+            else:
+                FieldCatalog._cache.pop(collection_name, None)
+
+
+    @staticmethod
+    def entries(collection_name):
+        cached = FieldCatalog._cache.get(collection_name)
+        if cached and time.time() - cached[0] < FieldCatalog.CACHE_TTL:
+            return cached[1]
+        entries = list(db.field_catalog.find({"collection": collection_name}, {"_id": 0}).sort("path", 1))
+        with FieldCatalog._lock:
+            FieldCatalog._cache[collection_name] = (time.time(), entries)
+        return entries
+
+
+    @staticmethod
+    def get_keys(collection_name):
+        # a name used both at the top level and in additional_fields is listed once
+        return list(dict.fromkeys(entry['field'] for entry in FieldCatalog.entries(collection_name)))
+
+
+    @staticmethod
+    def rebuild(collection_name, batch_size=1000):
+        # recounts a collection from scratch, used for existing data and after large deletes
+        db.field_catalog.delete_many({"collection": collection_name})
+        batch, total = [], 0
+        for document in db[collection_name].find({}):
+            batch.append(document)
+            if len(batch) >= batch_size:
+                db.field_catalog.bulk_write(FieldCatalog.operations(collection_name, batch), ordered=False)
+                total += len(batch)
+                batch = []
+        if batch:
+            db.field_catalog.bulk_write(FieldCatalog.operations(collection_name, batch), ordered=False)
+            total += len(batch)
+        FieldCatalog.invalidate(collection_name)
+        return total
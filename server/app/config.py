@@ -51,4 +51,7 @@ class Config:
     BACKEND_LOCAL_URL = f'http://{LOCAL_IP}:{PORT}'
     IMAGE_BASE_URL = f'{BACKEND_LOCAL_URL}/search/api'
 
+    # background removal of orphan files / file documents, in seconds (0 disables it)
+    FILE_GC_INTERVAL = 6 * 3600
+
 
@@ -1,7 +1,20 @@
-
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 
 # this file right now is only for connecting database
 client = MongoClient('localhost', 27017)
 db = client.flask_database  # use this temp
 
+
+_supports_transactions = None
+
+def supports_transactions():
+    # multi-document transactions need a replica set or a sharded cluster, a standalone mongod has neither
+    global _supports_transactions
+    if _supports_transactions is None:
+        try:
+            hello = client.admin.command('hello')
+        except PyMongoError:
+            return False
+        _supports_transactions = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+    return _supports_transactions
@@ -0,0 +1,113 @@
+from collections import Counter
+from pymongo import UpdateOne, ASCENDING, DESCENDING
+from app.database import db
+from app.logger import logger
+
+
+# document counts per value of the sidebar filters, unfiltered ones materialized in db.facet_counts:
+#   {_id: "<collection>:<facet>:<value>", collection, facet, value, count}
+# the item write paths record what they added and removed ($inc), rebuild() recounts from scratch;
+# counts narrowed by search criteria are computed with one $facet aggregation instead
+class FacetCounts:
+    FIELDS = ['categories', 'tags', 'source', 'identifier']
+    LIMIT = 200     # values returned per facet, most frequent first
+
+
+    @staticmethod
+    def values(document, field):
+        # array fields count once per distinct value, older documents may hold a plain string
+        value = document.get(field)
+        values = value if isinstance(value, list) else [value]
+        return {v for v in values if v is not None and v != "" and not isinstance(v, (dict, list))}
+
+
+    @staticmethod
+    def operations(collection_name, added=(), removed=()):
+        deltas = Counter()
+        for documents, sign in [(added, 1), (removed, -1)]:
+            for document in documents:
+                for field in FacetCounts.FIELDS:
+                    for value in FacetCounts.values(document, field):
+                        deltas[(field, value)] += sign
+
+        return [
+            UpdateOne(
+                {"_id": f"{collection_name}:{field}:{value}"},
+                {
+                    "$inc": {"count": delta},
+                    "$set": {"collection": collection_name, "facet": field, "value": value}
+                },
+                upsert=True
+            )
+            for (field, value), delta in deltas.items() if delta
+        ]
+
+
+    @staticmethod
+    def record(collection_name, added=(), removed=()):
+        # like the field catalog, a failed count update must not fail the write it describes
+        operations = FacetCounts.operations(collection_name, added, removed)
+        if not operations:
+            return
+        try:
+            db.facet_counts.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Could not update facet counts of {collection_name}: {e}")
+
+
+    @staticmethod
+    def counts(collection_name, limit=LIMIT):
+        facets = {field: [] for field in FacetCounts.FIELDS}
+        cursor = db.facet_counts.find(
+            {"collection": collection_name, "count": {"$gt": 0}},
+            {"_id": 0, "facet": 1, "value": 1, "count": 1}
+        ).sort([("facet", 1), ("count", DESCENDING)])
+        for document in cursor:
+            values = facets[document['facet']]
+            if not limit or len(values) < limit:
+                values.append({"value": document['value'], "count": document['count']})
+        return facets
+
+
+    @staticmethod
+    def _pipeline(query, limit=None):
+        facet_stages = {}
+        for field in FacetCounts.FIELDS:
+            stages = [
+                {"$unwind": f"${field}"},
+                {"$match": {field: {"$nin": [None, ""]}}},
+                # an array holding the same value twice still counts its document once
+                {"$group": {"_id": {"value": f"${field}", "document": "$_id"}}},
+                {"$group": {"_id": "$_id.value", "count": {"$sum": 1}}},
+                {"$sort": {"count": DESCENDING, "_id": ASCENDING}}
+            ]
+            if limit:
+                stages.append({"$limit": limit})
+            stages.append({"$project": {"_id": 0, "value": "$_id", "count": 1}})
+            facet_stages[field] = stages
+        return [{"$match": query}, {"$facet": facet_stages}]
+
+
+    @staticmethod
+    def filtered(collection_name, query, limit=LIMIT):
+        result = list(db[collection_name].aggregate(FacetCounts._pipeline(query, limit), allowDiskUse=True))
+        return result[0] if result else {field: [] for field in FacetCounts.FIELDS}
+
+
+    @staticmethod
+    def rebuild(collection_name):
+        # recounts a collection from scratch, for existing data and to correct drift
+        facets = FacetCounts.filtered(collection_name, {}, limit=None)
+        operations = [
+            UpdateOne(
+                {"_id": f"{collection_name}:{field}:{entry['value']}"},
+                {"$set": {"collection": collection_name, "facet": field, "value": entry['value'], "count": entry['count']}},
+                upsert=True
+            )
+            for field in FacetCounts.FIELDS
+            for entry in facets.get(field, [])
+        ]
+        db.facet_counts.delete_many({"collection": collection_name})
+        if operations:
+            db.facet_counts.bulk_write(operations, ordered=False)
+        return len(operations)
@@ -0,0 +1,55 @@
+import os
+import mimetypes
+from flask import send_file
+
+# file responses with validators: strong ETag, Last-Modified, Range and conditional GET
+# (If-None-Match / If-Modified-Since / If-Range are answered by send_file once those are set)
+
+# content addressed files never change under their path, everything else is revalidated every few minutes
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+MUTABLE_MAX_AGE = 300
+
+# magic numbers of the formats we actually store, the file extension is only the fallback
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF', 'application/pdf'),
+    (b'PK\x03\x04', None),  # zip container (docx / xlsx), the extension tells which
+]
+
+
+def sniff_mimetype(path, name=None):
+    with open(path, 'rb') as f:
+        head = f.read(16)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mimetype in SIGNATURES:
+        if head.startswith(signature) and mimetype:
+            return mimetype
+    # blobs carry no extension, the name the file was uploaded under does
+    return mimetypes.guess_type(name or path)[0] or 'application/octet-stream'
+
+
+def file_etag(stat, content_hash=None):
+    if content_hash:
+        return content_hash
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def send_cached_file(path, content_hash=None, immutable=False, **kwargs):
+    stat = os.stat(path)
+    response = send_file(
+        path,
+        mimetype=kwargs.pop('mimetype', None) or sniff_mimetype(path, kwargs.get('download_name')),
+        conditional=True,
+        etag=file_etag(stat, content_hash),
+        last_modified=stat.st_mtime,
+        max_age=IMMUTABLE_MAX_AGE if immutable else MUTABLE_MAX_AGE,
+        **kwargs
+    )
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
@@ -0,0 +1,146 @@
+from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure, PyMongoError
+from app.database import db
+from app.logger import logger
+
+# central registry of the indexes every hot lookup relies on
+# create_app() applies it on startup (create_index is a no-op when the index already exists)
+# utils/indexes.py reports missing / unused indexes and their sizes
+# text search over item collections (operator "text"), search_text holds the additional_fields values;
+# language "none" keeps reference numbers and codes unstemmed
+def search_text_index():
+    return IndexModel(
+        [("reference_no", TEXT), ("side_reference_nos", TEXT), ("tags", TEXT),
+         ("categories", TEXT), ("source", TEXT), ("search_text", TEXT)],
+        name="search_text",
+        weights={"reference_no": 10, "side_reference_nos": 8, "tags": 4, "categories": 4, "source": 2, "search_text": 1},
+        default_language="none"
+    )
+
+
+INDEXES = {
+    "samples": [
+        IndexModel([("reference_no", ASCENDING)], name="reference_no_unique", unique=True),
+        # items without side references store [], the partial filter keeps those out of the unique index
+        IndexModel([("side_reference_nos", ASCENDING)], name="side_reference_nos_unique", unique=True,
+                   partialFilterExpression={"side_reference_nos": {"$type": "string"}}),
+        # user defined attributes, searched as additional_fields.<key> (MongoDB 4.2+)
+        IndexModel([("additional_fields.$**", ASCENDING)], name="additional_fields_wildcard"),
+        search_text_index(),
+    ],
+    "samples_list": [
+        IndexModel([("identifier", ASCENDING), ("reference_no", ASCENDING)], name="identifier_reference_no_unique", unique=True),
+        # prefix search on reference_no across identifiers
+        IndexModel([("reference_no", ASCENDING)], name="reference_no"),
+        IndexModel([("additional_fields.$**", ASCENDING)], name="additional_fields_wildcard"),
+        search_text_index(),
+    ],
+    "inventory": [
+        IndexModel([("identifier", ASCENDING), ("reference_no", ASCENDING)], name="identifier_reference_no_unique", unique=True),
+        IndexModel([("reference_no", ASCENDING)], name="reference_no"),
+        IndexModel([("additional_fields.$**", ASCENDING)], name="additional_fields_wildcard"),
+        search_text_index(),
+    ],
+    "reference_abbreviations": [
+        IndexModel([("abbreviation", ASCENDING)], name="abbreviation_unique", unique=True),
+        IndexModel([("full_name", ASCENDING)], name="full_name_unique", unique=True),
+    ],
+    "identifiers": [
+        IndexModel([("identifier", ASCENDING)], name="identifier_unique", unique=True),
+        IndexModel([("mode", ASCENDING), ("created_at", DESCENDING)], name="mode_created_at"),
+    ],
+    "inventory_movements": [
+        IndexModel([("collection", ASCENDING), ("identifier", ASCENDING), ("reference_no", ASCENDING), ("bucket", ASCENDING)],
+                   name="item_bucket_unique", unique=True),
+        # InventoryLedger.reconcile(): only buckets holding a pending movement are indexed
+        IndexModel([("movements.pending", ASCENDING)], name="movements_pending", sparse=True),
+    ],
+    "workflows": [
+        IndexModel([("workflow_id", ASCENDING)], name="workflow_id_unique", unique=True),
+    ],
+    "nodes": [
+        IndexModel([("node_id", ASCENDING)], name="node_id_unique", unique=True),
+        IndexModel([("workflow_id", ASCENDING)], name="workflow_id"),
+    ],
+    "sections": [
+        IndexModel([("node_id", ASCENDING)], name="node_id"),
+        IndexModel([("section_id", ASCENDING)], name="section_id"),
+    ],
+    "files": [
+        IndexModel([("file_id", ASCENDING)], name="file_id_unique", unique=True),
+    ],
+    "field_catalog": [
+        IndexModel([("collection", ASCENDING), ("path", ASCENDING)], name="collection_path"),
+    ],
+    "facet_counts": [
+        IndexModel([("collection", ASCENDING), ("facet", ASCENDING), ("count", DESCENDING)], name="collection_facet_count"),
+    ],
+    "image_hashes": [
+        IndexModel([("reference_no", ASCENDING), ("path", ASCENDING)], name="reference_no_path_unique", unique=True),
+    ],
+    "upload_sessions": [
+        IndexModel([("upload_id", ASCENDING)], name="upload_id_unique", unique=True),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("authToken", ASCENDING)], name="authToken"),
+    ],
+}
+
+
+# earlier indexes on the same keys as a registry entry: MongoDB refuses a second index on one key
+# pattern, so the old one is dropped right before its replacement is built, and rebuilt if that fails
+RETIRED = {
+    "samples": {
+        "side_reference_nos_unique": IndexModel([("side_reference_nos", ASCENDING)], name="side_reference_nos"),
+    },
+}
+
+
+
+def ensure_indexes():
+    created, failed = [], []
+    try:
+        for collection_name, indexes in INDEXES.items():
+            for index in indexes:
+                name = index.document['name']
+                retired = RETIRED.get(collection_name, {}).get(name)
+                existing = db[collection_name].index_information() if retired else {}
+                try:
+                    if retired and name not in existing and retired.document['name'] in existing:
+                        logger.info(f"Replacing index {collection_name}.{retired.document['name']} with {name}")
+                        db[collection_name].drop_index(retired.document['name'])
+                    db[collection_name].create_indexes([index])
+                    created.append(f"{collection_name}.{name}")
+                except OperationFailure as e:
+                    # e.g. existing duplicates block a unique index, keep starting up and report it
+                    logger.error(f"Could not create index {collection_name}.{name}: {e}")
+                    failed.append(f"{collection_name}.{name}")
+                    if retired and name not in existing:
+                        # lookups on those keys keep an index until the duplicates are resolved
+                        db[collection_name].create_indexes([retired])
+    except PyMongoError as e:
+        logger.error(f"Skipping index bootstrap, database not reachable: {e}")
+    return created, failed
+
+
+
+def index_report():
+    report = {}
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        usage = {stat['name']: stat['accesses']['ops'] for stat in collection.aggregate([{"$indexStats": {}}])}
+        try:
+            sizes = db.command("collStats", collection_name).get('indexSizes', {})
+        except OperationFailure:
+            sizes = {}
+
+        registered = {index.document['name'] for index in indexes}
+        report[collection_name] = {
+            "missing": sorted(registered - set(existing)),
+            "unused": sorted(name for name, ops in usage.items() if ops == 0 and name != '_id_'),
+            "unregistered": sorted(set(existing) - registered - {'_id_'}),
+            "sizes": sizes,
+        }
+    return report
@@ -0,0 +1,32 @@
+import os
+import socket
+import time
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from app.database import db
+
+
+# named leases in db.leases {_id: name, holder, expires_at}: a periodic job started in every worker
+# process runs only in the one holding its lease, the others skip their turn; the holder renews on
+# each run, a holder that dies stops renewing and another process takes over once the lease expired
+class Lease:
+    @staticmethod
+    def holder():
+        # worked out on every call, worker processes forked from one parent must not share it
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+
+    @staticmethod
+    def acquire(name, seconds):
+        now = time.time()
+        holder = Lease.holder()
+        try:
+            lease = db.leases.find_one_and_update(
+                {"_id": name, "$or": [{"holder": holder}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": holder, "expires_at": now + seconds}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return False    # held by another process, the upsert collided with its document
+        return lease is not None and lease['holder'] == holder
@@ -2,6 +2,7 @@
 
 
 from app.database import db
+from app.thumbnails import Thumbnail
 from flask import current_app
 import numpy as np
 
@@ -131,13 +132,15 @@ class Price:
         
         image_base_url = current_app.config['IMAGE_BASE_URL']
         image_path = document.get('image_path', '')
-        image_url = f"{image_base_url}/{image_path.lstrip('/')}" if image_path else None
+        image_url = Thumbnail.url(image_base_url, image_path) if image_path else None
+        image_original_url = f"{image_base_url}/{image_path.lstrip('/')}" if image_path else None
 
         return {
             "reference_no": reference_no,
             "unit_price": document.get('unit_price', [])[-1] if document.get('unit_price') else None,
             "unit_weight": document.get('unit_weight', [])[-1] if document.get('unit_weight') else None,
-            "image_url": image_url
+            "image_url": image_url,
+            "image_original_url": image_original_url
         }
 
 
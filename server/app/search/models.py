@@ -2,7 +2,17 @@
 
 
 from app.database import db
+from bson import ObjectId
+from pymongo import ASCENDING
 from app.logger import logger
+from app.thumbnails import Thumbnail
+from app.catalog import FieldCatalog
+from app.facets import FacetCounts
+from app.cache import LRUCache
+from app.versions import CollectionVersion
+import re
+import copy
+import json
 import time
 from datetime import datetime, timedelta
 from flask import current_app
@@ -19,18 +29,8 @@ class Collection:
 
     @staticmethod
     def get_keys(collection_name):
-        exclude_keys = {"_id", "quantity", "password", "role", "authToken", "image_path"}
-        if collection_name in db.list_collection_names():
-            sample_document = db[collection_name].find_one()
-            if sample_document:
-                keys = set()
-                for key, value in sample_document.items():
-                    if key == "additional_fields" and isinstance(value, dict):
-                        keys.update(value.keys())
-                    elif key not in exclude_keys:
-                        keys.add(key)
-                return list(keys)
-        return None
+        # every field ever written to the collection, from the field catalog (see app/catalog.py)
+        return FieldCatalog.get_keys(collection_name) or None
 
 
     @staticmethod
@@ -85,15 +85,83 @@ class Collection:
 
 
 
+    @staticmethod
+    def parse_number(value):
+        number = float(value)
+        return int(number) if number.is_integer() else number
+
+
 
     @staticmethod
-    def search_by_multiple_criteria(collection_name, criteria):
-        if collection_name not in db.list_collection_names():
-            logger.error(f"Collection {collection_name} not found")
-            return None, 0
+    def process_numeric_query(key, value, operator):
+        # same operators as total_inventory, for any field the catalog has seen numbers in
+        try:
+            if operator == 'range':
+                min_value, max_value = map(Collection.parse_number, value)
+                return {key: {"$gte": min_value, "$lte": max_value}}
+            elif operator == '>':
+                return {key: {"$gt": Collection.parse_number(value)}}
+            elif operator == '<':
+                return {key: {"$lt": Collection.parse_number(value)}}
+            elif operator == 'exact' and isinstance(value, str) and ',' in value:
+                # comma separated alternatives, like process_general_query
+                return {key: {"$in": [Collection.parse_number(v.strip()) for v in value.split(',')]}}
+            elif operator == 'exact':
+                return {key: Collection.parse_number(value)}
+            else:
+                raise ValueError(f"Invalid numeric operator: {operator}")
+        except (TypeError, ValueError):
+            logger.error(f"Invalid numeric value or operator: key={key}, value={value}, operator={operator}")
+            raise ValueError(f"Invalid numeric value for {key}: {value}")
+
+
+
+    @staticmethod
+    def process_field_query(key, value, operator, catalog_entries):
+        # key as catalogued: top level and/or additional_fields.<key> (backed by the wildcard index),
+        # numeric operators apply when the catalog has only seen numbers for it
+        paths = [entry['path'] for entry in catalog_entries] or [key]
+        types = set()
+        for entry in catalog_entries:
+            types.update(name for name, count in entry.get('types', {}).items() if count)
+        numeric = bool(types) and types <= {'int', 'double', 'null'}
+
+        if operator == 'prefix':
+            # anchored and case sensitive, so the index on the field can still be used
+            queries = [{path: {"$regex": f"^{re.escape(str(value).strip())}"}} for path in paths]
+        elif operator in ('range', '>', '<') or (numeric and operator == 'exact'):
+            queries = [Collection.process_numeric_query(path, value, operator) for path in paths]
+        else:
+            queries = [Collection.process_general_query(path, value) for path in paths]
+        return queries[0] if len(queries) == 1 else {"$or": queries}
+
+
+
 
+    # one page per request: stable sort on _id, the next page starts after the last _id returned;
+    # the unique (identifier, reference_no) / reference_no indexes keep rows distinct, no $group needed
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    COUNT_LIMIT = 10000     # first page count stops here, "count_capped" tells the client
+    STREAM_BATCH_SIZE = 500
+
+    # only collections whose every write path bumps CollectionVersion, anything else is always queried
+    CACHED_COLLECTIONS = {'samples', 'samples_list', 'inventory'}
+
+    _result_cache = LRUCache(
+        max_entries=512,
+        max_bytes=64 * 1024 * 1024,
+        sizeof=lambda result: len(json.dumps(result, default=str))
+    )
+
+
+    @staticmethod
+    def build_query(criteria, collection_name=None):
         query = {"$and": []}
-        logger.info(f"Received search criteria: {criteria}")
+        catalog = {}
+        if collection_name:
+            for entry in FieldCatalog.entries(collection_name):
+                catalog.setdefault(entry['field'], []).append(entry)
 
         for criterion in criteria:
             key = criterion['key']
@@ -102,74 +170,165 @@ class Collection:
 
             logger.debug(f"Processing criterion: key={key}, value={value}, operator={operator}")
 
-            try:
-                if key == 'timestamp':
-                    timestamp_query = Collection.process_timestamp_query(key, value, operator)
-                    query["$and"].append(timestamp_query)
-                elif key == 'total_inventory':
-                    inventory_query = Collection.process_inventory_query(key, value, operator)
-                    query["$and"].append(inventory_query)
-                else:
-                    query["$and"].append(Collection.process_general_query(key, value))
-            except ValueError as e:
-                logger.error(str(e))
-                return None, 0
+            if operator == 'text':
+                # any key: ranked search over the search_text index, once per query
+                if Collection.is_text_query(query):
+                    raise ValueError("Only one text criterion is allowed")
+                query["$and"].append({"$text": {"$search": str(value)}})
+            elif key == 'timestamp':
+                timestamp_query = Collection.process_timestamp_query(key, value, operator)
+                query["$and"].append(timestamp_query)
+            elif key == 'total_inventory':
+                inventory_query = Collection.process_inventory_query(key, value, operator)
+                query["$and"].append(inventory_query)
+            else:
+                query["$and"].append(Collection.process_field_query(key, value, operator, catalog.get(key, [])))
+        return query
 
-        logger.debug(f"Final query: {query}")
+
+    @staticmethod
+    def is_text_query(query):
+        return any("$text" in condition for condition in query["$and"])
+
+
+    @staticmethod
+    def find(collection_name, query):
+        # text queries come back best match first, everything else in _id order; the text score is projected
+        # as _score, so it cannot shadow a stored "score" field, and process_result leaves it out
+        if Collection.is_text_query(query):
+            score = {"$meta": "textScore"}
+            return db[collection_name].find(query, {"_score": score}).sort([("_score", score), ("_id", ASCENDING)])
+        return db[collection_name].find(query).sort("_id", ASCENDING)
+
+
+    @staticmethod
+    def normalize_criteria(criteria):
+        # criteria that build the same query give the same cache key: order of criteria and of
+        # comma separated alternatives does not matter, the default operator is spelled out
+        normalized = []
+        for criterion in criteria:
+            value = criterion.get('value')
+            operator = criterion.get('operator', 'exact')
+            if operator == 'exact' and isinstance(value, str) and ',' in value:
+                value = ','.join(sorted(v.strip() for v in value.split(',')))
+            normalized.append(json.dumps({"key": criterion.get('key'), "operator": operator, "value": value}, sort_keys=True, default=str))
+        return tuple(sorted(normalized))
+
+
+    @staticmethod
+    def cache_stats():
+        return Collection._result_cache.stats()
+
+
+    @staticmethod
+    def search_by_multiple_criteria(collection_name, criteria, limit=None, after=None):
+        # returns (results, count, next_cursor); count is only computed for the first page (after is None)
+        # pages of CACHED_COLLECTIONS are cached under the collection's write version, any write makes them unreachable;
+        # a hit still costs the version lookup (one find_one by _id), it saves the query, the count and processing
+        limit = min(int(limit or Collection.PAGE_SIZE), Collection.MAX_PAGE_SIZE)
+        cache_key = None
+        if collection_name in Collection.CACHED_COLLECTIONS:
+            cache_key = (collection_name, CollectionVersion.get(collection_name), Collection.normalize_criteria(criteria), limit, after)
+            cached = Collection._result_cache.get(cache_key)
+            if cached is not None:
+                # callers decorate the results in place, the cached page stays untouched
+                return copy.deepcopy(cached)
 
         try:
-            # Use aggregation to ensure unique results based on reference_no and identifier
-            pipeline = [
-                {"$match": query},
-                {"$group": {
-                    "_id": {
-                        "reference_no": "$reference_no",
-                        "identifier": "$identifier"
-                    },
-                    "doc": {"$first": "$$ROOT"}
-                }},
-                {"$replaceRoot": {"newRoot": "$doc"}}
-            ]
-
-            results = list(db[collection_name].aggregate(pipeline))
-            count = len(results)
-
-            if count == 0:
-                logger.info(f"No matching documents found for query in collection {collection_name}")
-                return None, 0
-
-            processed_results = Collection.process_results(results)
-            logger.debug(f"Processed {len(processed_results)} results")
-
-            return processed_results, count
+            result = Collection._search(collection_name, criteria, limit, after)
+        except ValueError as e:
+            logger.error(str(e))
+            return None, 0, None
         except Exception as e:
             logger.error(f"Error executing query: {str(e)}")
-            return None, 0
+            return None, 0, None
+
+        if cache_key is not None:
+            Collection._result_cache.set(cache_key, copy.deepcopy(result))
+        return result
+
+
+    @staticmethod
+    def _search(collection_name, criteria, limit, after):
+        if collection_name not in db.list_collection_names():
+            raise ValueError(f"Collection {collection_name} not found")
+
+        logger.info(f"Received search criteria: {criteria}")
+        query = Collection.build_query(criteria, collection_name)
+        logger.debug(f"Final query: {query}")
+
+        text_query = Collection.is_text_query(query)
+        if text_query and after:
+            # ranked results are not in _id order, a text search returns its best `limit` matches only
+            raise ValueError("Text searches have no further pages")
+        page_query = {"$and": query["$and"] + [{"_id": {"$gt": ObjectId(after)}}]} if after else query
+
+        # one extra document tells whether there is a next page
+        results = list(Collection.find(collection_name, page_query).limit(limit + 1))
+        next_cursor = str(results[limit - 1]['_id']) if len(results) > limit and not text_query else None
+        results = results[:limit]
+
+        count = None
+        if not after:
+            count = db[collection_name].count_documents(query, limit=Collection.COUNT_LIMIT)
+
+        if not results:
+            logger.info(f"No matching documents found for query in collection {collection_name}")
+            return None, 0, None
+
+        processed_results = Collection.process_results(results)
+        logger.debug(f"Processed {len(processed_results)} results")
+
+        return processed_results, count, next_cursor
+
+
 
 
     @staticmethod
     def process_results(results):
-        processed_results = []
         image_base_url = current_app.config['IMAGE_BASE_URL']
+        return [Collection.process_result(result, image_base_url) for result in results]
 
-        for result in results:
-            processed_result = {}
-            for k, v in result.items():
-                if k == "_id":
-                    continue
-                if k == "additional_fields":
-                    processed_result.update(v)
-                elif k == 'image_path':
-                    # Remove the leading slash if it exists
-                    image_path = v[1:] if v.startswith('/') else v
-                    image_url = f"{image_base_url}/{image_path}"
-                    processed_result['image_url'] = image_url
-                elif k in ['unit_price', 'unit_weight']:
-                    processed_result[k] = v[-1] if isinstance(v, list) else v
-                else:
-                    processed_result[k] = v
-            processed_results.append(processed_result)
-        return processed_results
+
+    @staticmethod
+    def process_result(result, image_base_url):
+        processed_result = {}
+        for k, v in result.items():
+            if k in ("_id", "_score", "search_text", "inventory_applied"):
+                continue
+            if k == "additional_fields":
+                processed_result.update(v)
+            elif k == 'image_path':
+                # Remove the leading slash if it exists
+                image_path = v[1:] if v.startswith('/') else v
+                # grids only need a thumbnail, the full size image is one click away
+                processed_result['image_url'] = Thumbnail.url(image_base_url, image_path)
+                processed_result['image_original_url'] = f"{image_base_url}/{image_path}"
+            elif k in ['unit_price', 'unit_weight']:
+                processed_result[k] = v[-1] if isinstance(v, list) else v
+            else:
+                processed_result[k] = v
+        return processed_result
+
+
+    @staticmethod
+    def stream_search(collection_name, criteria):
+        # every match, one processed document at a time straight off the cursor (export / NDJSON mode);
+        # the query is checked here, before the caller starts responding
+        if collection_name not in db.list_collection_names():
+            raise ValueError(f"Collection {collection_name} not found")
+        query = Collection.build_query(criteria, collection_name)
+        image_base_url = current_app.config['IMAGE_BASE_URL']
+        cursor = Collection.find(collection_name, query).batch_size(Collection.STREAM_BATCH_SIZE)
+
+        def generate():
+            try:
+                for result in cursor:
+                    yield Collection.process_result(result, image_base_url)
+            finally:
+                cursor.close()
+
+        return generate()
 
 
 
@@ -209,24 +368,35 @@ class Collection:
 
 
 
+    @staticmethod
+    def get_facets(collection_name, criteria=None):
+        # without criteria from the materialized counts (app/facets.py), otherwise one $facet aggregation
+        # over the matching documents, cached like search pages under the collection's write version
+        if not criteria:
+            return FacetCounts.counts(collection_name)
+        if collection_name not in db.list_collection_names():
+            raise ValueError(f"Collection {collection_name} not found")
+
+        if collection_name not in Collection.CACHED_COLLECTIONS:
+            return FacetCounts.filtered(collection_name, Collection.build_query(criteria, collection_name))
+        cache_key = ('facets', collection_name, CollectionVersion.get(collection_name), Collection.normalize_criteria(criteria))
+        cached = Collection._result_cache.get(cache_key)
+        if cached is not None:
+            return copy.deepcopy(cached)
+        facets = FacetCounts.filtered(collection_name, Collection.build_query(criteria, collection_name))
+        Collection._result_cache.set(cache_key, copy.deepcopy(facets))
+        return facets
+
+
     @staticmethod
     def get_categories_and_tags():
-        logger.info("Fetching categories and tags from the database")
+        logger.info("Fetching categories and tags from the facet counts")
         try:
-            categories = set()
-            tags = set()
-            
-            find_categories = list(db.samples.distinct('categories'))
-            find_tags = list(db.samples.distinct('tags'))
-            
-            # Combine and deduplicate
-            categories.update(find_categories)
-            tags.update(find_tags)
-            
+            facets = FacetCounts.counts('samples', limit=None)
+            categories = [entry['value'] for entry in facets['categories']]
+            tags = [entry['value'] for entry in facets['tags']]
             logger.info(f"Successfully fetched {len(categories)} categories and {len(tags)} tags")
-            logger.debug(f"Categories: {categories}")
-            logger.debug(f"Tags: {tags}")
-            return list(categories), list(tags)
+            return categories, tags
         except Exception as e:
             logger.error(f"Error in get_categories_and_tags: {e}", exc_info=True)
             raise
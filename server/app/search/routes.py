@@ -1,8 +1,14 @@
 
 
-from flask import Blueprint, request, jsonify, send_file, current_app
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
+from werkzeug.security import safe_join
+from app.fileserve import send_cached_file
+from app.thumbnails import Thumbnail
+from app.storage import BlobStore
+from app.similarity import ImageIndex, HASH_BITS
 from app.logger import logger
 from app.search.models import Collection
+from bson import ObjectId
 import os
 import json
 
@@ -58,12 +64,34 @@ def searched_result():
         logger.error("Collection and search criteria must be provided")
         return jsonify({"error": "Collection and search criteria must be provided"}), 400
     
+    # Accept: application/x-ndjson streams every match, one JSON document per line
+    if request.accept_mimetypes.best == 'application/x-ndjson':
+        try:
+            documents = Collection.stream_search(collection_name, criteria)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+        lines = (json.dumps(document, default=str) + '\n' for document in documents)
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+    # keyset pagination: pass the returned "next" as ?after= for the following page
+    after = request.args.get('after')
+    limit = request.args.get('limit')
+    if after and not ObjectId.is_valid(after):
+        return jsonify({"error": "Invalid page cursor"}), 400
+    if limit and (not limit.isdigit() or int(limit) < 1):
+        return jsonify({"error": "limit must be a positive integer"}), 400
+
     try:
         logger.debug(f"Processing search criteria: {criteria}")
-        results, count = Collection.search_by_multiple_criteria(collection_name, criteria)
+        results, count, next_cursor = Collection.search_by_multiple_criteria(collection_name, criteria, limit, after)
         if results:
-            logger.info(f"Search successful. Returned {count} unique results.")
-            return jsonify({"results": results, "count": count}), 200
+            logger.info(f"Search successful. Returned {len(results)} results, next page: {next_cursor}")
+            response = {"results": results, "next": next_cursor}
+            if count is not None:
+                response["count"] = count
+                response["count_capped"] = count >= Collection.COUNT_LIMIT
+            return jsonify(response), 200
         else:
             logger.info(f"No matching documents found for query in collection {collection_name}")
             return jsonify({"error": "No matching documents found", "count": 0}), 404
@@ -74,12 +102,91 @@ def searched_result():
 
 
 
+@search_bp.route('/api/facets', methods=['GET'])
+def get_facets():
+    # value counts of categories, tags, source and identifier, narrowed by ?criteria= when given
+    collection_name = request.args.get('collection', 'samples')
+    try:
+        criteria = json.loads(request.args.get('criteria', '[]'))
+    except json.JSONDecodeError:
+        return jsonify({"error": "criteria must be a JSON list"}), 400
+
+    try:
+        facets = Collection.get_facets(collection_name, criteria)
+        return jsonify({"collection": collection_name, "facets": facets, "filtered": bool(criteria)}), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error fetching facets of {collection_name}: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
+
+
+
+
+@search_bp.route('/api/search_cache_stats', methods=['GET'])
+def search_cache_stats():
+    # the cache lives per worker process, pid tells which one answered
+    return jsonify({"pid": os.getpid(), **Collection.cache_stats()}), 200
+
+
+
+
+@search_bp.route('/api/similar_images', methods=['GET'])
+def similar_images():
+    reference_no = request.args.get('reference_no')
+    if not reference_no:
+        return jsonify({"error": "Reference number must be provided"}), 400
+
+    # limit is capped at ImageIndex.MAX_LIMIT, distance is a number of differing bits of the hash
+    distance = request.args.get('distance')
+    limit = request.args.get('limit')
+    if limit and (not limit.isdigit() or int(limit) < 1):
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    if distance and (not distance.isdigit() or int(distance) > HASH_BITS):
+        return jsonify({"error": f"distance must be an integer between 0 and {HASH_BITS}"}), 400
+
+    try:
+        matches = ImageIndex.similar(reference_no, distance or None, limit)
+        if matches is None:
+            return jsonify({"error": f"No image hashes found for {reference_no}"}), 404
+        image_base_url = current_app.config['IMAGE_BASE_URL']
+        for match in matches:
+            match['image_url'] = Thumbnail.url(image_base_url, match.pop('image_path'))
+            match['matched_image_url'] = Thumbnail.url(image_base_url, match.pop('matched_image_path'))
+        return jsonify({"results": matches, "count": len(matches)}), 200
+    except Exception as e:
+        logger.error(f"Error searching images similar to {reference_no}: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+
+
 @search_bp.route('/api/images/<path:filename>', methods=['GET'])
 def get_image(filename):
-    image_path = os.path.join(IMAGE_FOLDER, filename)
+    return serve_image(IMAGE_FOLDER, filename)
+
+
+
+# images stored by content (see app/storage.py), their urls never change content
+@search_bp.route('/api/blobs/<path:filename>', methods=['GET'])
+def get_blob(filename):
+    return serve_image(BlobStore.FOLDER, filename, immutable=True)
+
+
+
+def serve_image(folder, filename, immutable=False):
+    image_path = safe_join(folder, filename)
     logger.info(f"Attempting to serve image: {image_path}")
     try:
-        return send_file(image_path, mimetype='image/jpeg')
+        if image_path is None:
+            raise FileNotFoundError(filename)
+        # ?w=200&fmt=webp asks for a resized copy, see app/thumbnails.py
+        if (request.args.get('w') or request.args.get('fmt')) and Thumbnail.available():
+            thumbnail_path = Thumbnail.get(image_path, request.args.get('w'), request.args.get('fmt'))
+            return send_cached_file(thumbnail_path, content_hash=Thumbnail.etag(thumbnail_path), immutable=immutable)
+        return send_cached_file(image_path, content_hash=os.path.basename(image_path) if immutable else None, immutable=immutable)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except FileNotFoundError:
         logger.error(f"Image not found: {image_path}")
         return jsonify({"error": "Image not found"}), 404
@@ -0,0 +1,223 @@
+import os
+import threading
+from functools import lru_cache
+from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from app.database import db
+from app.logger import logger
+
+# Pillow is optional, without it no image is hashed and similar() finds nothing new
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HASH_SIZE = 8   # 8x8 difference bits -> 64 bit hash
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def dhash(path):
+    # difference hash: grayscale, shrink to 9x8, one bit per horizontal neighbour comparison;
+    # survives rescaling and recompression, a re-photographed sample lands within a few bits
+    with Image.open(path) as image:
+        image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))   # jpeg decodes at reduced size, much faster
+        pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+
+class HammingIndex:
+    # multi-index hashing: each 64 bit hash is split into CHUNKS blocks of 16 bits, one table per block
+    # two hashes within distance d agree to within d // CHUNKS bits on at least one block (pigeonhole),
+    # so a search only probes the buckets near the query's blocks and checks those candidates in full
+    CHUNKS = 4
+    CHUNK_BITS = HASH_BITS // CHUNKS
+
+    def __init__(self):
+        self.entries = []      # (hash, item)
+        self.tables = [{} for _ in range(HammingIndex.CHUNKS)]
+        self.size = 0
+
+
+    @staticmethod
+    def _chunks(value):
+        mask = (1 << HammingIndex.CHUNK_BITS) - 1
+        return [(value >> (i * HammingIndex.CHUNK_BITS)) & mask for i in range(HammingIndex.CHUNKS)]
+
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _masks(radius):
+        # every CHUNK_BITS wide bit pattern with at most radius bits set
+        masks = []
+        for bits in range(radius + 1):
+            for positions in combinations(range(HammingIndex.CHUNK_BITS), bits):
+                masks.append(sum(1 << position for position in positions))
+        return masks
+
+
+    def add(self, value, item):
+        position = len(self.entries)
+        self.entries.append((value, item))
+        for table, chunk in zip(self.tables, HammingIndex._chunks(value)):
+            table.setdefault(chunk, []).append(position)
+        self.size += 1
+
+
+    def search(self, value, max_distance):
+        results = []
+        seen = set()
+        masks = HammingIndex._masks(max_distance // HammingIndex.CHUNKS)
+        for table, chunk in zip(self.tables, HammingIndex._chunks(value)):
+            for mask in masks:
+                for position in table.get(chunk ^ mask, ()):
+                    if position in seen:
+                        continue
+                    seen.add(position)
+                    other, item = self.entries[position]
+                    distance = hamming(value, other)
+                    if distance <= max_distance:
+                        results.append((distance, item))
+        return results
+
+
+
+# perceptual hashes of every sample image, one document per (reference_no, path) in db.image_hashes
+# the hamming index is built from the collection on startup; documents written by other worker processes
+# are picked up before each search (everything with an _id above the last one loaded)
+class ImageIndex:
+    DEFAULT_DISTANCE = 8
+    MAX_DISTANCE = 12       # larger distances are searched at 12, past it most of the index matches
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 200
+    WORKERS = 2
+    BACKFILL_BATCH = 500
+
+    _tree = HammingIndex()
+    _last_id = None
+    _lock = threading.Lock()
+    _executor = None
+
+
+    @staticmethod
+    def available():
+        return Image is not None
+
+
+    @staticmethod
+    def _get_executor():
+        with ImageIndex._lock:
+            if ImageIndex._executor is None:
+                ImageIndex._executor = ThreadPoolExecutor(max_workers=ImageIndex.WORKERS, thread_name_prefix="image-hash")
+            return ImageIndex._executor
+
+
+    @staticmethod
+    def sync():
+        query = {"_id": {"$gt": ImageIndex._last_id}} if ImageIndex._last_id else {}
+        with ImageIndex._lock:
+            for document in db.image_hashes.find(query, {"reference_no": 1, "path": 1, "dhash": 1}).sort("_id", 1):
+                ImageIndex._tree.add(int(document['dhash'], 16), (document['reference_no'], document['path']))
+                ImageIndex._last_id = document['_id']
+        return ImageIndex._tree.size
+
+
+    @staticmethod
+    def load():
+        try:
+            count = ImageIndex.sync()
+            logger.info(f"Loaded {count} image hashes")
+        except PyMongoError as e:
+            logger.error(f"Skipping image hash index, database not reachable: {e}")
+
+
+    @staticmethod
+    def _hash_operations(reference_no, paths):
+        operations = []
+        for path in paths:
+            try:
+                value = dhash(os.path.join(SERVER_DIR, path.lstrip('/')))
+            except Exception as e:
+                logger.warning(f"Could not hash image {path}: {e}")
+                continue
+            operations.append(UpdateOne(
+                {"reference_no": reference_no, "path": path},
+                {"$setOnInsert": {"dhash": f"{value:016x}"}},
+                upsert=True
+            ))
+        return operations
+
+
+    @staticmethod
+    def add_sample(reference_no, paths):
+        # hashed off the request thread, the upload response does not wait for it
+        paths = [path for path in paths if path]
+        if not paths or not ImageIndex.available():
+            return None
+
+        def run():
+            operations = ImageIndex._hash_operations(reference_no, paths)
+            if operations:
+                db.image_hashes.bulk_write(operations, ordered=False)
+
+        return ImageIndex._get_executor().submit(run)
+
+
+    @staticmethod
+    def similar(reference_no, max_distance=None, limit=None):
+        max_distance = min(int(max_distance if max_distance is not None else ImageIndex.DEFAULT_DISTANCE), ImageIndex.MAX_DISTANCE)
+        limit = min(int(limit or ImageIndex.DEFAULT_LIMIT), ImageIndex.MAX_LIMIT)
+        ImageIndex.sync()
+        hashes = list(db.image_hashes.find({"reference_no": reference_no}, {"_id": 0, "path": 1, "dhash": 1}))
+        if not hashes:
+            return None
+
+        best = {}
+        for document in hashes:
+            for distance, (other_reference_no, path) in ImageIndex._tree.search(int(document['dhash'], 16), max_distance):
+                if other_reference_no == reference_no:
+                    continue
+                if other_reference_no not in best or distance < best[other_reference_no]['distance']:
+                    best[other_reference_no] = {
+                        "reference_no": other_reference_no,
+                        "distance": distance,
+                        "image_path": path,
+                        "matched_image_path": document['path']
+                    }
+        return sorted(best.values(), key=lambda match: (match['distance'], match['reference_no']))[:limit]
+
+
+    @staticmethod
+    def backfill():
+        # hashes every sample image that has no document yet, safe to re-run
+        if not ImageIndex.available():
+            raise RuntimeError("Pillow is required to hash images")
+        hashed = {(document['reference_no'], document['path']) for document in db.image_hashes.find({}, {"reference_no": 1, "path": 1})}
+        operations = []
+        count = 0
+        for sample in db.samples.find({}, {"reference_no": 1, "image_path": 1, "additional_image_paths": 1}):
+            paths = [sample.get('image_path')] + list(sample.get('additional_image_paths') or [])
+            paths = [path for path in paths if path and (sample['reference_no'], path) not in hashed]
+            operations.extend(ImageIndex._hash_operations(sample['reference_no'], paths))
+            if len(operations) >= ImageIndex.BACKFILL_BATCH:
+                db.image_hashes.bulk_write(operations, ordered=False)
+                count += len(operations)
+                operations = []
+        if operations:
+            db.image_hashes.bulk_write(operations, ordered=False)
+            count += len(operations)
+        return count
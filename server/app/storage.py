@@ -0,0 +1,188 @@
+import os
+import uuid
+import hashlib
+import time
+from collections import Counter
+from pymongo import ReturnDocument
+from app.database import db
+from app.logger import logger
+from app.versions import CollectionVersion
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# content addressed storage for uploaded images and files:
+# - a blob lives at blobs/<aa>/<bb>/<sha256>, two levels of 256 shards keep every directory small
+# - identical content is stored once, db.blobs keeps one document per blob {_id: sha256, size, refcount}
+# - every upload holds one reference (a file document, the images of a sample): acquire on write,
+#   release on delete, the file goes away with the last reference; rows of samples_list / inventory
+#   only copy a sample's image_path and hold none, except legacy rows moved in by migrate_legacy_paths
+# - blob paths never change content, they are served with immutable caching
+class BlobStore:
+    PREFIX = 'blobs'
+    FOLDER = os.path.join(SERVER_DIR, PREFIX)
+    TEMP_FOLDER = os.path.join(FOLDER, '.tmp')
+    CHUNK_SIZE = 1024 * 1024
+
+
+    @staticmethod
+    def relative_path(sha256):
+        return '/'.join([BlobStore.PREFIX, sha256[:2], sha256[2:4], sha256])
+
+
+    @staticmethod
+    def absolute_path(sha256):
+        return os.path.join(SERVER_DIR, BlobStore.relative_path(sha256))
+
+
+    @staticmethod
+    def is_blob_path(path):
+        return bool(path) and path.lstrip('/').startswith(BlobStore.PREFIX + '/')
+
+
+    @staticmethod
+    def hash_of(path):
+        return path.rstrip('/').rsplit('/', 1)[-1] if BlobStore.is_blob_path(path) else None
+
+
+    @staticmethod
+    def _temporary_path():
+        os.makedirs(BlobStore.TEMP_FOLDER, exist_ok=True)
+        return os.path.join(BlobStore.TEMP_FOLDER, f"{uuid.uuid4().hex}.part")
+
+
+    @staticmethod
+    def remove_stale_temporaries(older_than):
+        # leftovers of writes that died half way; a write in progress keeps touching its file
+        cutoff = time.time() - older_than
+        removed = 0
+        for name in os.listdir(BlobStore.TEMP_FOLDER) if os.path.isdir(BlobStore.TEMP_FOLDER) else []:
+            path = os.path.join(BlobStore.TEMP_FOLDER, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+    @staticmethod
+    def put_stream(stream):
+        # hashed while written to a temporary file, then moved under its hash; returns (sha256, size, path)
+        sha256 = hashlib.sha256()
+        size = 0
+        temporary_path = BlobStore._temporary_path()
+        try:
+            with open(temporary_path, 'wb') as output:
+                while True:
+                    chunk = stream.read(BlobStore.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    output.write(chunk)
+                    size += len(chunk)
+            return BlobStore.adopt(temporary_path, sha256.hexdigest(), size)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+
+    @staticmethod
+    def put_file(path):
+        # copies a file into the store, the original is left in place
+        with open(path, 'rb') as source:
+            return BlobStore.put_stream(source)
+
+
+    @staticmethod
+    def adopt(path, sha256, size, references=1):
+        # takes over a file whose hash is already known; the reference is taken before the file is
+        # placed, a concurrent release of the same blob then sees a count above zero and keeps it
+        BlobStore.acquire(sha256, size, references)
+        absolute_path = BlobStore.absolute_path(sha256)
+        if os.path.exists(absolute_path):
+            os.remove(path)
+            # the garbage collector goes by mtime, a deduplicated upload counts as new
+            os.utime(absolute_path)
+        else:
+            os.makedirs(os.path.dirname(absolute_path), exist_ok=True)
+            os.replace(path, absolute_path)
+        return sha256, size, BlobStore.relative_path(sha256)
+
+
+    @staticmethod
+    def acquire(sha256, size, references=1):
+        db.blobs.update_one(
+            {"_id": sha256},
+            {
+                "$inc": {"refcount": references},
+                "$setOnInsert": {"size": size, "created_at": int(time.time() * 1000)}
+            },
+            upsert=True
+        )
+
+
+    @staticmethod
+    def release(paths):
+        # one reference per entry, the same blob may be listed several times; non blob paths are ignored
+        released = 0
+        for sha256, count in Counter(BlobStore.hash_of(path) for path in paths if BlobStore.is_blob_path(path)).items():
+            blob = db.blobs.find_one_and_update(
+                {"_id": sha256},
+                {"$inc": {"refcount": -count}},
+                return_document=ReturnDocument.AFTER
+            )
+            if blob and blob['refcount'] <= 0 and db.blobs.delete_one({"_id": sha256, "refcount": {"$lte": 0}}).deleted_count:
+                try:
+                    os.remove(BlobStore.absolute_path(sha256))
+                    released += 1
+                except FileNotFoundError:
+                    logger.warning(f"Blob {sha256} was already missing on disk")
+        return released
+
+
+    @staticmethod
+    def migrate_legacy_paths():
+        # moves files/ and images/ paths still referenced by documents into the store, safe to re-run:
+        # each distinct path is copied in, every document pointing at it is rewritten, then the original goes
+        migrated, missing = 0, 0
+        references = Counter()
+        for file in db.files.find({"path": {"$not": {"$regex": f"^/?{BlobStore.PREFIX}/"}}}, {"path": 1}):
+            references[file['path'].lstrip('/')] += 1
+        item_collections = [db.samples, db.samples_list, db.inventory]
+        for collection in item_collections:
+            for item in collection.find({}, {"image_path": 1, "additional_image_paths": 1}):
+                for path in [item.get('image_path')] + list(item.get('additional_image_paths') or []):
+                    if path and not BlobStore.is_blob_path(path):
+                        # legacy rows of samples_list / inventory may hold the only copy of an image, every
+                        # document pointing at the path counts, a blob must not start at refcount 0
+                        references[path.lstrip('/')] += 1
+
+        # refcount = number of referencing documents: put_file takes one, acquire adds the rest
+        for path, count in references.items():
+            absolute_path = os.path.join(SERVER_DIR, path)
+            if not os.path.isfile(absolute_path):
+                missing += 1
+                logger.warning(f"Not migrated, missing on disk: {path}")
+                continue
+
+            sha256, _, blob_path = BlobStore.put_file(absolute_path)
+            if count > 1:
+                BlobStore.acquire(sha256, 0, count - 1)
+            variants = [path, '/' + path]
+            db.files.update_many({"path": {"$in": variants}}, {"$set": {"path": blob_path, "sha256": sha256}})
+            for collection in item_collections:
+                collection.update_many({"image_path": {"$in": variants}}, {"$set": {"image_path": blob_path}})
+                collection.update_many(
+                    {"additional_image_paths": {"$in": variants}},
+                    {"$set": {"additional_image_paths.$[path]": blob_path}},
+                    array_filters=[{"path": {"$in": variants}}]
+                )
+            os.remove(absolute_path)
+            migrated += 1
+
+        for collection in item_collections:
+            CollectionVersion.bump(collection.name)
+        return migrated, missing
@@ -0,0 +1,196 @@
+import os
+import atexit
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.logger import logger
+
+# Pillow is optional, without it the thumbnail endpoint serves the original image
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE_FOLDER = os.path.join(SERVER_DIR, 'images')
+
+
+# resized copies of images/, generated on first request and kept in a byte bounded on disk LRU:
+# - cache entries are named after (source path, source mtime, source size, width, format),
+#   so a replaced source image simply gets a new entry and the stale one ages out
+# - a hit refreshes the entry's mtime, eviction removes the least recently used entries first
+# - the folder lives outside images/ so the file garbage collector never sees it
+# - renders run on WORKERS threads per worker process, Pillow releases the GIL while resizing and encoding
+class Thumbnail:
+    FOLDER = os.path.join(SERVER_DIR, 'thumbnails')
+    MAX_BYTES = 512 * 1024 * 1024
+    LOW_WATER = 0.9                     # evict down to this fraction of MAX_BYTES
+    WIDTHS = [64, 128, 200, 400, 800]   # requested widths snap up to one of these
+    DEFAULT_WIDTH = 200
+    DEFAULT_FORMAT = 'webp'
+    FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG', 'jpg': 'JPEG', 'png': 'PNG'}
+    QUALITY = 80
+    WORKERS = 2
+
+    _executor = None
+    _pending = {}
+    _lock = threading.Lock()
+    _cached_bytes = None
+
+
+    @staticmethod
+    def available():
+        return Image is not None
+
+
+    @staticmethod
+    def _get_executor():
+        if Thumbnail._executor is None:
+            with Thumbnail._lock:
+                if Thumbnail._executor is None:
+                    Thumbnail._executor = ThreadPoolExecutor(max_workers=Thumbnail.WORKERS, thread_name_prefix="thumbnail")
+                    atexit.register(Thumbnail.shutdown)
+        return Thumbnail._executor
+
+
+    @staticmethod
+    def shutdown():
+        with Thumbnail._lock:
+            executor, Thumbnail._executor = Thumbnail._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+    @staticmethod
+    def normalize(width, fmt):
+        try:
+            width = int(width) if width else Thumbnail.DEFAULT_WIDTH
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid width: {width}")
+        fmt = (fmt or Thumbnail.DEFAULT_FORMAT).lower()
+        if fmt not in Thumbnail.FORMATS:
+            raise ValueError(f"Unsupported format: {fmt}")
+        if fmt == 'jpg':
+            fmt = 'jpeg'
+        width = next((w for w in Thumbnail.WIDTHS if w >= width), Thumbnail.WIDTHS[-1])
+        return width, fmt
+
+
+    @staticmethod
+    def url(image_base_url, image_path, width=None, fmt=None):
+        width, fmt = Thumbnail.normalize(width, fmt)
+        return f"{image_base_url}/{image_path.lstrip('/')}?w={width}&fmt={fmt}"
+
+
+    @staticmethod
+    def _cache_path(source, stat, width, fmt):
+        key = f"{os.path.relpath(source, IMAGE_FOLDER)}:{stat.st_mtime_ns}:{stat.st_size}:{width}:{fmt}"
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(Thumbnail.FOLDER, digest[:2], f"{digest}.{fmt}")
+
+
+    @staticmethod
+    def get(source, width=None, fmt=None):
+        # returns the path of the resized copy, generating it if needed;
+        # concurrent requests for the same entry wait on one render
+        width, fmt = Thumbnail.normalize(width, fmt)
+        stat = os.stat(source)
+        target = Thumbnail._cache_path(source, stat, width, fmt)
+
+        if os.path.exists(target):
+            try:
+                os.utime(target)
+                return target
+            except FileNotFoundError:
+                pass    # evicted in between, render it again
+
+        executor = Thumbnail._get_executor()
+        with Thumbnail._lock:
+            future = Thumbnail._pending.get(target)
+            if future is None:
+                future = executor.submit(
+                    _render, source, target, width, Thumbnail.FORMATS[fmt], Thumbnail.QUALITY
+                )
+                Thumbnail._pending[target] = future
+        try:
+            size = future.result()
+        except Exception:
+            with Thumbnail._lock:
+                if Thumbnail._pending.get(target) is future:
+                    del Thumbnail._pending[target]
+            raise
+        with Thumbnail._lock:
+            # only the first waiter to get here counts the new entry
+            if Thumbnail._pending.get(target) is future:
+                del Thumbnail._pending[target]
+                Thumbnail._account(size, target)
+        return target
+
+
+    @staticmethod
+    def etag(path):
+        # the entry's mtime moves on every hit, its name is what identifies the content
+        return os.path.splitext(os.path.basename(path))[0]
+
+
+    @staticmethod
+    def _entries():
+        entries = []
+        for root, _, filenames in os.walk(Thumbnail.FOLDER):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+
+    @staticmethod
+    def _account(size, keep):
+        # called with _lock held; the running total is rebuilt from disk on first use and after
+        # each eviction, other worker processes write into the same folder
+        if Thumbnail._cached_bytes is None:
+            Thumbnail._cached_bytes = sum(entry[1] for entry in Thumbnail._entries())
+        else:
+            Thumbnail._cached_bytes += size
+        if Thumbnail._cached_bytes > Thumbnail.MAX_BYTES:
+            Thumbnail._cached_bytes = Thumbnail.evict(keep=keep)
+
+
+    @staticmethod
+    def evict(max_bytes=None, keep=None):
+        limit = (max_bytes if max_bytes is not None else Thumbnail.MAX_BYTES) * Thumbnail.LOW_WATER
+        entries = sorted(Thumbnail._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            if path == keep:
+                continue    # about to be served
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logger.info(f"Thumbnail cache evicted {removed} entries, {total} bytes left")
+        return total
+
+
+def _render(source, target, width, pil_format, quality):
+    # runs on a pool thread; other threads and worker processes may render the same target at once
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width * 4))
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.part"
+        image.save(temp_path, format=pil_format, quality=quality)
+    os.replace(temp_path, target)
+    return os.path.getsize(target)
@@ -2,16 +2,30 @@
 
 
 import uuid
-from app.database import db
+from app.database import db, client, supports_transactions
 from bson import ObjectId
 from typing import Dict, Any
 from werkzeug.utils import secure_filename
 import os
 from app.logger import logger
 from typing import List
+import copy
 import json
 import time
-from pymongo import UpdateOne
+import threading
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pymongo import UpdateOne, InsertOne, DeleteMany, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from app.cache import LRUCache
+from app.storage import BlobStore
+from app.similarity import ImageIndex
+from app.catalog import FieldCatalog
+from app.facets import FacetCounts
+from app.versions import CollectionVersion
+from app.lease import Lease
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 SERVER_DIR = os.path.dirname(os.path.dirname(CURRENT_DIR))
@@ -31,6 +45,7 @@ class Item:
         self.categories = kwargs.get('categories', [])
         self.tags = kwargs.get('tags', [])
         self.additional_fields = kwargs.get('additional_fields', {})
+        self.search_text = self.build_search_text(self.additional_fields)
         self.image_path = kwargs.get('image_path')
         self.additional_image_paths = kwargs.get('additional_image_paths', [])
         self.timestamp = kwargs.get('timestamp', int(time.time()))
@@ -44,6 +59,37 @@ class Item:
         self.timestamp = int(kwargs.get('timestamp', time.time() * 1000))
 
 
+    @staticmethod
+    def build_search_text(additional_fields):
+        # additional_fields values flattened into one string, covered by the text index next to
+        # reference_no / side_reference_nos / tags / categories / source (see app/indexes.py)
+        words = []
+        for value in (additional_fields or {}).values():
+            for part in value if isinstance(value, list) else [value]:
+                if isinstance(part, (str, int, float)) and not isinstance(part, bool) and str(part).strip():
+                    words.append(str(part).strip())
+        return ' '.join(words)
+
+
+    @staticmethod
+    def backfill_search_text(batch_size=1000):
+        count = 0
+        for collection in [db.samples, db.samples_list, db.inventory]:
+            operations = []
+            for document in collection.find({"additional_fields": {"$exists": True}}, {"additional_fields": 1}):
+                operations.append(UpdateOne(
+                    {"_id": document['_id']},
+                    {"$set": {"search_text": Item.build_search_text(document['additional_fields'])}}
+                ))
+                if len(operations) >= batch_size:
+                    count += collection.bulk_write(operations, ordered=False).modified_count
+                    operations = []
+            if operations:
+                count += collection.bulk_write(operations, ordered=False).modified_count
+            CollectionVersion.bump(collection.name)
+        return count
+
+
     def _parse_inventory(self, inventory, username):
         # Always create an inventory entry, even if no value is provided
         return [{
@@ -72,22 +118,87 @@ class Item:
 
 
     def save_item(self):
-        if not self.validate_references():
-            raise ValueError("Reference validation failed")
-        data = self.__dict__
-        result = db.samples.insert_one(data)
+        prefix = self.reference_no
+        try:
+            if not self.validate_references():
+                raise ValueError("Reference validation failed")
+            result = self._insert(prefix)
+        except Exception:
+            # the sample was never stored, neither are the references to its images
+            BlobStore.release([self.image_path] + list(self.additional_image_paths or []))
+            raise
+
+        InventoryLedger.record('samples', None, self.reference_no, self.inventory)
+        ImageIndex.add_sample(self.reference_no, [self.image_path] + list(self.additional_image_paths or []))
         return result
 
 
+    def _insert(self, prefix):
+        for attempt in range(ReferenceAllocator.MAX_ATTEMPTS):
+            data = dict(self.__dict__)
+            # movements live in the inventory ledger, only the total stays on the item
+            data.pop('inventory', None)
+            try:
+                result = db.samples.insert_one(data)
+                CollectionVersion.bump('samples')
+                FieldCatalog.record('samples', inserted=[data])
+                FacetCounts.record('samples', added=[data])
+                return result
+            except DuplicateKeyError as e:
+                # allocated numbers never repeat, this only happens against older
+                # timestamp based reference numbers, take the next number and retry
+                key_pattern = (e.details or {}).get('keyPattern', {})
+                if 'side_reference_nos' in key_pattern:
+                    raise ValueError("Side reference numbers are not unique")
+                if 'reference_no' not in key_pattern:
+                    raise
+                logger.warning(f"Reference number {self.reference_no} already taken, allocating a new one")
+                self.reference_no = ReferenceAllocator.allocate(prefix)
+        raise ValueError("Could not allocate a unique reference number")
+
+
 
     @staticmethod
     def are_side_references_unique(side_refs):
         if len(side_refs) != len(set(side_refs)):
             return False
-        for ref in side_refs:
-            if db.samples.find_one({"side_reference_nos": ref}):
-                return False
-        return True
+        if not side_refs:
+            return True
+        # single lookup on the unique multikey index
+        return db.samples.find_one({"side_reference_nos": {"$in": side_refs}}, {"_id": 1}) is None
+
+
+    @staticmethod
+    def validate_reference_batch(rows):
+        # checks a whole spreadsheet before a mass upload, rows: [{"reference_no", "side_reference_no": "a, b"}, ...]
+        reference_nos = [row.get('reference_no') for row in rows if row.get('reference_no')]
+        side_reference_nos = [
+            ref.strip()
+            for row in rows
+            for ref in (row.get('side_reference_no') or '').split(',') if ref.strip()
+        ]
+
+        def duplicates(values):
+            seen, repeated = set(), set()
+            for value in values:
+                (repeated if value in seen else seen).add(value)
+            return sorted(repeated)
+
+        existing_reference_nos = db.samples.distinct("reference_no", {"reference_no": {"$in": reference_nos}}) if reference_nos else []
+        existing_side_reference_nos = []
+        if side_reference_nos:
+            wanted = set(side_reference_nos)
+            for doc in db.samples.find({"side_reference_nos": {"$in": side_reference_nos}}, {"_id": 0, "side_reference_nos": 1}):
+                existing_side_reference_nos.extend(ref for ref in doc['side_reference_nos'] if ref in wanted)
+
+        result = {
+            "duplicate_reference_nos": duplicates(reference_nos),
+            "existing_reference_nos": sorted(existing_reference_nos),
+            "duplicate_side_reference_nos": duplicates(side_reference_nos),
+            "existing_side_reference_nos": sorted(set(existing_side_reference_nos)),
+        }
+        result["valid"] = not any(result.values())
+        return result
 
     @staticmethod
     def is_reference_no_unique(ref_no):
@@ -104,14 +215,8 @@ class Item:
         if not self.are_side_references_unique(self.side_reference_nos):
             raise ValueError("Side reference numbers are not unique")
         
-        # Extract the last 6 digits of the timestamp
-        short_timestamp = str(self.timestamp)[-6:]
-        
-        # Generate the new reference number
-        self.reference_no = f"{self.reference_no}{short_timestamp}x"
-        
-        if not self.is_reference_no_unique(self.reference_no):
-            raise ValueError("Generated reference number is not unique")
+        # Generate the new reference number, unique without a read-before-write
+        self.reference_no = ReferenceAllocator.allocate(self.reference_no)
         
         return True
 
@@ -129,70 +234,360 @@ class Item:
             else:
                 data[key] = value
 
+        # images go to the content addressed store, each path holds one reference (see app/storage.py)
         if 'image' in files:
-            file = files['image']
-            filename = secure_filename(file.filename)
-            directory = os.path.splitext(filename)[0]
-            os.makedirs(os.path.join(SERVER_DIR, 'images', directory), exist_ok=True)
-            file_path = os.path.join(SERVER_DIR, 'images', directory, filename)
-            file.save(file_path)
-            data['image_path'] = f'images/{directory}/{filename}'
+            _, _, data['image_path'] = BlobStore.put_stream(files['image'].stream)
 
         additional_images = []
         for key, file in files.items():
             if key.startswith('additional_image_'):
-                filename = secure_filename(file.filename)
-                directory = os.path.splitext(data['image_path'].split('/')[-1])[0]
-                file_path = os.path.join(SERVER_DIR, 'images', directory, filename)
-                file.save(file_path)
-                additional_images.append(f'/images/{directory}/{filename}')
+                _, _, path = BlobStore.put_stream(file.stream)
+                additional_images.append(path)
         data['additional_image_paths'] = additional_images
 
         return cls(**data)
 
-    @staticmethod
-    def is_reference_unique(abbreviation: str, full_name: str):
-        logger.info(f"Checking uniqueness for abbreviation: {abbreviation}, full_name: {full_name}")
-        result = db.reference_table.find_one({
-            'reference_number_table': {
-                '$elemMatch': {abbreviation: {'$exists': True}}
-            }
-        })
-        if result:
-            return False
-        for doc in db.reference_table.find():
-            for ref in doc.get('reference_number_table', []):
-                if full_name in ref.values():
-                    logger.info(f"Found matching full_name: {full_name}")
-                    return False
-        logger.info("Reference is unique")
-        return True
+    # one document per abbreviation in db.reference_abbreviations, both fields carry a unique index
+    # get_all_references is served from this process cache, kept under the collection's write version
+    # (app/versions.py) so abbreviations added through another worker process show up on the next call
+    _reference_cache = None     # (version, [references])
+
 
     @staticmethod
     def add_reference(full_name: str, abbreviation: str):
         logger.info(f"Attempting to add reference: {abbreviation} - {full_name}")
-        if not Item.is_reference_unique(abbreviation, full_name):
+        # the unique indexes make the insert itself the uniqueness check, also under concurrent inserts
+        try:
+            result = db.reference_abbreviations.insert_one({
+                "abbreviation": abbreviation,
+                "full_name": full_name,
+                "created_at": int(time.time() * 1000)
+            })
+        except DuplicateKeyError:
             logger.warning(f"Reference abbreviation already exists: {abbreviation} - {full_name}")
             raise ValueError("Reference abbreviation already exists")
-        new_reference = {abbreviation: full_name}
-        result = db.reference_table.update_one(
-            {},
-            {'$push': {'reference_number_table': new_reference}},
-            upsert=True
-        )
-        success = result.modified_count > 0 or result.upserted_id is not None
+        CollectionVersion.bump('reference_abbreviations')
+        Item._reference_cache = None
+        success = result.inserted_id is not None
         logger.info(f"Add reference result: {'Success' if success else 'Failure'}")
         return success
 
     @staticmethod
     def get_all_references():
-        result = db.reference_table.find_one({})
-        if result and 'reference_number_table' in result:
-            return [
-                {'abbreviation': list(ref.keys())[0], 'fullName': list(ref.values())[0]}
-                for ref in result['reference_number_table']
+        version = CollectionVersion.get('reference_abbreviations')
+        cached = Item._reference_cache
+        if cached is None or cached[0] != version:
+            references = [
+                {'abbreviation': ref['abbreviation'], 'fullName': ref['full_name']}
+                for ref in db.reference_abbreviations.find({}, {'_id': 0, 'abbreviation': 1, 'full_name': 1}).sort('created_at', 1)
             ]
-        return []
+            cached = Item._reference_cache = (version, references)
+        return list(cached[1])
+
+    @staticmethod
+    def migrate_reference_table():
+        # copy the legacy single-document reference_table into reference_abbreviations,
+        # created_at counts up from the migration time so the listing keeps the legacy order
+        migrated, skipped = 0, 0
+        created_at = int(time.time() * 1000)
+        for doc in db.reference_table.find().sort('_id', 1):
+            for ref in doc.get('reference_number_table', []):
+                for abbreviation, full_name in ref.items():
+                    created_at += 1
+                    try:
+                        result = db.reference_abbreviations.update_one(
+                            {"abbreviation": abbreviation},
+                            {"$setOnInsert": {"full_name": full_name, "created_at": created_at}},
+                            upsert=True
+                        )
+                        migrated += 1 if result.upserted_id else 0
+                    except DuplicateKeyError:
+                        logger.warning(f"Skipping reference {abbreviation} - {full_name}, full name already used")
+                        skipped += 1
+        CollectionVersion.bump('reference_abbreviations')
+        Item._reference_cache = None
+        return migrated, skipped
+
+
+
+
+
+
+class ReferenceAllocator:
+    # hands out reference numbers from per-prefix sequences in db.counters
+    # each process reserves BLOCK_SIZE numbers with one atomic $inc and serves them from memory,
+    # so concurrent uploads (threads or worker processes) never get the same number
+    BLOCK_SIZE = 20
+    MAX_ATTEMPTS = 3
+
+    # 7 digits, older timestamp based numbers used 6, so the two schemes cannot overlap
+    NUMBER_WIDTH = 7
+
+    _lock = threading.Lock()
+    _blocks = {}          # prefix -> [next, last]
+    _pid = None
+
+
+    @staticmethod
+    def _reserve_block(prefix):
+        counter = db.counters.find_one_and_update(
+            {"_id": f"reference_no:{prefix}"},
+            {"$inc": {"seq": ReferenceAllocator.BLOCK_SIZE}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        last = counter['seq']
+        return [last - ReferenceAllocator.BLOCK_SIZE + 1, last]
+
+
+    @staticmethod
+    def allocate(prefix):
+        with ReferenceAllocator._lock:
+            # a forked worker must not reuse the block inherited from its parent
+            if ReferenceAllocator._pid != os.getpid():
+                ReferenceAllocator._blocks = {}
+                ReferenceAllocator._pid = os.getpid()
+
+            block = ReferenceAllocator._blocks.get(prefix)
+            if not block or block[0] > block[1]:
+                block = ReferenceAllocator._reserve_block(prefix)
+                ReferenceAllocator._blocks[prefix] = block
+
+            number = block[0]
+            block[0] += 1
+
+        return f"{prefix}{number:0{ReferenceAllocator.NUMBER_WIDTH}d}x"
+
+
+
+
+
+
+class InventoryLedger:
+    # put-in/take-out history, one document per item per month, so item documents
+    # only carry the materialized total_inventory and stay small
+    # {collection, identifier, reference_no, bucket: "2024-05", movements: [...], count, put_in, take_out}
+    # an item's $inc and its movements are written together: in one transaction where the deployment
+    # supports them, otherwise the ledger goes first and each movement stays "pending" (since when, ms)
+    # until its item write went through; items keep the ids of the last APPLIED_KEEP movements they applied
+    # (inventory_applied), so reconcile() can finish or drop what a crash left pending without counting twice.
+    # movements written with_item came with the insert of their item, its existence is enough
+
+    HISTORY_PAGE_BUCKETS = 6
+    APPLIED_KEEP = 100
+    RECONCILE_AFTER = 300
+
+
+    @staticmethod
+    def _bucket(timestamp):
+        # legacy entries may carry second resolution timestamps
+        seconds = timestamp / 1000 if timestamp > 10**11 else timestamp
+        return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m')
+
+
+    @staticmethod
+    def movement(put_in, take_out, by="User", timestamp=None):
+        return {
+            "id": uuid.uuid4().hex,
+            "putIn": int(put_in or 0),
+            "takeOut": int(take_out or 0),
+            "by": by,
+            "timestamp": timestamp or int(time.time() * 1000)
+        }
+
+
+    @staticmethod
+    def mark_pending(movements, with_item=False):
+        # with_item: the movements come with the insert of their item, which holds them in its total already
+        pending = int(time.time() * 1000)
+        return [{**movement, "pending": pending, **({"with_item": True} if with_item else {})} for movement in movements]
+
+
+    @staticmethod
+    def item_operation(movements):
+        # the $inc of the item the movements belong to; pending movements also leave their ids on the item
+        operation = {"$inc": {"total_inventory": sum(movement['putIn'] - movement['takeOut'] for movement in movements)}}
+        pending = [movement['id'] for movement in movements if 'pending' in movement]
+        if pending:
+            operation["$push"] = {"inventory_applied": {"$each": pending, "$slice": -InventoryLedger.APPLIED_KEEP}}
+        return operation
+
+
+    @staticmethod
+    def _movement_filter(collection_name, identifier, reference_no, movement):
+        return {
+            "collection": collection_name,
+            "identifier": identifier,
+            "reference_no": reference_no,
+            "bucket": InventoryLedger._bucket(movement['timestamp']),
+            "movements.id": movement['id']
+        }
+
+
+    @staticmethod
+    def record_operations(collection_name, identifier, reference_no, movements):
+        buckets = {}
+        for movement in movements:
+            timestamp = movement.get('timestamp') or int(time.time() * 1000)
+            buckets.setdefault(InventoryLedger._bucket(timestamp), []).append(movement)
+
+        return [
+            UpdateOne(
+                {
+                    "collection": collection_name,
+                    "identifier": identifier,
+                    "reference_no": reference_no,
+                    "bucket": bucket
+                },
+                {
+                    "$push": {"movements": {"$each": entries}},
+                    "$inc": {
+                        "count": len(entries),
+                        "put_in": sum(entry.get('putIn', 0) for entry in entries),
+                        "take_out": sum(entry.get('takeOut', 0) for entry in entries)
+                    }
+                },
+                upsert=True
+            )
+            for bucket, entries in buckets.items()
+        ]
+
+
+    @staticmethod
+    def record(collection_name, identifier, reference_no, movements, session=None):
+        operations = InventoryLedger.record_operations(collection_name, identifier, reference_no, movements)
+        return InventoryLedger.write(operations, session)
+
+
+    @staticmethod
+    def settle_operations(collection_name, identifier, reference_no, movements):
+        # the item write went through, the movements are no longer pending
+        return [
+            UpdateOne(InventoryLedger._movement_filter(collection_name, identifier, reference_no, movement),
+                      {"$unset": {"movements.$.pending": "", "movements.$.with_item": ""}})
+            for movement in movements
+        ]
+
+
+    @staticmethod
+    def discard_operations(collection_name, identifier, reference_no, movements):
+        # the item is gone or its write failed, the movements never happened
+        return [
+            UpdateOne(
+                InventoryLedger._movement_filter(collection_name, identifier, reference_no, movement),
+                {
+                    "$pull": {"movements": {"id": movement['id']}},
+                    "$inc": {"count": -1, "put_in": -movement['putIn'], "take_out": -movement['takeOut']}
+                }
+            )
+            for movement in movements
+        ]
+
+
+    @staticmethod
+    def write(operations, session=None):
+        if not operations:
+            return None
+        return db.inventory_movements.bulk_write(operations, ordered=False, session=session)
+
+
+    @staticmethod
+    def reconcile(older_than=None):
+        # movements pending for longer than RECONCILE_AFTER: a writer died between the ledger and the item;
+        # the item's inventory_applied tells whether its $inc still has to be applied
+        older_than = InventoryLedger.RECONCILE_AFTER if older_than is None else older_than
+        cutoff = int((time.time() - older_than) * 1000)
+        summary = {"applied": 0, "settled": 0, "discarded": 0}
+        touched = set()
+        for bucket in db.inventory_movements.find({"movements.pending": {"$lt": cutoff}}):
+            collection = db[bucket['collection']]
+            owner = (bucket['collection'], bucket.get('identifier'), bucket['reference_no'])
+            for movement in bucket.get('movements', []):
+                if movement.get('pending') is None or movement['pending'] >= cutoff:
+                    continue
+                item = collection.find_one({"identifier": owner[1], "reference_no": owner[2]}, {"inventory_applied": 1})
+                if item is None:
+                    InventoryLedger.write(InventoryLedger.discard_operations(*owner, [movement]))
+                    summary['discarded'] += 1
+                    continue
+                if not movement.get('with_item') and movement['id'] not in item.get('inventory_applied', []):
+                    collection.update_one({"_id": item['_id'], "inventory_applied": {"$ne": movement['id']}},
+                                          InventoryLedger.item_operation([movement]))
+                    summary['applied'] += 1
+                    touched.add(bucket['collection'])
+                InventoryLedger.write(InventoryLedger.settle_operations(*owner, [movement]))
+                summary['settled'] += 1
+
+        for collection_name in touched:
+            CollectionVersion.bump(collection_name)
+        if any(summary.values()):
+            logger.warning(f"Inventory ledger reconciled: {summary}")
+        return summary
+
+
+    @staticmethod
+    def history(collection_name, identifier, reference_no, before=None, limit=None):
+        # newest first, paged by month bucket: pass the returned "next" as "before"
+        limit = limit or InventoryLedger.HISTORY_PAGE_BUCKETS
+        query = {
+            "collection": collection_name,
+            "identifier": identifier,
+            "reference_no": reference_no
+        }
+        if before:
+            query["bucket"] = {"$lt": before}
+
+        buckets = list(db.inventory_movements.find(query, {"_id": 0, "bucket": 1, "movements": 1})
+                       .sort("bucket", -1)
+                       .limit(limit))
+
+        movements = []
+        for bucket in buckets:
+            # pending movements are not applied to the item (yet)
+            applied = [movement for movement in bucket.get('movements', []) if 'pending' not in movement]
+            movements.extend(sorted(applied, key=lambda m: m.get('timestamp', 0), reverse=True))
+
+        return {
+            "movements": movements,
+            "next": buckets[-1]['bucket'] if len(buckets) == limit else None
+        }
+
+
+    @staticmethod
+    def migrate_embedded(collection_name, batch_size=500):
+        # move embedded "inventory" arrays into the ledger and recompute total_inventory
+        collection = db[collection_name]
+        cursor = collection.find({"inventory": {"$exists": True}},
+                                 {"identifier": 1, "reference_no": 1, "inventory": 1})
+
+        migrated = 0
+        ledger_operations, item_operations = [], []
+        for doc in cursor:
+            inventory = doc.get('inventory') or []
+            ledger_operations.extend(InventoryLedger.record_operations(
+                collection_name, doc.get('identifier'), doc.get('reference_no'), inventory
+            ))
+            item_operations.append(UpdateOne(
+                {"_id": doc['_id']},
+                {
+                    "$set": {"total_inventory": sum(m.get('putIn', 0) - m.get('takeOut', 0) for m in inventory)},
+                    "$unset": {"inventory": ""}
+                }
+            ))
+            migrated += 1
+
+            if len(item_operations) >= batch_size:
+                InventoryLedger.write(ledger_operations)
+                collection.bulk_write(item_operations, ordered=False)
+                ledger_operations, item_operations = [], []
+
+        if item_operations:
+            InventoryLedger.write(ledger_operations)
+            collection.bulk_write(item_operations, ordered=False)
+        CollectionVersion.bump(collection_name)
+
+        logger.info(f"Migrated inventory history of {migrated} documents in {collection_name}")
+        return migrated
 
 
 
@@ -227,7 +622,12 @@ class ItemBatch:
             "identifier": self.identifier,
             "reference_no": reference_no
         }
+        removed = list(self.collection.find(query, {field: 1 for field in FacetCounts.FIELDS}))
         result = self.collection.delete_many(query)
+        CollectionVersion.bump(self.collection.name)
+        if result.deleted_count:
+            FacetCounts.record(self.collection.name, removed=removed)
+        self._touch_identifier(-result.deleted_count)
         
         return {
             "message": "Item removed successfully",
@@ -240,40 +640,84 @@ class ItemBatch:
 
 
     def save_items(self):
+        # one $in prefetch, then a single unordered bulk for the whole set: inserts, field updates with the
+        # inventory $inc folded in, and the delete of rows no longer listed. inventory movements follow the
+        # ledger protocol of InventoryLedger (written pending first, settled once the bulk went through), not a
+        # transaction, which would turn one failing row into a failed batch. the field catalog, facet counts
+        # and identifier registry are derived from the rows and written after the bulk, one batch each:
+        # eventually consistent, utils/migrate.py field_catalog / facets rebuild them
         try:
-            items_to_update = []
-            items_to_insert = []
+            # keyed by reference_no since identifier is fixed for the whole batch
+            reference_nos = [item.get('reference_no') for item in self.items]
+            existing_items = self._find_existing_items(reference_nos)
+            recorded = self._recorded_movements([
+                item.get('reference_no') for item in self.items
+                if item.get('inventory') and item.get('reference_no') in existing_items
+            ])
+
+            operations = []
+            outcomes = []
+            movements = {}              # outcome index -> pending movements of the row
+            written = {}                # outcome index -> (document or $set, inserted), for the field catalog
+            facets = {}                 # outcome index -> (facet values after, before), for the facet counts
             processed_reference_nos = set()
 
             for item in self.items:
-                existing_item = self._find_existing_item(item)
-                
+                reference_no = item.get('reference_no')
+                existing_item = existing_items.get(reference_no)
+
                 if existing_item:
-                    if 'newPutIn' in item or 'newTakeOut' in item:
-                        # Handle inventory update
-                        self.update_inventory(
-                            item['reference_no'],
-                            item.get('newPutIn', 0),
-                            item.get('newTakeOut', 0),
-                        )
-                    else:
-                        update_operation = self._prepare_update_operation(item, existing_item)
-                        if update_operation:
-                            items_to_update.append((existing_item['_id'], update_operation))
+                    update_operation = self._prepare_update_operation(item, existing_item)
+                    row_movements = InventoryLedger.mark_pending(self._submitted_movements(item, recorded.get(reference_no, set())))
+                    if row_movements:
+                        movements[len(outcomes)] = row_movements
+                        update_operation.update(InventoryLedger.item_operation(row_movements))
+                    operations.append(UpdateOne({'_id': existing_item['_id']}, update_operation))
+                    written[len(outcomes)] = (update_operation.get('$set', {}), False)
+                    facets[len(outcomes)] = (self._facet_values(existing_item, update_operation), existing_item)
+                    outcomes.append({
+                        "reference_no": reference_no,
+                        "status": "inventory_updated" if row_movements else "updated",
+                        "id": str(existing_item['_id'])
+                    })
                 else:
                     new_item = self._process_item(item)
-                    items_to_insert.append(new_item)
+                    new_item['_id'] = ObjectId()
+                    operations.append(InsertOne(new_item))
+                    if item.get('inventory'):
+                        movements[len(outcomes)] = InventoryLedger.mark_pending(
+                            self._initial_movements(item['inventory']), with_item=True
+                        )
+                    written[len(outcomes)] = (new_item, True)
+                    facets[len(outcomes)] = (new_item, {})
+                    outcomes.append({"reference_no": reference_no, "status": "inserted", "id": str(new_item['_id'])})
                 
-                processed_reference_nos.add(item.get('reference_no'))
+                processed_reference_nos.add(reference_no)
+
+            # rows of this set which are no longer in the submitted list
+            obsolete_query = {
+                'identifier': self.identifier,
+                'reference_no': {'$nin': list(processed_reference_nos)}
+            }
+            obsolete_items = list(self.collection.find(obsolete_query, {field: 1 for field in FacetCounts.FIELDS}))
+            operations.append(DeleteMany(obsolete_query))
 
-            updated_ids = self._perform_bulk_update(items_to_update)
-            inserted_ids = self._insert_new_items(items_to_insert)
-            self._remove_obsolete_items(processed_reference_nos)
+            InventoryLedger.write(self._movement_operations(outcomes, movements, InventoryLedger.record_operations))
+            removed_count = self._execute_bulk(operations, outcomes)
+            self._settle_movements(outcomes, movements)
+            CollectionVersion.bump(self.collection.name)
+            self._record_fields(outcomes, written)
+            self._record_facets(outcomes, facets, obsolete_items if removed_count else [])
+
+            inserted_count = sum(1 for o in outcomes if o["status"] == "inserted")
+            self._touch_identifier(inserted_count - removed_count)
 
             return {
                 "message": "Items processed successfully",
-                "inserted_ids": inserted_ids,
-                "updated_ids": updated_ids,
+                "inserted_ids": [o["id"] for o in outcomes if o["status"] == "inserted"],
+                "updated_ids": [o["id"] for o in outcomes if o["status"] in ("updated", "inventory_updated")],
+                "removed_count": removed_count,
+                "results": outcomes,
                 "identifier": self.identifier
             }
 
@@ -285,63 +729,245 @@ class ItemBatch:
 
 
 
-    def _find_existing_item(self, item):
+    def _find_existing_items(self, reference_nos):
         query = {
-            'reference_no': item['reference_no'],
-            'identifier': self.identifier
+            'identifier': self.identifier,
+            'reference_no': {'$in': reference_nos}
         }
-        return self.collection.find_one(query)
+        return {doc['reference_no']: doc for doc in self.collection.find(query)}
 
 
 
-
-    def update_inventory(self, reference_no, put_in, take_out):
+    def _recorded_movements(self, reference_nos):
+        # (timestamp, putIn, takeOut) of every movement already in the ledger, per reference_no
+        recorded = {}
+        if not reference_nos:
+            return recorded
         query = {
+            "collection": self.collection.name,
             "identifier": self.identifier,
-            "reference_no": reference_no
-        }
-        
-        item = self.collection.find_one(query)
-        
-        if not item:
-            raise ValueError(f"Item with reference number {reference_no} not found")
-         
-        # Create new inventory entry
-        new_entry = {
-            "putIn": put_in,
-            "takeOut": take_out,
-            "by": "User",
-            "timestamp": int(time.time() * 1000)
-        }
-        
-        # Append new entry to existing inventory
-        inventory = item.get('inventory', [])
-        inventory.append(new_entry)
-        
-        # Calculate new total inventory
-        new_total_inventory = self._calculate_inventory(inventory)
-        
-        # Update the document
-        update_operation = {
-            "$set": {
-                "inventory": inventory,
-                "total_inventory": new_total_inventory
-            }
+            "reference_no": {"$in": reference_nos}
         }
-        
-        result = self.collection.update_one(query, update_operation)
-        
-        if result.modified_count == 0:
-            raise ValueError("Failed to update inventory")
-        
+        for bucket in db.inventory_movements.find(query, {"reference_no": 1, "movements": 1}):
+            keys = recorded.setdefault(bucket['reference_no'], set())
+            for movement in bucket.get('movements', []):
+                keys.add(ItemBatch._movement_key(movement))
+        return recorded
+
+
+
+    @staticmethod
+    def _movement_key(movement):
+        return (movement.get('timestamp'), int(movement.get('putIn') or 0), int(movement.get('takeOut') or 0))
+
+
+
+    @staticmethod
+    def _submitted_movements(item, recorded):
+        # an existing row changes inventory through newPutIn / newTakeOut, or through entries appended to the
+        # "inventory" list it was loaded with: entries the ledger does not know yet are new movements
+        movements = []
+        if item.get('newPutIn') or item.get('newTakeOut'):
+            movements.append(InventoryLedger.movement(item.get('newPutIn', 0), item.get('newTakeOut', 0)))
+        for entry in item.get('inventory') or []:
+            if isinstance(entry, dict) and ItemBatch._movement_key(entry) not in recorded:
+                movements.append(InventoryLedger.movement(
+                    entry.get('putIn', 0), entry.get('takeOut', 0), entry.get('by', "User"), entry.get('timestamp')
+                ))
+        return movements
+
+
+
+    @staticmethod
+    def _initial_movements(inventory):
+        # the "inventory" list a new row comes with, as ledger movements
+        return [
+            InventoryLedger.movement(entry.get('putIn', 0), entry.get('takeOut', 0), entry.get('by', "User"), entry.get('timestamp'))
+            for entry in inventory if isinstance(entry, dict)
+        ]
+
+
+
+    def _execute_bulk(self, operations, outcomes):
+        # unordered, so one failing row does not stop the rest of the batch,
+        # the operation index maps write errors back to the row outcomes (delete is always last)
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            logger.info(f"Bulk save: inserted {result.inserted_count}, modified {result.modified_count}, removed {result.deleted_count}")
+            return result.deleted_count
+        except BulkWriteError as e:
+            details = e.details
+            for error in details.get('writeErrors', []):
+                index = error['index']
+                if index < len(outcomes):
+                    outcomes[index]['status'] = "error"
+                    outcomes[index]['error'] = error.get('errmsg', 'Write failed')
+            logger.error(f"Bulk save finished with {len(details.get('writeErrors', []))} failed rows")
+            return details.get('nRemoved', 0)
+
+
+
+
+
+    def _record_fields(self, outcomes, written):
+        ok = [written[index] for index in written if outcomes[index]['status'] != "error"]
+        FieldCatalog.record(
+            self.collection.name,
+            inserted=[document for document, inserted in ok if inserted],
+            updated=[document for document, inserted in ok if not inserted]
+        )
+
+
+
+    def _record_facets(self, outcomes, facets, removed):
+        ok = [facets[index] for index in facets if outcomes[index]['status'] != "error"]
+        FacetCounts.record(
+            self.collection.name,
+            added=[after for after, _ in ok],
+            removed=[before for _, before in ok] + removed
+        )
+
+
+
+    @staticmethod
+    def _facet_values(existing_item, update_operation):
+        # the facet fields of a row as they are once update_operation is applied
+        values = {field: existing_item.get(field) for field in FacetCounts.FIELDS}
+        for field in update_operation.get('$unset', {}):
+            if field in values:
+                values[field] = None
+        for field, value in update_operation.get('$set', {}).items():
+            if field in values:
+                values[field] = value
+        return values
+
+
+
+    def _movement_operations(self, outcomes, movements, operations):
+        return [
+            operation
+            for index, entries in movements.items()
+            for operation in operations(self.collection.name, self.identifier, outcomes[index]['reference_no'], entries)
+        ]
+
+
+
+    def _settle_movements(self, outcomes, movements):
+        # pending movements of rows written by the bulk are settled, those of failed rows never happened
+        InventoryLedger.write(
+            self._movement_operations(outcomes, {index: entries for index, entries in movements.items()
+                                                 if outcomes[index]['status'] != "error"}, InventoryLedger.settle_operations) +
+            self._movement_operations(outcomes, {index: entries for index, entries in movements.items()
+                                                 if outcomes[index]['status'] == "error"}, InventoryLedger.discard_operations)
+        )
+
+
+
+
+
+    def update_inventory(self, reference_no, put_in, take_out, by="User"):
+        # $inc is applied atomically by the server, so concurrent
+        # put-ins/take-outs on the same item cannot overwrite each other
+        movement = InventoryLedger.movement(put_in, take_out, by)
+        totals = self._write_movements([(reference_no, movement)])
+
+        if reference_no not in totals:
+            raise LookupError(f"Item with reference number {reference_no} not found")
+
         return {
             "message": "Inventory updated successfully",
             "reference_no": reference_no,
-            "total_inventory": new_total_inventory
+            "total_inventory": totals[reference_no]
         }
 
 
 
+    def _write_movements(self, movements):
+        # movements: [(reference_no, movement)], every item $inc together with its ledger entry (see InventoryLedger);
+        # returns {reference_no: total_inventory} of the items found, read once every write is done
+        reference_nos = list(dict.fromkeys(reference_no for reference_no, _ in movements))
+        totals = {}
+
+        def read_totals(session):
+            return {
+                doc['reference_no']: doc.get('total_inventory', 0)
+                for doc in self.collection.find(
+                    {"identifier": self.identifier, "reference_no": {"$in": reference_nos}},
+                    {"reference_no": 1, "total_inventory": 1},
+                    session=session
+                )
+            }
+
+        def ledger_operations(entries, operations):
+            grouped = {}
+            for reference_no, movement in entries:
+                grouped.setdefault(reference_no, []).append(movement)
+            return [
+                operation
+                for reference_no, group in grouped.items()
+                for operation in operations(self.collection.name, self.identifier, reference_no, group)
+            ]
+
+        def item_operations(entries):
+            return [
+                UpdateOne({"identifier": self.identifier, "reference_no": reference_no}, InventoryLedger.item_operation([movement]))
+                for reference_no, movement in entries
+            ]
+
+        if supports_transactions():
+            def write(session):
+                self.collection.bulk_write(item_operations(movements), ordered=False, session=session)
+                totals.clear()
+                totals.update(read_totals(session))
+                # unknown references get no ledger entry
+                found = [(reference_no, movement) for reference_no, movement in movements if reference_no in totals]
+                InventoryLedger.write(ledger_operations(found, InventoryLedger.record_operations), session)
+
+            with client.start_session() as session:
+                session.with_transaction(write)
+        else:
+            movements = [(reference_no, movement) for (reference_no, _), movement
+                         in zip(movements, InventoryLedger.mark_pending([movement for _, movement in movements]))]
+            InventoryLedger.write(ledger_operations(movements, InventoryLedger.record_operations))
+            self.collection.bulk_write(item_operations(movements), ordered=False)
+            totals.update(read_totals(None))
+            InventoryLedger.write(
+                ledger_operations([entry for entry in movements if entry[0] in totals], InventoryLedger.settle_operations) +
+                ledger_operations([entry for entry in movements if entry[0] not in totals], InventoryLedger.discard_operations)
+            )
+
+        CollectionVersion.bump(self.collection.name)
+        self._touch_identifier()
+        return totals
+
+
+
+    def update_inventories(self, changes):
+        # bulk variant of update_inventory, changes: [{"reference_no", "putIn", "takeOut", "by"?, "timestamp"?}, ...]
+        # one result per change, in order. totals are a post-write snapshot, read once every change is written,
+        # minus the later changes of this call to the same item: exact inside a transaction, without one a
+        # concurrent writer to the same item may already be counted in
+        if not changes:
+            return []
+
+        movements = [
+            (change['reference_no'], InventoryLedger.movement(
+                change.get('putIn', 0), change.get('takeOut', 0), change.get('by', "User"), change.get('timestamp')
+            ))
+            for change in changes
+        ]
+        totals = self._write_movements(movements)
+
+        results = []
+        for reference_no, movement in reversed(movements):
+            if reference_no not in totals:
+                results.append({"reference_no": reference_no, "error": "Item not found"})
+                continue
+            results.append({"reference_no": reference_no, "total_inventory": totals[reference_no]})
+            totals[reference_no] -= movement['putIn'] - movement['takeOut']
+        return results[::-1]
+
+
 
     def _calculate_inventory(self, inventory):
         return sum(item.get('putIn', 0) - item.get('takeOut', 0) for item in inventory)
@@ -349,11 +975,15 @@ class ItemBatch:
 
 
     @staticmethod
-    def _get_relative_path(full_path):
-        # Assume the full path always contains '/search/api/images/' directory
+    def _get_image_path(full_path):
+        # thumbnail urls carry ?w=&fmt=, the stored path is the original image
+        full_path = full_path.split('?')[0]
+        # images are served from '/search/api/images/...' or, content addressed, '/search/api/blobs/...'
+        if f'/search/api/{BlobStore.PREFIX}/' in full_path:
+            return f"{BlobStore.PREFIX}/{full_path.split(f'/search/api/{BlobStore.PREFIX}/')[-1]}"
         if '/search/api/images/' in full_path:
-            return full_path.split('/search/api/images/')[-1]
-        return full_path  # Return as is if it doesn't contain '/search/api/images/'
+            full_path = full_path.split('/search/api/images/')[-1]
+        return f"images/{full_path}"
 
 
 
@@ -364,18 +994,19 @@ class ItemBatch:
             "identifier": self.identifier
         }
         for key, value in item.items():
-            if key not in ['_id', 'timestamp', 'identifier']:
+            if key not in ['_id', 'timestamp', 'identifier', 'image_original_url', 'search_text', 'inventory_applied']:
                 if key == 'inventory':
-                    processed_item[key] = value
+                    # history is recorded in the InventoryLedger by save_items
                     processed_item['total_inventory'] = self._calculate_inventory(value)
                 elif key == 'image_url':
                     # Convert full URL to relative path
-                    relative_path = self._get_relative_path(value)
-                    processed_item['image_path'] = f"images/{relative_path}"
+                    processed_item['image_path'] = self._get_image_path(value)
                 elif key in ['unit_price', 'unit_weight']:
                     processed_item[key] = self._ensure_array(value)
                 else:
                     processed_item[key] = value
+        if 'additional_fields' in processed_item:
+            processed_item['search_text'] = Item.build_search_text(processed_item['additional_fields'])
         return processed_item
 
 
@@ -394,24 +1025,23 @@ class ItemBatch:
     def _prepare_update_operation(self, new_item, existing_item):
         update_operation = {'$set': {}, '$unset': {}}
         
+        # inventory and total_inventory are only changed through the ledger ($inc), never overwritten
         for key in existing_item:
-            if key not in new_item and key not in ['_id', 'identifier', 'timestamp', 'original_inventory']:
+            if key not in new_item and key not in ['_id', 'identifier', 'timestamp', 'original_inventory', 'total_inventory',
+                                                   'search_text', 'inventory_applied']:
                 update_operation['$unset'][key] = ""
 
         for key, value in new_item.items():
-            if key not in ['_id', 'identifier', 'timestamp']:
+            if key not in ['_id', 'identifier', 'timestamp', 'inventory', 'total_inventory', 'newPutIn', 'newTakeOut',
+                           'image_original_url', 'search_text', 'inventory_applied']:
                 if value is None or value == "":
                     update_operation['$unset'][key] = ""
                 else:
                     if key in ['categories', 'tags']:
                         update_operation['$set'][key] = value if isinstance(value, list) else [value]
-                    elif key == 'inventory':
-                        update_operation['$set'][key] = value
-                        update_operation['$set']['total_inventory'] = self._calculate_inventory(value)
                     elif key == 'image_url':
                         # Convert full URL to relative path
-                        relative_path = self._get_relative_path(value)
-                        update_operation['$set']['image_path'] = f"images/{relative_path}"
+                        update_operation['$set']['image_path'] = self._get_image_path(value)
                     else:
                         update_operation['$set'][key] = value
 
@@ -420,6 +1050,12 @@ class ItemBatch:
             if key in update_operation['$unset']:
                 del update_operation['$unset'][key]
 
+        # the text indexed copy of additional_fields follows it
+        if 'additional_fields' in update_operation['$set']:
+            update_operation['$set']['search_text'] = Item.build_search_text(update_operation['$set']['additional_fields'])
+        elif 'additional_fields' in update_operation['$unset']:
+            update_operation['$unset']['search_text'] = ""
+
         update_operation['$set']['timestamp'] = self.timestamp
 
         if not update_operation['$set']:
@@ -432,74 +1068,72 @@ class ItemBatch:
 
 
 
-    def _perform_bulk_update(self, items_to_update):
-        updated_ids = []
-        if items_to_update:
-            bulk_operations = [
-                UpdateOne({'_id': item_id}, update_operation)
-                for item_id, update_operation in items_to_update
-            ]
-            
-            if bulk_operations:
-                update_result = self.collection.bulk_write(bulk_operations)
-                updated_ids = [str(item_id) for item_id, _ in items_to_update]
-                logger.info(f"Updated {update_result.modified_count} existing items. Updated IDs: {updated_ids}")
-        return updated_ids
-
-    def _insert_new_items(self, items_to_insert):
-        inserted_ids = []
-        if items_to_insert:
-            insert_result = self.collection.insert_many(items_to_insert)
-            inserted_ids = [str(id) for id in insert_result.inserted_ids]
-            logger.info(f"Inserted {len(inserted_ids)} new items. Inserted IDs: {inserted_ids}")
-        return inserted_ids
-
-    def _remove_obsolete_items(self, processed_reference_nos):
-        result = self.collection.delete_many({
-            'identifier': self.identifier,
-            'reference_no': {'$nin': list(processed_reference_nos)}
-        })
-        logger.info(f"Removed {result.deleted_count} obsolete items from the set.")
-
+    # db.identifiers is the registry of batch identifiers, one document each:
+    # {identifier, mode, name, owner, created_at, item_count, last_modified}, kept up to date by every write of the batch
+    IDENTIFIER_PAGE_SIZE = 50
 
 
+    @staticmethod
+    def _registry_mode(mode):
+        return 'inventory' if mode == 'inventory' else 'sampling'
+
+
+    def _touch_identifier(self, item_count_change=0):
+        now = int(time.time() * 1000)
+        db.identifiers.update_one(
+            {"identifier": self.identifier},
+            {
+                "$inc": {"item_count": item_count_change},
+                "$set": {"last_modified": now},
+                "$setOnInsert": {
+                    "mode": self._registry_mode(self.mode),
+                    "name": self.identifier,
+                    "owner": None,
+                    "created_at": now
+                }
+            },
+            upsert=True
+        )
 
 
     @staticmethod
-    def get_identifiers(mode):
-        if mode == 'inventory':
-            collection = db.inventory
-            prefix = 'INV'
-        elif mode == 'sampling':
-            collection = db.samples_list
-            prefix = 'SAM'
-        else:
-            return []  # Return an empty list if not in sampling or inventory mode
-        
-        pipeline = [
-            {"$match": {"identifier": {"$regex": f"^{prefix}_"}}},
-            {"$group": {"_id": "$identifier"}},
-            {"$project": {"identifier": "$_id", "_id": 0}}
-        ]
-        
-        identifiers = list(collection.aggregate(pipeline))
-        return [i['identifier'] for i in identifiers]
+    def get_identifiers(mode, page=None, page_size=None, with_stats=False):
+        if mode not in ['inventory', 'sampling']:
+            return [], 0  # Return an empty list if not in sampling or inventory mode
+
+        query = {"mode": mode}
+        projection = {"_id": 0} if with_stats else {"_id": 0, "identifier": 1}
+        cursor = db.identifiers.find(query, projection).sort("created_at", -1)
+
+        total = None
+        if page:
+            page_size = page_size or ItemBatch.IDENTIFIER_PAGE_SIZE
+            cursor = cursor.skip((page - 1) * page_size).limit(page_size)
+            total = db.identifiers.count_documents(query)
+
+        identifiers = list(cursor)
+        if not with_stats:
+            identifiers = [i['identifier'] for i in identifiers]
+        return identifiers, total if total is not None else len(identifiers)
 
 
 
 
     @staticmethod
-    def create_identifier(mode, name):
+    def create_identifier(mode, name, owner=None):
         prefix = "INV" if mode == 'inventory' else "SAM"
         new_identifier = f"{prefix}_{name}_{str(uuid.uuid4())[:8]}"
+        now = int(time.time() * 1000)
         
-        collection = db.inventory if mode == 'inventory' else db.samples_list
-        
-        # Store the new identifier in the appropriate collection
-        collection.insert_one({
+        # Store the new identifier in the registry, no placeholder item is needed anymore
+        db.identifiers.insert_one({
             "identifier": new_identifier,
-            "created_at": int(time.time() * 1000),
-            "name": name
+            "mode": ItemBatch._registry_mode(mode),
+            "name": name,
+            "owner": owner,
+            "created_at": now,
+            "item_count": 0,
+            "last_modified": now
         })
         
         return new_identifier
@@ -507,9 +1141,53 @@ class ItemBatch:
 
 
 
+    @staticmethod
+    def backfill_identifier_registry():
+        # build the registry from identifiers already present in the item collections
+        count = 0
+        for mode, collection in [('inventory', db.inventory), ('sampling', db.samples_list)]:
+            pipeline = [
+                {"$match": {"identifier": {"$exists": True}}},
+                {"$group": {
+                    "_id": "$identifier",
+                    "name": {"$max": "$name"},
+                    "created_at": {"$min": {"$ifNull": ["$created_at", "$timestamp"]}},
+                    "last_modified": {"$max": "$timestamp"},
+                    "item_count": {"$sum": {"$cond": [{"$ifNull": ["$reference_no", False]}, 1, 0]}}
+                }}
+            ]
+            operations = [
+                UpdateOne(
+                    {"identifier": group['_id']},
+                    {"$set": {
+                        "mode": mode,
+                        "name": group.get('name') or group['_id'],
+                        "created_at": group.get('created_at'),
+                        "item_count": group['item_count'],
+                        "last_modified": group.get('last_modified') or group.get('created_at')
+                    }, "$setOnInsert": {"owner": None}},
+                    upsert=True
+                )
+                for group in collection.aggregate(pipeline)
+            ]
+            if operations:
+                db.identifiers.bulk_write(operations, ordered=False)
+            count += len(operations)
+        return count
+
+
+
+
 
 
 class Workflow:
+    # every committed change bumps workflows.version and stamps the touched nodes with it,
+    # fetches with since_version only return nodes stamped later (sections and files come with their node)
+    # assembled trees are cached per (workflow_id, version); every fetch reads the committed version
+    # (one indexed find_one), so a commit made by any worker is seen by the next fetch of every other
+    _tree_cache = LRUCache(max_entries=64)
+
+
     def __init__(self, name, workflow_id, is_locked, status, owner, timestamp=None):
         self._id = ObjectId()
         self.workflow_id = workflow_id
@@ -522,8 +1200,9 @@ class Workflow:
         self.timestamp = timestamp or int(time.time() * 1000)  # Use provided timestamp or current time
 
 
-    def save(self):
-        data = {
+    def document(self):
+        # the workflows document, written by WorkflowCommit
+        return {
             "_id": self._id,
             "workflow_id": self.workflow_id,
             "name": self.name,
@@ -532,83 +1211,92 @@ class Workflow:
             "status": self.status,
             "is_locked": self.is_locked,
             "owner": self.owner,
-            "timestamp": self.timestamp
+            "timestamp": self.timestamp,
+            "version": 0
         }
-        return db.workflows.insert_one(data)
-
 
 
     @staticmethod
-    def update_status(workflow_id: str, status: str):
-        return db.workflows.update_one(
+    def bump_version(workflow_id, node_ids=(), session=None):
+        workflow = db.workflows.find_one_and_update(
             {"workflow_id": workflow_id},
-            {"$set": {"status": status}}
+            {"$inc": {"version": 1}},
+            projection={"version": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
         )
+        if not workflow:
+            return None
 
+        version = workflow['version']
+        node_ids = [node_id for node_id in set(node_ids) if node_id]
+        if node_ids:
+            db.nodes.update_many({"node_id": {"$in": node_ids}}, {"$set": {"version": version}}, session=session)
+        return version
 
-    @staticmethod
-    def update_lock_status(workflow_id, is_locked):
-        return db.workflows.update_one(
-            {"workflow_id": workflow_id},
-            {"$set": {"is_locked": is_locked}}
-        )
-
-    @staticmethod
-    def update_edges(workflow_id, edges):
-        return db.workflows.update_one(
-            {"workflow_id": workflow_id},
-            {"$set": {"edges": edges}}
-        )
 
     @staticmethod
-    def push_node(workflow_id, node_id):
-        return db.workflows.update_one(
-            {"workflow_id": workflow_id},
-            {"$push": {"node_ids": node_id}}
-        )
+    def get_workflow_by_id(workflow_id, since_version=None):
+        version = db.workflows.find_one({"workflow_id": workflow_id}, {"version": 1})
+        if not version:
+            return None
+        workflow = Workflow._tree_cache.get((workflow_id, version.get('version', 0)))
+        if workflow is None:
+            workflow = Workflow._assemble_workflow(workflow_id)
+            if workflow is None:
+                return None
+            Workflow._tree_cache.set((workflow_id, workflow['version']), workflow)
+
+        # callers may change what they get, the cached tree stays untouched
+        if since_version is None:
+            return copy.deepcopy(workflow)
+        return copy.deepcopy(Workflow._workflow_delta(workflow, since_version))
 
-    @staticmethod
-    def remove_node(workflow_id, node_id):
-        return db.workflows.update_one(
-            {"workflow_id": workflow_id},
-            {"$pull": {"node_ids": node_id}}
-        )
 
     @staticmethod
-    def confirm_workflow(workflow_id):
-        return db.workflows.update_one(
-            {"workflow_id": workflow_id},
-            {"$set": {"status": "confirmed"}}
-        )
+    def _workflow_delta(workflow, since_version):
+        # node_ids lets the client drop nodes removed since its version
+        delta = {key: value for key, value in workflow.items() if key != 'nodes'}
+        delta['since_version'] = since_version
+        delta['nodes'] = [node for node in workflow['nodes'] if node.get('version', 0) > since_version]
+        delta['node_ids'] = [node['node_id'] for node in workflow['nodes']]
+        return delta
+
 
     @staticmethod
-    def get_workflow_by_id(workflow_id):
+    def _assemble_workflow(workflow_id):
         try:
             workflow = db.workflows.find_one({"workflow_id": workflow_id})
             if not workflow:
                 return None
             workflow['_id'] = str(workflow['_id'])
+            workflow['version'] = workflow.get('version', 0)
 
+            # the whole tree in three more queries, independent of node/section counts
             nodes = list(db.nodes.find({"workflow_id": workflow_id}))
+            node_ids = [node['node_id'] for node in nodes]
+            sections = list(db.sections.find({"node_id": {"$in": node_ids}}))
+            file_ids = [file_id for section in sections for file_id in section.get('file_ids', [])]
+            files = {
+                file['file_id']: file
+                for file in db.files.find(
+                    {"file_id": {"$in": file_ids}},
+                    {"_id": 0, "file_id": 1, "name": 1, "type": 1, "size": 1}
+                )
+            } if file_ids else {}
+
+            sections_by_node = {}
+            for section in sections:
+                section['_id'] = str(section['_id'])
+                section['files'] = [files[file_id] for file_id in section.get('file_ids', []) if file_id in files]
+                sections_by_node.setdefault(section['node_id'], []).append(section)
+
             workflow['nodes'] = []
             node_map = {node['node_id']: node['node_id'] for node in nodes}
             for node in nodes:
                 node['_id'] = str(node['_id'])
                 node['id'] = node['id'] if 'id' in node else node['node_id']
-
-                sections = list(db.sections.find({"node_id": node['node_id']}))
-                node['sections'] = []
-
-                for section in sections:
-                    section['_id'] = str(section['_id'])
-                    files = list(db.files.find({"file_id": {"$in": section.get('file_ids', [])}}))
-                    section['files'] = [{
-                        "file_id": file['file_id'],
-                        "name": file['name'],
-                        "type": file['type'],
-                        "size": file['size']
-                    } for file in files]
-                    node['sections'].append(section)
+                node['sections'] = sections_by_node.get(node['node_id'], [])
                 workflow['nodes'].append(node)
             
             if 'edges' not in workflow or not workflow['edges']:
@@ -658,8 +1346,8 @@ class Node:
         self.status = status
         self.section_ids = []
 
-    def save(self):
-        data = {
+    def document(self):
+        return {
             "_id": self._id,
             "node_id": self.node_id,
             "workflow_id": self.workflow_id,
@@ -667,21 +1355,6 @@ class Node:
             "status": self.status,
             "section_ids": self.section_ids
         }
-        return db.nodes.insert_one(data)
-
-    @staticmethod
-    def update_status(node_id, status):
-        return db.nodes.update_one(
-            {"node_id": node_id},
-            {"$set": {"status": status}}
-        )
-
-    @staticmethod
-    def push_section(node_id, section_id):
-        return db.nodes.update_one(
-            {"node_id": node_id},
-            {"$push": {"section_ids": section_id}}
-        )
 
 
 
@@ -698,8 +1371,8 @@ class Section:
 
 
 
-    def save(self):
-        data = {
+    def document(self):
+        return {
             "_id": self._id,
             "section_id": self.section_id,
             "node_id": self.node_id,
@@ -707,12 +1380,11 @@ class Section:
             "label": self.label,
             "file_ids": self.file_ids
         }
-        return db.sections.insert_one(data)
 
 
 
     @staticmethod
-    def push_file_id(workflow_id, node_id, section_id, file_id):
+    def push_file_ids(workflow_id, node_id, section_id, file_ids):
         if section_id == 'undefined' or not section_id:
             logger.error(f"Invalid section_id: {section_id} for workflow_id: {workflow_id}, node_id: {node_id}")
             return None
@@ -729,7 +1401,7 @@ class Section:
             "node_id": node_id,
             "$or": [{"_id": section_object_id}, {"section_id": section_id}]
         }
-        update = {"$push": {"file_ids": file_id}}
+        update = {"$push": {"file_ids": {"$each": file_ids}}}
 
         logger.info(f"Attempting to update section. Query: {query}, Update: {update}")
 
@@ -739,7 +1411,7 @@ class Section:
             logger.error(f"No section found for workflow_id: {workflow_id}, node_id: {node_id}, section_id: {section_id}")
             return None
         elif result.modified_count == 0:
-            logger.warning(f"Section found but not modified. Possible duplicate file_id: {file_id}")
+            logger.warning(f"Section found but not modified. File ids: {file_ids}")
         
         return result
 
@@ -796,76 +1468,108 @@ class File:
                 "type": file["type"],
                 "size": file["size"],
                 "path": os.path.join(SERVER_DIR, file["path"]),  # This should now correctly point to the 'files' directory
+                "sha256": file.get("sha256"),
             }
         return None
 
 
+    # uploads are streamed into the blob store on a bounded pool, hashing while writing,
+    # metadata then goes to the database with one insert_many and one $push per section
+    CHUNK_SIZE = 1024 * 1024
+    UPLOAD_WORKERS = 4
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
     @staticmethod
-    def process_multiple_uploads(files, file_data_array, workflow_id, node_id, section_id, FILE_FOLDER):
+    def _get_executor():
+        with File._executor_lock:
+            if File._executor is None:
+                File._executor = ThreadPoolExecutor(max_workers=File.UPLOAD_WORKERS, thread_name_prefix="upload")
+            return File._executor
+
+
+    @staticmethod
+    def process_multiple_uploads(files, file_data_array, workflow_id, node_id, section_id):
         results = []
+        pending = []
+        executor = File._get_executor()
         for file, file_data in zip(files, file_data_array):
             if file.filename == '':
                 continue
 
             if file and File.allowed_file(file.filename):
-                result = File.process_single_upload(file, file_data, workflow_id, node_id, section_id, FILE_FOLDER)
-                results.append(result)
+                future = executor.submit(BlobStore.put_stream, file.stream)
+                pending.append((future, file_data))
             else:
                 results.append({
                     "error": "Invalid file type",
                     "file_name": file.filename
                 })
-        return results
-
 
+        documents = []
+        for future, file_data in pending:
+            try:
+                sha256, size, path = future.result()
+            except Exception as e:
+                logger.exception(f"Error processing file upload: {str(e)}")
+                results.append({
+                    "error": f"Error processing file upload: {str(e)}",
+                    "file_id": file_data['file_id']
+                })
+                continue
 
-    @staticmethod
-    def process_single_upload(file, file_data, workflow_id, node_id, section_id, FILE_FOLDER):
-        try:
-            filename = secure_filename(file.filename)
-            relative_path = os.path.join('files', filename)
-            absolute_path = os.path.join(FILE_FOLDER, filename)
-            file.save(absolute_path)
-
-            file_document = {
+            documents.append({
                 "file_id": file_data['file_id'],
                 "name": file_data['name'],
                 "type": file_data['type'],
                 "size": file_data['size'],
-                "path": relative_path  # Store the relative path
-            }
+                "path": path,  # Store the relative path
+                "sha256": sha256,
+                "uploaded_at": int(time.time() * 1000)
+            })
 
-            # Insert file document into files collection
-            file_result = db.files.insert_one(file_document)
+        results.extend(File.persist_uploads(documents, workflow_id, node_id, section_id))
 
+        if any("message" in result for result in results):
+            Workflow.bump_version(workflow_id, [node_id])
+        return results
 
-            if file_result.inserted_id:
-                # Update the section with the new file_id
-                section_result = Section.push_file_id(workflow_id, node_id, section_id, file_data['file_id'])
-                
-                if section_result and section_result.modified_count > 0:
-                    return {
-                        "message": "File uploaded successfully",
-                        "file_id": file_data['file_id']
-                    }
-                else:
-                    logger.error(f"Failed to update section. Section result: {section_result}")
-                    return {
-                        "error": "Failed to update section with file ID",
-                        "file_id": file_data['file_id']
-                    }
-            else:
-                logger.error(f"Failed to insert file document for file_id: {file_data['file_id']}")
-                return {
-                    "error": "Failed to insert file document",
-                    "file_id": file_data['file_id']
-                }
-        except Exception as e:
-            logger.exception(f"Error processing file upload: {str(e)}")
-            return {
-                "error": f"Error processing file upload: {str(e)}",
-                "file_id": file_data['file_id']
-            }
+
+
+    @staticmethod
+    def persist_uploads(documents, workflow_id, node_id, section_id):
+        # metadata of files already on disk: one insert_many, then one $push of every inserted id
+        if not documents:
+            return []
+
+        failed = {}
+        try:
+            db.files.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed[documents[error['index']]['file_id']] = error.get('errmsg', 'Write failed')
+            logger.error(f"Failed to insert {len(failed)} file documents")
+
+        inserted_ids = [document['file_id'] for document in documents if document['file_id'] not in failed]
+        section_result = Section.push_file_ids(workflow_id, node_id, section_id, inserted_ids) if inserted_ids else None
+
+        if inserted_ids and not (section_result and section_result.modified_count > 0):
+            logger.error(f"Failed to update section. Section result: {section_result}")
+            db.files.delete_many({"_id": {"$in": [document['_id'] for document in documents if document['file_id'] in inserted_ids]}})
+            for file_id in inserted_ids:
+                failed[file_id] = "Failed to update section with file ID"
+
+        # documents that were not stored give their blob reference back
+        BlobStore.release([document['path'] for document in documents if document['file_id'] in failed])
+
+        return [
+            {"error": failed[document['file_id']], "file_id": document['file_id']}
+            if document['file_id'] in failed else
+            {"message": "File uploaded successfully", "file_id": document['file_id']}
+            for document in documents
+        ]
 
 
 
@@ -897,127 +1601,567 @@ class File:
 
 
     @staticmethod
-    # TODO: if the path is not locating accurately, remove is won't happen, solve that later
-    def remove_files_for_section(section_id: str):
-        try:
-            # Find all files associated with the section
-            files = db.files.find({"section_id": section_id})
-            
-            print(SERVER_DIR)
-            for file in files:
-                # Remove the file from the filesystem
-                file_path = os.path.join(f'{SERVER_DIR}/files', file['path'])
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    print(f"Deleted file: {file_path}")
-                else:
-                    print(f"File not found on filesystem: {file_path}")
+    def paths_for(file_ids, session=None):
+        # one entry per document, each of them holds a blob reference
+        return [file['path'] for file in db.files.find({"file_id": {"$in": file_ids}}, {"_id": 0, "path": 1}, session=session)]
 
-            # Remove all file documents associated with the section from the database
-            result = db.files.delete_many({"section_id": section_id})
-            print(f"Removed {result.deleted_count} file documents from the database")
 
-            return result.deleted_count
-        except Exception as e:
-            print(f"Error removing files for section {section_id}: {str(e)}")
-            return 0
 
+    @staticmethod
+    def unlink_paths(paths):
+        BlobStore.release(paths)
+        # files/ paths from before the blob store: one can still be used by another document
+        # (same file name uploaded twice), keep those
+        paths = list({path for path in paths if not BlobStore.is_blob_path(path)})
+        still_used = set(db.files.distinct("path", {"path": {"$in": paths}})) if paths else set()
+        for path in paths:
+            if path in still_used:
+                continue
+            absolute_path = os.path.join(SERVER_DIR, path)
+            try:
+                os.remove(absolute_path)
+            except FileNotFoundError:
+                logger.warning(f"File not found on filesystem: {absolute_path}")
 
 
 
 
-class HandleWorkflow:
+
+
+class FileGarbageCollector:
+    # reconciles db.files, sections.file_ids and the files/, images/ and blobs/ folders:
+    # - file documents no section refers to
+    # - files on disk no document refers to
+    # anything younger than GRACE_SECONDS is left alone, uploads write the disk before the database;
+    # files/.partial belongs to resumable uploads, UploadSession.expire() cleans it up instead, and
+    # blobs/.tmp holds blobs being written, only its files untouched for GRACE_SECONDS are removed
+    GRACE_SECONDS = 3600
+    BATCH_SIZE = 100
+    BATCH_PAUSE = 0.5
+    FOLDERS = ['files', 'images', BlobStore.PREFIX]
+
+    _thread = None
 
 
     @staticmethod
-    def process_changes(changes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        results = []
-        workflow_ids = set()
+    def _normalize(path):
+        return path.lstrip('/') if path else path
 
-        for change in changes:
-            try:
-                if 'type' not in change or 'data' not in change:
-                    raise KeyError("Change must have 'type' and 'data' keys")
-                
-                if 'workflow_id' not in change['data']:
-                    raise KeyError("Change data must include workflow_id")
 
-                workflow_ids.add(change['data']['workflow_id'])
-                
-                result = HandleWorkflow.process_change(change['type'], change['data'])
-                results.append(result)
-            except KeyError as e:
-                logger.error(f"KeyError in change: {str(e)}")
-                results.append({"error": f"Invalid change format: {str(e)}", "type": change.get('type', 'unknown')})
-            except ValueError as e:
-                logger.error(f"ValueError in change: {str(e)}")
-                results.append({"error": str(e), "type": change.get('type', 'unknown')})
-            except Exception as e:
-                logger.error(f"Unexpected error processing change: {str(e)}")
-                results.append({"error": "An unexpected error occurred", "type": change.get('type', 'unknown')})
+    @staticmethod
+    def _referenced_image_paths():
+        paths = set()
+        for collection in [db.samples, db.samples_list, db.inventory]:
+            paths.update(collection.distinct("image_path"))
+            paths.update(collection.distinct("additional_image_paths"))
+        return {FileGarbageCollector._normalize(path) for path in paths if path}
 
-        # Check if all changes are for the same workflow
-        if len(workflow_ids) != 1:
-            error_message = "All changes must be for the same workflow"
-            logger.error(error_message)
-            results.append({"error": error_message, "type": "multiple_workflows"})
-            return results
 
-        # After processing all changes, update the workflow status
-        if results and all(result.get('success', False) for result in results):
-            workflow_id = list(workflow_ids)[0]  # Safe to use [0] as we've confirmed there's only one ID
-            Workflow.update_status(workflow_id, "saved")
+    @staticmethod
+    def scan():
+        cutoff = time.time() - FileGarbageCollector.GRACE_SECONDS
+        referenced_file_ids = set(db.sections.distinct("file_ids"))
+
+        orphan_documents = []
+        referenced_paths = set()
+        for file in db.files.find({}, {"_id": 0, "file_id": 1, "path": 1, "size": 1, "uploaded_at": 1}):
+            # documents from before uploaded_at existed count as old
+            if file['file_id'] not in referenced_file_ids and file.get('uploaded_at', 0) / 1000 < cutoff:
+                orphan_documents.append(file)
+            else:
+                referenced_paths.add(FileGarbageCollector._normalize(file.get('path')))
+        referenced_paths |= FileGarbageCollector._referenced_image_paths()
+
+        orphan_files = []
+        for folder in FileGarbageCollector.FOLDERS:
+            for root, folders, filenames in os.walk(os.path.join(SERVER_DIR, folder)):
+                folders[:] = [name for name in folders
+                              if os.path.join(root, name) not in (UploadSession.PARTIAL_FOLDER, BlobStore.TEMP_FOLDER)]
+                for filename in filenames:
+                    absolute_path = os.path.join(root, filename)
+                    relative_path = os.path.relpath(absolute_path, SERVER_DIR).replace(os.sep, '/')
+                    if relative_path in referenced_paths:
+                        continue
+                    stat = os.stat(absolute_path)
+                    if stat.st_mtime < cutoff:
+                        orphan_files.append({"path": relative_path, "size": stat.st_size})
 
-        return results
+        return {
+            "orphan_documents": orphan_documents,
+            "orphan_files": orphan_files,
+            "reclaimable_bytes": sum(file['size'] for file in orphan_files)
+        }
 
 
+    @staticmethod
+    def collect(dry_run=False):
+        report = FileGarbageCollector.scan()
+        summary = {
+            "orphan_documents": len(report['orphan_documents']),
+            "orphan_files": len(report['orphan_files']),
+            "reclaimable_bytes": report['reclaimable_bytes'],
+            "removed_documents": 0,
+            "removed_files": 0,
+            "expired_uploads": 0,
+            "removed_temporaries": 0,
+            "dry_run": dry_run
+        }
+        if dry_run:
+            return summary
+
+        summary['expired_uploads'] = UploadSession.expire()
+        summary['removed_temporaries'] = BlobStore.remove_stale_temporaries(FileGarbageCollector.GRACE_SECONDS)
+
+        batch_size = FileGarbageCollector.BATCH_SIZE
+        documents = report['orphan_documents']
+        for i in range(0, len(documents), batch_size):
+            file_ids = [file['file_id'] for file in documents[i:i + batch_size]]
+            summary['removed_documents'] += db.files.delete_many({"file_id": {"$in": file_ids}}).deleted_count
+            BlobStore.release([file['path'] for file in documents[i:i + batch_size]])
+            time.sleep(FileGarbageCollector.BATCH_PAUSE)
+
+        files = report['orphan_files']
+        cutoff = time.time() - FileGarbageCollector.GRACE_SECONDS
+        for i in range(0, len(files), batch_size):
+            for file in files[i:i + batch_size]:
+                if FileGarbageCollector._remove_orphan(file['path'], cutoff):
+                    summary['removed_files'] += 1
+            time.sleep(FileGarbageCollector.BATCH_PAUSE)
+
+        logger.warning(f"File garbage collection: {summary}")
+        return summary
+
 
     @staticmethod
-    def process_change(change_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    def _remove_orphan(path, cutoff):
+        # the scan may be minutes old: an upload can have deduplicated onto a blob since (adopt takes the
+        # reference first, then touches the file), so a blob only goes while its refcount is still zero
+        absolute_path = os.path.join(SERVER_DIR, path)
         try:
-            if change_type == 'create_workflow':
-                return HandleWorkflow._create_workflow(data)
-            elif change_type == 'confirm_workflow':
-                return HandleWorkflow._confirm_workflow(data)
-            elif change_type == 'remove_node':
-                return HandleWorkflow._remove_node(data)
-            elif change_type == 'add_node':
-                return HandleWorkflow._add_node(data)
-            elif change_type == 'add_section':
-                return HandleWorkflow._add_section(data)
-            elif change_type == 'remove_section':  # Add this new condition
-                return HandleWorkflow._remove_section(data)
-            elif change_type == 'update_node_status':
-                return HandleWorkflow._update_node_status(data)
-            elif change_type == 'update_lock_status':
-                return HandleWorkflow._update_lock_status(data)
-            else:
-                raise ValueError(f"Unknown change type: {change_type}")
-        except KeyError as e:
-            logger.error(f"Missing key in change data for type '{change_type}': {str(e)}")
-            return {"error": f"Missing data for {change_type}: {str(e)}", "type": change_type}
-        except Exception as e:
-            logger.error(f"Error processing change of type '{change_type}': {str(e)}")
-            return {"error": f"Error processing {change_type}: {str(e)}", "type": change_type}
+            if os.stat(absolute_path).st_mtime >= cutoff:
+                return False
+            if BlobStore.is_blob_path(path):
+                sha256 = BlobStore.hash_of(path)
+                if db.blobs.find_one({"_id": sha256}, {"_id": 1}) and \
+                        not db.blobs.delete_one({"_id": sha256, "refcount": {"$lte": 0}}).deleted_count:
+                    return False
+                if os.stat(absolute_path).st_mtime >= cutoff or db.blobs.find_one({"_id": sha256}, {"_id": 1}):
+                    return False
+            os.remove(absolute_path)
+            return True
+        except FileNotFoundError:
+            return False
+
 
+    @staticmethod
+    def start_background(interval):
+        if FileGarbageCollector._thread or not interval:
+            return
+
+        # every worker process starts the thread, only the holder of the "file_gc" lease collects; the lease
+        # outlasts two intervals and is renewed after each run, a dead holder is replaced within two intervals
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    if not Lease.acquire("file_gc", 2 * interval):
+                        continue
+                except Exception as e:
+                    logger.error(f"File garbage collection lease failed: {str(e)}")
+                    continue
+                try:
+                    FileGarbageCollector.collect()
+                except Exception as e:
+                    logger.error(f"File garbage collection failed: {str(e)}")
+                # same schedule: inventory movements a crashed writer left pending
+                try:
+                    InventoryLedger.reconcile()
+                except Exception as e:
+                    logger.error(f"Inventory reconciliation failed: {str(e)}")
+                try:
+                    Lease.acquire("file_gc", 2 * interval)
+                except Exception as e:
+                    logger.error(f"File garbage collection lease failed: {str(e)}")
+
+        FileGarbageCollector._thread = threading.Thread(target=run, name="file-gc", daemon=True)
+        FileGarbageCollector._thread.start()
+
+
+
+
+
+
+class UploadSession:
+    # resumable upload of one large workflow file: initiate -> PUT chunks by offset -> finalize
+    # chunks are written straight into a preallocated file under files/.partial/, the session
+    # document in db.upload_sessions records which byte ranges arrived (with their checksums)
+    # sessions without a chunk for EXPIRE_SECONDS are expired by expire() (run with the file garbage collector)
+    PARTIAL_FOLDER = os.path.join(SERVER_DIR, 'files', '.partial')
+    MAX_CHUNK_SIZE = 16 * 1024 * 1024
+    EXPIRE_SECONDS = 7 * 24 * 3600
 
 
+    @staticmethod
+    def _partial_path(upload_id):
+        return os.path.join(UploadSession.PARTIAL_FOLDER, upload_id)
 
 
     @staticmethod
-    def _confirm_workflow(data: Dict[str, Any]) -> Dict[str, Any]:
-        workflow_id = data['id']
-        Workflow.confirm_workflow(workflow_id)
+    def _merge(ranges):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+
+    @staticmethod
+    def _progress(session):
+        received = UploadSession._merge(session.get('received', []))
+        missing, position = [], 0
+        for start, end in received:
+            if start > position:
+                missing.append([position, start])
+            position = max(position, end)
+        if position < session['size']:
+            missing.append([position, session['size']])
         return {
-            "type": "confirm_workflow",
-            "id": workflow_id,
-            "status": "confirmed"
+            "upload_id": session['upload_id'],
+            "size": session['size'],
+            "received": received,
+            "missing": missing,
+            "complete": not missing
         }
 
 
+    @staticmethod
+    def _get(upload_id):
+        session = db.upload_sessions.find_one({"upload_id": upload_id, "status": "open"})
+        if not session:
+            raise ValueError(f"Upload {upload_id} not found or already finalized")
+        return session
+
+
+    @staticmethod
+    def initiate(workflow_id, node_id, section_id, file_data, filename):
+        if not File.allowed_file(filename):
+            raise ValueError("Invalid file type")
+        size = int(file_data['size'])
+        if size < 0:
+            raise ValueError("Invalid file size")
+
+        upload_id = uuid.uuid4().hex
+        os.makedirs(UploadSession.PARTIAL_FOLDER, exist_ok=True)
+        with open(UploadSession._partial_path(upload_id), 'wb') as output:
+            output.truncate(size)
+
+        db.upload_sessions.insert_one({
+            "upload_id": upload_id,
+            "workflow_id": workflow_id,
+            "node_id": node_id,
+            "section_id": section_id,
+            "file_data": file_data,
+            "filename": secure_filename(filename),
+            "size": size,
+            "received": [],
+            "checksums": [],
+            "status": "open",
+            "created_at": int(time.time() * 1000),
+            "updated_at": int(time.time() * 1000)
+        })
+        return {"upload_id": upload_id, "size": size, "max_chunk_size": UploadSession.MAX_CHUNK_SIZE}
+
+
+    @staticmethod
+    def write_chunk(upload_id, offset, stream, length, checksum=None):
+        session = UploadSession._get(upload_id)
+        if offset < 0 or length <= 0 or length > UploadSession.MAX_CHUNK_SIZE or offset + length > session['size']:
+            raise ValueError(f"Chunk {offset}+{length} is outside of the file or too large")
+
+        # buffered (at most MAX_CHUNK_SIZE) and only written once complete and verified,
+        # a bad chunk must not overwrite ranges that already arrived
+        sha256 = hashlib.sha256()
+        buffer = bytearray()
+        while len(buffer) < length:
+            chunk = stream.read(min(File.CHUNK_SIZE, length - len(buffer)))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            buffer.extend(chunk)
+
+        if len(buffer) != length:
+            raise ValueError(f"Chunk at {offset} is incomplete, got {len(buffer)} of {length} bytes")
+        if checksum and checksum.lower() != sha256.hexdigest():
+            # not recorded as received, the client sends the same range again
+            raise ValueError(f"Checksum mismatch for chunk at {offset}")
+
+        with open(UploadSession._partial_path(upload_id), 'r+b') as output:
+            output.seek(offset)
+            output.write(buffer)
+
+        session = db.upload_sessions.find_one_and_update(
+            {"upload_id": upload_id},
+            {
+                "$push": {
+                    "received": [offset, offset + length],
+                    "checksums": {"offset": offset, "length": length, "sha256": sha256.hexdigest()}
+                },
+                "$set": {"updated_at": int(time.time() * 1000)}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        return UploadSession._progress(session)
+
+
+    @staticmethod
+    def status(upload_id):
+        return UploadSession._progress(UploadSession._get(upload_id))
+
+
+    @staticmethod
+    def finalize(upload_id, checksum=None):
+        session = UploadSession._get(upload_id)
+        progress = UploadSession._progress(session)
+        if not progress['complete']:
+            raise ValueError(f"Upload {upload_id} is missing byte ranges {progress['missing']}")
+
+        # claimed while it runs, a concurrent finalize of the same upload gets "not found"
+        session = db.upload_sessions.find_one_and_update(
+            {"upload_id": upload_id, "status": "open"},
+            {"$set": {"status": "finalizing", "updated_at": int(time.time() * 1000)}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not session:
+            raise ValueError(f"Upload {upload_id} not found or already finalized")
+
+        try:
+            result = UploadSession._finalize(session, checksum)
+        except Exception:
+            db.upload_sessions.update_one({"upload_id": upload_id}, {"$set": {"status": "open"}})
+            raise
+
+        # a failed insert leaves the session open with its partial file, the client can finalize again
+        if "message" in result:
+            os.remove(UploadSession._partial_path(upload_id))
+        db.upload_sessions.update_one(
+            {"upload_id": upload_id},
+            {"$set": {"status": "finalized" if "message" in result else "open"}}
+        )
+        return result
+
 
     @staticmethod
-    def _create_workflow(data: Dict[str, Any]) -> Dict[str, Any]:
+    def _finalize(session, checksum):
+        partial_path = UploadSession._partial_path(session['upload_id'])
+        sha256 = hashlib.sha256()
+        with open(partial_path, 'rb') as source:
+            for chunk in iter(lambda: source.read(File.CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        if checksum and checksum.lower() != sha256.hexdigest():
+            raise ValueError("Checksum mismatch for the assembled file")
+
+        # from here on the same path as a regular upload; the blob store takes a link (or copy)
+        # of the partial file, which stays until the file document is stored
+        linked_path = f"{partial_path}.{uuid.uuid4().hex}"
+        try:
+            os.link(partial_path, linked_path)
+        except OSError:
+            shutil.copyfile(partial_path, linked_path)
+        _, _, path = BlobStore.adopt(linked_path, sha256.hexdigest(), session['size'])
+        file_data = session['file_data']
+        document = {
+            "file_id": file_data['file_id'],
+            "name": file_data['name'],
+            "type": file_data['type'],
+            "size": session['size'],
+            "path": path,
+            "sha256": sha256.hexdigest(),
+            "uploaded_at": int(time.time() * 1000)
+        }
+        result = File.persist_uploads([document], session['workflow_id'], session['node_id'], session['section_id'])[0]
+        if "message" in result:
+            Workflow.bump_version(session['workflow_id'], [session['node_id']])
+        return result
+
+
+    @staticmethod
+    def expire():
+        # sessions idle for EXPIRE_SECONDS (a finalize that died halfway included), and partial files no
+        # live session owns; sessions from before updated_at existed go by created_at
+        cutoff = int((time.time() - UploadSession.EXPIRE_SECONDS) * 1000)
+        expired = 0
+        query = {
+            "status": {"$in": ["open", "finalizing"]},
+            "$or": [
+                {"updated_at": {"$lt": cutoff}},
+                {"updated_at": {"$exists": False}, "created_at": {"$lt": cutoff}}
+            ]
+        }
+        for session in db.upload_sessions.find(query, {"upload_id": 1, "status": 1}):
+            claimed = db.upload_sessions.update_one(
+                {"_id": session['_id'], "status": session['status']},
+                {"$set": {"status": "expired"}}
+            )
+            if claimed.modified_count:
+                expired += 1
+                try:
+                    os.remove(UploadSession._partial_path(session['upload_id']))
+                except FileNotFoundError:
+                    pass
+
+        if os.path.isdir(UploadSession.PARTIAL_FOLDER):
+            grace_cutoff = time.time() - FileGarbageCollector.GRACE_SECONDS
+            names = os.listdir(UploadSession.PARTIAL_FOLDER)
+            active = {session['upload_id'] for session in db.upload_sessions.find(
+                {"upload_id": {"$in": [name.split('.')[0] for name in names]}, "status": {"$in": ["open", "finalizing"]}},
+                {"upload_id": 1}
+            )}
+            for name in names:
+                path = os.path.join(UploadSession.PARTIAL_FOLDER, name)
+                if name.split('.')[0] not in active and os.path.getmtime(path) < grace_cutoff:
+                    os.remove(path)
+        return expired
+
+
+
+
+
+
+class WorkflowCommit:
+    # one workflow_commit compiled against an in-memory copy of the workflow:
+    # state is read once (workflow, its nodes, sections of nodes losing sections), every change is
+    # validated and folded into the plan (repeated updates of a node coalesce), then written with
+    # at most one bulk_write per collection, inside a transaction when the server supports it
+    def __init__(self, workflow_id: str):
+        self.workflow_id = workflow_id
+        self.workflow = None
+        self.created = False
+        self.nodes = {}                 # node_id -> node document as it will be after the commit
+        self.new_node_ids = []
+        self.removed_node_ids = []
+        self.node_updates = {}          # node_id -> {"status": ..., "push": [...], "pull": [...]}
+        self.sections = {}              # str(_id) -> section document, loaded and new ones
+        self.new_section_ids = []
+        self.removed_section_ids = []
+        self.workflow_set = {}
+        self.workflow_push = []
+        self.workflow_pull = []
+        self.removed_file_ids = []
+
+
+    def load(self, changes: List[Dict[str, Any]]):
+        self.workflow = db.workflows.find_one({"workflow_id": self.workflow_id})
+        self.nodes = {node['node_id']: node for node in db.nodes.find({"workflow_id": self.workflow_id})}
+
+        removal_node_ids = [
+            change['data'].get('node_id') for change in changes
+            if change.get('type') in ['remove_node', 'remove_section']
+        ]
+        if removal_node_ids:
+            for section in db.sections.find({"node_id": {"$in": removal_node_ids}}):
+                self.sections[str(section['_id'])] = section
+
+
+    def _require_workflow(self, action: str, check_lock=True):
+        if not self.workflow:
+            raise ValueError(f"Workflow with id {self.workflow_id} not found")
+        if check_lock and self.workflow.get('is_locked'):
+            raise ValueError(f"Cannot {action}. Workflow {self.workflow_id} is locked.")
+
+
+    def _require_node(self, node_id: str):
+        node = self.nodes.get(node_id)
+        if not node:
+            raise ValueError(f"Node with id {node_id} not found in workflow {self.workflow_id}")
+        return node
+
+
+    def _node_update(self, node_id: str):
+        return self.node_updates.setdefault(node_id, {"push": [], "pull": []})
+
+
+    def set_workflow(self, **fields):
+        self.workflow.update(fields)
+        if not self.created:
+            self.workflow_set.update(fields)
+
+
+    def _add_node(self, node_data: Dict[str, Any]):
+        node = Node(
+            workflow_id=self.workflow_id,
+            node_id=node_data['node_id'],
+            label=node_data['label'],
+            status=node_data.get('status', 'Sleep')
+        )
+        document = node.document()
+        self.nodes[node.node_id] = document
+        self.new_node_ids.append(node.node_id)
+
+        if self.created:
+            self.workflow['node_ids'].append(node.node_id)
+        elif node.node_id in self.workflow_pull:
+            self.workflow_pull.remove(node.node_id)
+        else:
+            self.workflow_push.append(node.node_id)
+
+        for section_data in node_data.get('sections', []):
+            self._add_section(node.node_id, section_data)
+        return document
+
+
+    def _add_section(self, node_id: str, section_data: Dict[str, Any]):
+        section = Section(
+            section_id=section_data.get('section_id'),
+            node_id=node_id,
+            workflow_id=self.workflow_id,
+            label=section_data['label']
+        )
+        section_id = str(section._id)
+        self.sections[section_id] = section.document()
+        self.new_section_ids.append(section_id)
+
+        if node_id in self.new_node_ids:
+            self.nodes[node_id]['section_ids'].append(section_id)
+        else:
+            self._node_update(node_id)['push'].append(section_id)
+        return section_id
+
+
+    def _drop_section(self, section_id: str):
+        section = self.sections.pop(section_id, None)
+        if section_id in self.new_section_ids:
+            self.new_section_ids.remove(section_id)
+        else:
+            self.removed_section_ids.append(section_id)
+            if section:
+                self.removed_file_ids.extend(section.get('file_ids', []))
+        return section
+
+
+    # ------------------------------------------------ compile one change ------------------------------------------------
+
+    def compile(self, change_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        handlers = {
+            'create_workflow': self._create_workflow,
+            'confirm_workflow': self._confirm_workflow,
+            'remove_node': self._remove_node,
+            'add_node': self._add_node_change,
+            'add_section': self._add_section_change,
+            'remove_section': self._remove_section,
+            'update_node_status': self._update_node_status,
+            'update_lock_status': self._update_lock_status,
+        }
+        if change_type not in handlers:
+            raise ValueError(f"Unknown change type: {change_type}")
+        return handlers[change_type](data)
+
+
+    def _create_workflow(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        if self.workflow:
+            raise ValueError(f"Workflow with id {self.workflow_id} already exists")
+
         workflow = Workflow(
             name=data['name'], 
             workflow_id=data['workflow_id'], 
@@ -1027,39 +2171,18 @@ class HandleWorkflow:
             timestamp=data.get('timestamp'),  # Use provided timestamp if available
         )
         workflow.edges = data.get('edges', [])
-        
+        self.workflow = workflow.document()
+        self.created = True
+
         for node_data in data.get('nodes', []):
-            node = Node(
-                workflow_id=workflow.workflow_id,
-                node_id=node_data['node_id'],
-                label=node_data['label'],
-                status=node_data['status']
-            )
-            node.save()
-            workflow.node_ids.append(node.node_id)
-            
-            print(f"\nProcessing node: {node.label}")
-            for section_data in node_data.get('sections', []):
-                print(f"\nSection data: {section_data}")
-                section = Section(
-                    section_id=section_data.get('section_id'),
-                    node_id=node.node_id,
-                    workflow_id=workflow.workflow_id,
-                    label=section_data['label'],
-                )
-                section_result = section.save()
-                section_id = str(section_result.inserted_id)
-                Node.push_section(node.node_id, section_id)
-                print(f"Saved section: {section.label} with id: {section_id}")
+            self._add_node(node_data)
 
-        workflow.save()
-        print(f"\nWorkflow saved: {workflow.name} with id: {workflow.workflow_id}")
         return {
             "type": "create_workflow",
             "id": workflow.workflow_id,
             "name": workflow.name,
-            "node_ids": workflow.node_ids,
-            "edges": workflow.edges,
+            "node_ids": list(self.workflow["node_ids"]),
+            "edges": self.workflow['edges'],
             "status": workflow.status,
             "is_locked": workflow.is_locked,
             "owner": workflow.owner,  # Include owner in the return data
@@ -1067,193 +2190,121 @@ class HandleWorkflow:
         }
 
 
+    def _confirm_workflow(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        self._require_workflow("confirm workflow", check_lock=False)
+        self.set_workflow(status="confirmed")
+        return {
+            "type": "confirm_workflow",
+            "id": data['id'],
+            "status": "confirmed"
+        }
 
 
-    @staticmethod
-    def _update_lock_status(data: Dict[str, Any]) -> Dict[str, Any]:
-        workflow_id = data['workflow_id']
+    def _update_lock_status(self, data: Dict[str, Any]) -> Dict[str, Any]:
         is_locked = data['is_locked']
-        
-        result = Workflow.update_lock_status(workflow_id, is_locked)
-        
-        if result.modified_count == 0:
-            raise ValueError(f"Failed to update lock status for workflow with id {workflow_id}")
-        
+        self._require_workflow("update lock status", check_lock=False)
+
+        if self.workflow.get('is_locked') == is_locked:
+            raise ValueError(f"Failed to update lock status for workflow with id {self.workflow_id}")
+
+        self.set_workflow(is_locked=is_locked)
         return {
             "type": "update_lock_status",
-            "workflow_id": workflow_id,
+            "workflow_id": self.workflow_id,
             "is_locked": is_locked
         }
 
 
-
-
-    @staticmethod
-    def _add_node(data: Dict[str, Any]) -> Dict[str, Any]:
-        workflow_id = data['workflow_id']
-        workflow = db.workflows.find_one({"workflow_id": workflow_id})
-        
-        if workflow['is_locked']:
-            raise ValueError(f"Cannot add node. Workflow {workflow_id} is locked.")
-        
+    def _add_node_change(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        self._require_workflow("add node")
         node_data = data['node']
-        new_edges = data.get('edges', [])
-
-        node = Node(
-            workflow_id=workflow_id,
-            node_id=node_data['node_id'],
-            label=node_data['label'],
-            status=node_data.get('status', 'Sleep')
-        )
-        node.save()
-
-        Workflow.push_node(workflow_id, node.node_id)
-        Workflow.update_edges(workflow_id, new_edges)
-
-        for section_data in node_data.get('sections', []):
-            section = Section(
-                section_id=section_data['section_id'],
-                node_id=node.node_id,
-                workflow_id=node.workflow_id,
-                label=section_data['label']
-            )
-            section_result = section.save()
-            section_id = section_result.inserted_id
-            Node.push_section(node.node_id, str(section_id))
+        if node_data['node_id'] in self.nodes:
+            raise ValueError(f"Node with id {node_data['node_id']} already exists")
 
+        node = self._add_node(node_data)
+        self.set_workflow(edges=data.get('edges', []))
 
         return {
             "type": "add_node",
-            "node_id": node.node_id,
-            "label": node.label,
-            "status": node.status,
+            "node_id": node['node_id'],
+            "label": node['label'],
+            "status": node['status'],
             "sections": [{"label": section_data['label'], "id": section_data.get('section_id')} for section_data in node_data.get('sections', [])]
         }
 
 
-
-    @staticmethod
-    def _update_node_status(data: Dict[str, Any]) -> Dict[str, Any]:
-        workflow_id = data.get('workflow_id')
+    def _update_node_status(self, data: Dict[str, Any]) -> Dict[str, Any]:
         node_id = data.get('node_id')
         new_status = data.get('status')
         
-        if not all([workflow_id, node_id, new_status]):
+        if not all([node_id, new_status]):
             missing = [k for k in ['workflow_id', 'node_id', 'status'] if k not in data]
             raise KeyError(f"Missing required data for updating node status: {', '.join(missing)}")
         
-        node = db.nodes.find_one({"workflow_id": workflow_id, "node_id": node_id})
-        if not node:
-            raise ValueError(f"Node with id {node_id} not found in workflow {workflow_id}")
-        
+        node = self._require_node(node_id)
         old_status = node['status']
-        if old_status != new_status:
-            result = Node.update_status(node_id, new_status)
-            
-            if result.modified_count == 0:
-                raise ValueError(f"Failed to update status for node with id {node_id} in workflow {workflow_id}")
-            
-            return {
-                "type": "update_node_status",
-                "workflow_id": workflow_id,
-                "node_id": node_id,
-                "status": new_status,
-                "old_status": old_status,
-                "updated": True
-            }
-        else:
-            return {
-                "type": "update_node_status",
-                "workflow_id": workflow_id,
-                "node_id": node_id,
-                "status": new_status,
-                "old_status": old_status,
-                "updated": False
-            }
-
-
+        updated = old_status != new_status
+        if updated:
+            # last status of the commit wins, one write per node
+            node['status'] = new_status
+            if node_id not in self.new_node_ids:
+                self._node_update(node_id)['status'] = new_status
 
+        return {
+            "type": "update_node_status",
+            "workflow_id": self.workflow_id,
+            "node_id": node_id,
+            "status": new_status,
+            "old_status": old_status,
+            "updated": updated
+        }
 
 
-    @staticmethod
-    def _remove_node(data: Dict[str, Any]) -> Dict[str, Any]:
-        workflow_id = data['workflow_id']
-        workflow = db.workflows.find_one({"workflow_id": workflow_id})
-        
-        if workflow['is_locked']:
-            raise ValueError(f"Cannot remove node. Workflow {workflow_id} is locked.")
-        
+    def _remove_node(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        self._require_workflow("remove node")
         node_id = data['node_id']
-        new_edges = data.get('edges', [])
-        
-        print(f"Attempting to remove node {node_id} from workflow {workflow_id}")
-        
-        if not workflow:
-            raise ValueError(f"Workflow with id {workflow_id} not found")
-        
-        node = db.nodes.find_one({"node_id": node_id})
+        node = self.nodes.get(node_id)
         if not node:
             raise ValueError(f"Node with id {node_id} not found")
-        
-        section_ids = node.get('section_ids', [])
+
+        section_ids = list(node.get('section_ids', []))
         for section_id in section_ids:
-            db.sections.delete_one({"_id": ObjectId(section_id)})
-            print(f"Deleted section {section_id}")
-        
-        node_result = db.nodes.delete_one({"node_id": node_id})
-        print(f"Node deletion result: {node_result.deleted_count} document(s) deleted")
-        
-        workflow_result = Workflow.remove_node(workflow_id, node_id)
-        edge_result = Workflow.update_edges(workflow_id, new_edges)
-        print(f"Workflow update result: {workflow_result.modified_count} document(s) modified")
-        print(f"Edge update result: {edge_result.modified_count} document(s) modified")
-        
-        
+            self._drop_section(section_id)
+
+        del self.nodes[node_id]
+        self.node_updates.pop(node_id, None)
+        if node_id in self.new_node_ids:
+            self.new_node_ids.remove(node_id)
+            if node_id in self.workflow_push:
+                self.workflow_push.remove(node_id)
+        else:
+            self.removed_node_ids.append(node_id)
+            self.workflow_pull.append(node_id)
+        if self.created:
+            self.workflow['node_ids'].remove(node_id)
+
+        self.set_workflow(edges=data.get('edges', []))
+
         return {
             "type": "remove_node",
             "node_id": node_id,
-            "node_deleted": node_result.deleted_count,
-            "workflow_updated": workflow_result.modified_count,
-            "edges_updated": edge_result.modified_count,
+            "node_deleted": 1,
+            "workflow_updated": 1,
+            "edges_updated": 1,
             "sections_deleted": len(section_ids)
         }
 
 
-
-
-
-
-    @staticmethod
-    def _add_section(data: Dict[str, Any]) -> Dict[str, Any]:
-        workflow_id = data.get('workflow_id')
+    def _add_section_change(self, data: Dict[str, Any]) -> Dict[str, Any]:
         node_id = data.get('node_id')
         section_data = data.get('section')
 
-        if not all([workflow_id, node_id, section_data]):
+        if not all([node_id, section_data]):
             raise ValueError(f"Missing required data for adding section: {data}")
 
-        workflow = db.workflows.find_one({"workflow_id": workflow_id})
-        if not workflow:
-            raise ValueError(f"Workflow with id {workflow_id} not found")
-
-        if workflow.get('is_locked'):
-            raise ValueError(f"Cannot add section. Workflow {workflow_id} is locked.")
-
-        node = db.nodes.find_one({"node_id": node_id, "workflow_id": workflow_id})
-        if not node:
-            raise ValueError(f"Node with id {node_id} not found in workflow {workflow_id}")
-
-        section = Section(
-            section_id=section_data['section_id'],
-            node_id=node_id,
-            workflow_id=workflow_id,
-            label=section_data['label']
-        )
-        section_result = section.save()
-        section_id = str(section_result.inserted_id)
-        Node.push_section(node_id, section_id)
-
-        print(f"\nAdded new section: {section.label} with id: {section_id} to node: {node_id}")
+        self._require_workflow("add section")
+        self._require_node(node_id)
+        section_id = self._add_section(node_id, section_data)
 
         return {
             "type": "add_section",
@@ -1264,58 +2315,187 @@ class HandleWorkflow:
         }
 
 
-
-
-    @staticmethod
-    def _remove_section(data: Dict[str, Any]) -> Dict[str, Any]:
-        workflow_id = data.get('workflow_id')
+    def _remove_section(self, data: Dict[str, Any]) -> Dict[str, Any]:
         node_id = data.get('node_id')
         section_id = data.get('section_id')
 
-        if not all([workflow_id, node_id, section_id]):
+        if not all([node_id, section_id]):
             raise ValueError(f"Missing required data for removing section: {data}")
 
-        workflow = db.workflows.find_one({"workflow_id": workflow_id})
-        if not workflow:
-            raise ValueError(f"Workflow with id {workflow_id} not found")
-
-        if workflow.get('is_locked'):
-            raise ValueError(f"Cannot remove section. Workflow {workflow_id} is locked.")
-
-        node = db.nodes.find_one({"node_id": node_id, "workflow_id": workflow_id})
-        if not node:
-            raise ValueError(f"Node with id {node_id} not found in workflow {workflow_id}")
-
-        # Remove associated files
-        files_removed = File.remove_files_for_section(section_id)
+        self._require_workflow("remove section")
+        node = self._require_node(node_id)
 
-        # Remove the section from the sections collection
-        section_result = db.sections.delete_one({"section_id": section_id, "node_id": node_id, "workflow_id": workflow_id})
-
-        # Remove the section_id from the node's section_ids array
-        node_result = db.nodes.update_one(
-            {"node_id": node_id},
-            {"$pull": {"section_ids": section_id}}
-        )
-
-        if section_result.deleted_count == 0:
+        matches = [key for key, section in self.sections.items()
+                   if section.get('section_id') == section_id and section.get('node_id') == node_id]
+        if not matches:
             raise ValueError(f"Section with id {section_id} not found or already removed")
 
-        print(f"\nRemoved section with id: {section_id} from node: {node_id}")
+        file_count = len(self.removed_file_ids)
+        for key in matches:
+            self._drop_section(key)
+            if key in node.get('section_ids', []):
+                node['section_ids'].remove(key)
+            if node_id not in self.new_node_ids:
+                update = self._node_update(node_id)
+                if key in update['push']:
+                    update['push'].remove(key)
+                else:
+                    update['pull'].append(key)
 
         return {
             "type": "remove_section",
-            "workflow_id": workflow_id,
+            "workflow_id": self.workflow_id,
             "node_id": node_id,
             "section_id": section_id,
-            "section_deleted": section_result.deleted_count,
-            "node_updated": node_result.modified_count,
-            "files_removed": files_removed
+            "section_deleted": len(matches),
+            "node_updated": 1,
+            "files_removed": len(self.removed_file_ids) - file_count
         }
 
 
+    # ------------------------------------------------ write the plan ------------------------------------------------
+
+    def _workflow_operations(self):
+        if self.created:
+            return [InsertOne(self.workflow)]
+
+        operations = []
+        query = {"workflow_id": self.workflow_id}
+        # $pull and $push on the same array cannot share one update document
+        if self.workflow_pull:
+            operations.append(UpdateOne(query, {"$pull": {"node_ids": {"$in": self.workflow_pull}}}))
+        update = {}
+        if self.workflow_push:
+            update["$push"] = {"node_ids": {"$each": self.workflow_push}}
+        if self.workflow_set:
+            update["$set"] = self.workflow_set
+        if update:
+            operations.append(UpdateOne(query, update))
+        return operations
+
+
+    def _node_operations(self):
+        operations = [InsertOne(self.nodes[node_id]) for node_id in self.new_node_ids]
+        if self.removed_node_ids:
+            operations.append(DeleteMany({"node_id": {"$in": self.removed_node_ids}}))
+
+        for node_id, update in self.node_updates.items():
+            query = {"node_id": node_id}
+            if update['pull']:
+                operations.append(UpdateOne(query, {"$pull": {"section_ids": {"$in": update['pull']}}}))
+            document = {}
+            if update['push']:
+                document["$push"] = {"section_ids": {"$each": update['push']}}
+            if 'status' in update:
+                document["$set"] = {"status": update['status']}
+            if document:
+                operations.append(UpdateOne(query, document))
+        return operations
+
+
+    def _section_operations(self):
+        operations = [InsertOne(self.sections[section_id]) for section_id in self.new_section_ids]
+        if self.removed_section_ids:
+            operations.append(DeleteMany({"_id": {"$in": [ObjectId(section_id) for section_id in self.removed_section_ids]}}))
+        return operations
+
+
+    def execute(self, touched_node_ids: List[str]):
+        removed_paths = []
+
+        def write(session):
+            # cascade: files of every removed section go with it
+            if self.removed_file_ids:
+                removed_paths[:] = File.paths_for(self.removed_file_ids, session=session)
+                db.files.delete_many({"file_id": {"$in": self.removed_file_ids}}, session=session)
+            for collection, operations in [
+                (db.workflows, self._workflow_operations()),
+                (db.nodes, self._node_operations()),
+                (db.sections, self._section_operations()),
+            ]:
+                if operations:
+                    collection.bulk_write(operations, ordered=True, session=session)
+            Workflow.bump_version(self.workflow_id, touched_node_ids, session=session)
+
+        with client.start_session() as session:
+            if supports_transactions():
+                session.with_transaction(write)
+            else:
+                write(None)
+
+        # the disk is not part of the transaction, so files are removed only once the commit went through
+        File.unlink_paths(removed_paths)
+
 
 
 
 
 
+class HandleWorkflow:
+
+
+    @staticmethod
+    def process_changes(changes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        results = []
+        workflow_ids = set()
+
+        for change in changes:
+            if isinstance(change.get('data'), dict) and 'workflow_id' in change['data']:
+                workflow_ids.add(change['data']['workflow_id'])
+
+        # Check if all changes are for the same workflow, nothing is written otherwise
+        if len(workflow_ids) > 1:
+            error_message = "All changes must be for the same workflow"
+            logger.error(error_message)
+            return [{"error": error_message, "type": "multiple_workflows"}]
+
+        commit = WorkflowCommit(next(iter(workflow_ids), None))
+        if workflow_ids:
+            commit.load(changes)
+
+        for change in changes:
+            try:
+                if 'type' not in change or 'data' not in change:
+                    raise KeyError("Change must have 'type' and 'data' keys")
+                
+                if 'workflow_id' not in change['data']:
+                    raise KeyError("Change data must include workflow_id")
+
+                result = commit.compile(change['type'], change['data'])
+                results.append(result)
+            except KeyError as e:
+                logger.error(f"KeyError in change: {str(e)}")
+                results.append({"error": f"Invalid change format: {str(e)}", "type": change.get('type', 'unknown')})
+            except ValueError as e:
+                logger.error(f"ValueError in change: {str(e)}")
+                results.append({"error": str(e), "type": change.get('type', 'unknown')})
+            except Exception as e:
+                logger.error(f"Unexpected error processing change: {str(e)}")
+                results.append({"error": "An unexpected error occurred", "type": change.get('type', 'unknown')})
+
+        if not workflow_ids or all("error" in result for result in results):
+            return results
+
+        # After compiling all changes, mark the workflow saved
+        if results and all(result.get('success', False) for result in results):
+            commit.set_workflow(status="saved")
+
+        try:
+            commit.execute(HandleWorkflow._touched_node_ids(changes))
+        except PyMongoError as e:
+            logger.error(f"Workflow commit failed for {commit.workflow_id}: {str(e)}")
+            return [{"error": f"Commit failed: {str(e)}", "type": change.get('type', 'unknown')} for change in changes]
+
+        return results
+
+
+
+    @staticmethod
+    def _touched_node_ids(changes: List[Dict[str, Any]]) -> List[str]:
+        node_ids = []
+        for change in changes:
+            data = change.get('data', {})
+            node_ids.append(data.get('node_id'))
+            node_ids.append(data.get('node', {}).get('node_id'))
+            node_ids.extend(node.get('node_id') for node in data.get('nodes', []))
+        return [node_id for node_id in node_ids if node_id]
@@ -1,8 +1,10 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify
+from app.fileserve import send_cached_file
+from app.storage import BlobStore
 import os
 import json
 from app.logger import logger
-from app.upload.models import Item, ItemBatch, Workflow, File, HandleWorkflow 
+from app.upload.models import Item, ItemBatch, Workflow, File, HandleWorkflow, InventoryLedger, UploadSession
 # create Blueprint object, which is this file
 upload_bp = Blueprint('upload', __name__)
 # the folder for saving the uploaded sample image
@@ -84,6 +86,23 @@ def upload_data():
 
 
 
+@upload_bp.route('/api/validate_references', methods=['POST'])
+def validate_references():
+    try:
+        rows = request.json.get('rows')
+        if not isinstance(rows, list):
+            return jsonify({"error": "Invalid data format, expected a list of rows"}), 400
+
+        result = Item.validate_reference_batch(rows)
+        return jsonify(result), 200
+    except Exception as e:
+        logger.error(f"Error validating references: {str(e)}")
+        return jsonify({"error": "An unexpected error occurred while validating references"}), 500
+
+
+
+
+
 @upload_bp.route('/api/upload_sample', methods=['POST'])
 def upload_sample():
     try:
@@ -111,11 +130,62 @@ def upload_sample():
 
 
 
+@upload_bp.route('/api/inventory_history', methods=['GET'])
+def inventory_history():
+    collection_name = request.args.get('collection')
+    identifier = request.args.get('identifier')  # not set for the samples collection
+    reference_no = request.args.get('reference_no')
+    before = request.args.get('before')
+    limit = request.args.get('limit', type=int)
+
+    if collection_name not in ['samples', 'samples_list', 'inventory'] or not reference_no:
+        return jsonify({"error": "Valid collection and reference number are required"}), 400
+
+    try:
+        history = InventoryLedger.history(collection_name, identifier, reference_no, before, limit)
+        return jsonify(history), 200
+    except Exception as e:
+        logger.error(f"Error fetching inventory history for {reference_no}: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+
+@upload_bp.route('/api/update_inventory', methods=['POST'])
+def update_inventory():
+    # put-in / take-out of rows of a samples_list / inventory set, applied atomically with $inc:
+    # [{"reference_no", "putIn", "takeOut", "by"}, ...]
+    changes = request.json
+    mode = request.args.get('mode', 'normal')
+    identifier = request.args.get('identifier')
+
+    if not identifier or not isinstance(changes, list) or not all(change.get('reference_no') for change in changes):
+        return jsonify({"error": "Identifier and a list of changes with reference numbers are required"}), 400
+
+    try:
+        batch = ItemBatch([], mode=mode, identifier=identifier)
+        if len(changes) == 1:
+            change = changes[0]
+            result = batch.update_inventory(change['reference_no'], change.get('putIn', 0), change.get('takeOut', 0), change.get('by', "User"))
+            return jsonify({"results": [{"reference_no": result['reference_no'], "total_inventory": result['total_inventory']}]}), 200
+        return jsonify({"results": batch.update_inventories(changes)}), 200
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.exception(f"Error updating inventory of {identifier}: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+
 @upload_bp.route('/api/fetch_identifiers', methods=['GET'])
 def fetch_identifiers():
     mode = request.args.get('mode')  # No default provided
-    identifiers = ItemBatch.get_identifiers(mode)
-    return jsonify({"identifiers": identifiers})
+    page = request.args.get('page', type=int)  # paginated only when a page is given
+    page_size = request.args.get('page_size', type=int)
+    with_stats = request.args.get('stats') == '1'
+    identifiers, total = ItemBatch.get_identifiers(mode, page, page_size, with_stats)
+    return jsonify({"identifiers": identifiers, "total": total})
 
 
 
@@ -123,11 +193,12 @@ def fetch_identifiers():
 def create_identifier():
     mode = request.args.get('mode', 'normal')
     name = request.json.get('name')
+    owner = request.json.get('owner')
     
     if not name:
         return jsonify({"error": "Name is required"}), 400
     
-    new_identifier = ItemBatch.create_identifier(mode, name)
+    new_identifier = ItemBatch.create_identifier(mode, name, owner)
     return jsonify({"identifier": new_identifier})
 
 
@@ -177,6 +248,7 @@ def commit_changes():
 @upload_bp.route('/api/fetch_all_workflow', methods=['GET'])
 def get_workflow():
     workflow_id = request.args.get('workflow_id')
+    since_version = request.args.get('since_version', type=int)  # only nodes changed after this version
     logger.info(f"Requested workflow_id: {workflow_id}")
     
     if not workflow_id:
@@ -184,7 +256,7 @@ def get_workflow():
         return jsonify({"error": "Workflow ID must be provided"}), 400
 
     try:
-        workflow = Workflow.get_workflow_by_id(workflow_id)
+        workflow = Workflow.get_workflow_by_id(workflow_id, since_version)
         if workflow:
             logger.info(f"Successfully fetched workflow: {workflow_id}")
             logger.debug(f"Workflow data: {workflow}")
@@ -234,7 +306,7 @@ def upload_files():
     if len(files) != len(file_data_array):
         return jsonify({"error": "Mismatch between files and file data"}), 400
 
-    results = File.process_multiple_uploads(files, file_data_array, workflow_id, node_id, section_id, FILE_FOLDER)
+    results = File.process_multiple_uploads(files, file_data_array, workflow_id, node_id, section_id)
 
     successful_uploads = [r for r in results if "message" in r]
     failed_uploads = [r for r in results if "error" in r]
@@ -254,6 +326,72 @@ def upload_files():
 
 
 
+# resumable upload for large files: POST to start, PUT raw chunks with ?offset=, GET for the
+# received / missing byte ranges, POST .../finalize once everything arrived
+@upload_bp.route('/api/upload_session', methods=['POST'])
+def initiate_upload():
+    data = request.json or {}
+    try:
+        session = UploadSession.initiate(
+            data['workflow_id'], data['node_id'], data['section_id'],
+            data['file_data'], data.get('filename') or data['file_data']['name']
+        )
+        return jsonify(session), 201
+    except KeyError as e:
+        return jsonify({"error": f"Missing data: {str(e)}"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error starting upload: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+
+@upload_bp.route('/api/upload_session/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    if offset is None or not length:
+        return jsonify({"error": "Offset and a non-empty body are required"}), 400
+
+    try:
+        # read from the raw stream, the chunk is never spooled by werkzeug
+        progress = UploadSession.write_chunk(upload_id, offset, request.stream, length, request.headers.get('X-Chunk-SHA256'))
+        return jsonify(progress), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error writing chunk for upload {upload_id}: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+
+@upload_bp.route('/api/upload_session/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    try:
+        return jsonify(UploadSession.status(upload_id)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+
+
+
+@upload_bp.route('/api/upload_session/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    try:
+        checksum = (request.get_json(silent=True) or {}).get('sha256')
+        result = UploadSession.finalize(upload_id, checksum)
+        status_code = 200 if "message" in result else 500
+        return jsonify(result), status_code
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error finalizing upload {upload_id}: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+
+
+
 @upload_bp.route('/api/download_file/<workflow_id>/<node_id>/<section_id>/<file_id>', methods=['GET'])
 def download_file(workflow_id, node_id, section_id, file_id):
     file_info, error = File.get_file_for_download(workflow_id, node_id, section_id, file_id)
@@ -267,7 +405,13 @@ def download_file(workflow_id, node_id, section_id, file_id):
     logger.info(f"Attempting to send file: {absolute_path}")
     
     try:
-        return send_file(absolute_path, as_attachment=True, download_name=file_info['name'])
+        return send_cached_file(
+            absolute_path,
+            content_hash=file_info.get('sha256'),
+            immutable=BlobStore.is_blob_path(os.path.relpath(absolute_path, SERVER_DIR)),
+            as_attachment=True,
+            download_name=file_info['name']
+        )
     except Exception as e:
         logger.error(f"Error sending file: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
@@ -0,0 +1,26 @@
+from pymongo import ReturnDocument
+from app.database import db
+
+
+# per collection write counters in db.collection_versions {_id: collection name, version}
+# every write path bumps the collection it wrote to once the write is done, caches of query
+# results key their entries by the current version, a bump makes every older entry unreachable.
+# get() is deliberately not cached in the process: every cache lookup pays one _id lookup here, so a
+# write made by another worker is seen by the very next read (utils/bench_search_cache.py measures it)
+class CollectionVersion:
+    @staticmethod
+    def get(collection_name):
+        document = db.collection_versions.find_one({"_id": collection_name})
+        return document['version'] if document else 0
+
+
+    @staticmethod
+    def bump(collection_name, session=None):
+        document = db.collection_versions.find_one_and_update(
+            {"_id": collection_name},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        return document['version']
@@ -0,0 +1,152 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import app.upload.models as models
+from app.upload.models import ItemBatch, InventoryLedger
+
+# run from the server/ directory:
+# >> python -m pytest tests        (or python -m unittest discover tests)
+# the ledger protocol runs in memory on mongomock, one thread at a time (mongomock is not thread safe);
+# concurrent writers are checked against a real mongod on localhost and skipped when there is none
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def mongod_available():
+    try:
+        MongoClient('localhost', 27017, serverSelectionTimeoutMS=500).admin.command('ping')
+        return True
+    except PyMongoError:
+        return False
+
+
+@unittest.skipIf(mongomock is None, "needs mongomock")
+class InventoryLedgerTest(unittest.TestCase):
+    # standalone deployment: no transactions, the ledger is written first
+    def setUp(self):
+        self.db = mongomock.MongoClient().flask_database
+        self.patched = [(module, module.db) for name, module in list(sys.modules.items())
+                        if name.startswith('app') and hasattr(module, 'db')]
+        for module, _ in self.patched:
+            module.db = self.db
+        self.supports_transactions = models.supports_transactions
+        models.supports_transactions = lambda: False
+
+        self.db.inventory.insert_many([
+            {"identifier": "INV_T", "reference_no": "A1", "total_inventory": 5},
+            {"identifier": "INV_T", "reference_no": "A2", "total_inventory": 0},
+        ])
+        self.batch = ItemBatch([], mode='inventory', identifier='INV_T')
+
+    def tearDown(self):
+        for module, db in self.patched:
+            module.db = db
+        models.supports_transactions = self.supports_transactions
+
+    def total(self, reference_no):
+        return self.db.inventory.find_one({"reference_no": reference_no})['total_inventory']
+
+    def ledger_total(self, reference_no):
+        return sum(bucket['put_in'] - bucket['take_out']
+                   for bucket in self.db.inventory_movements.find({"reference_no": reference_no}))
+
+    def test_update_inventory(self):
+        result = self.batch.update_inventory("A1", 3, 1)
+        self.assertEqual(result['total_inventory'], 7)
+        self.assertEqual(self.ledger_total("A1"), 2)
+        self.assertFalse(self.db.inventory_movements.find_one({"movements.pending": {"$exists": True}}))
+
+    def test_update_inventory_unknown_item(self):
+        with self.assertRaises(LookupError):
+            self.batch.update_inventory("MISSING", 1, 0)
+        self.assertEqual(self.ledger_total("MISSING"), 0)
+
+    def test_update_inventories_one_result_per_change(self):
+        results = self.batch.update_inventories([
+            {"reference_no": "A1", "putIn": 2},
+            {"reference_no": "MISSING", "putIn": 1},
+            {"reference_no": "A1", "takeOut": 4},
+            {"reference_no": "A2", "putIn": 1},
+        ])
+        self.assertEqual(results, [
+            {"reference_no": "A1", "total_inventory": 7},
+            {"reference_no": "MISSING", "error": "Item not found"},
+            {"reference_no": "A1", "total_inventory": 3},
+            {"reference_no": "A2", "total_inventory": 1},
+        ])
+        self.assertEqual(self.ledger_total("A1"), -2)
+        self.assertEqual(self.ledger_total("A2"), 1)
+
+    def test_save_items_folds_movements_into_the_rows(self):
+        entry = {"putIn": 4, "takeOut": 0, "by": "u", "timestamp": 1700000000000}
+        ItemBatch([{"reference_no": "B1", "inventory": [entry]}], mode='inventory', identifier='INV_S').save_items()
+        self.assertEqual(self.total("B1"), 4)
+
+        # the UI sends back the list it loaded with one entry appended, and a put-in of its own
+        appended = {"putIn": 0, "takeOut": 1, "by": "u", "timestamp": 1700000001000}
+        result = ItemBatch([{"reference_no": "B1", "inventory": [entry, appended], "newPutIn": 2}],
+                           mode='inventory', identifier='INV_S').save_items()
+        self.assertEqual(result['results'][0]['status'], "inventory_updated")
+        self.assertEqual(self.total("B1"), 5)
+        self.assertEqual(self.ledger_total("B1"), 5)
+        self.assertFalse(self.db.inventory_movements.find_one({"movements.pending": {"$exists": True}}))
+
+    def test_reconcile_settles_movements_of_an_inserted_row(self):
+        movement = InventoryLedger.mark_pending([InventoryLedger.movement(5, 0)], with_item=True)
+        InventoryLedger.write(InventoryLedger.record_operations('inventory', 'INV_T', 'A1', movement))
+
+        self.assertEqual(InventoryLedger.reconcile(older_than=-1), {"applied": 0, "settled": 1, "discarded": 0})
+        self.assertEqual(self.total("A1"), 5)
+
+    def test_reconcile_applies_a_movement_once(self):
+        # crashed after the ledger write: the item never got the $inc
+        movement = InventoryLedger.mark_pending([InventoryLedger.movement(10, 0)])
+        InventoryLedger.write(InventoryLedger.record_operations('inventory', 'INV_T', 'A1', movement))
+        self.assertEqual(InventoryLedger.history('inventory', 'INV_T', 'A1')['movements'], [])
+
+        self.assertEqual(InventoryLedger.reconcile(older_than=-1)['applied'], 1)
+        self.assertEqual(InventoryLedger.reconcile(older_than=-1), {"applied": 0, "settled": 0, "discarded": 0})
+        self.assertEqual(self.total("A1"), 15)
+        self.assertEqual(len(InventoryLedger.history('inventory', 'INV_T', 'A1')['movements']), 1)
+
+    def test_reconcile_settles_an_applied_movement(self):
+        # crashed after the item write, before the movement was settled
+        movement = InventoryLedger.mark_pending([InventoryLedger.movement(0, 4)])
+        InventoryLedger.write(InventoryLedger.record_operations('inventory', 'INV_T', 'A1', movement))
+        self.db.inventory.update_one({"reference_no": "A1"}, InventoryLedger.item_operation(movement))
+
+        self.assertEqual(InventoryLedger.reconcile(older_than=-1), {"applied": 0, "settled": 1, "discarded": 0})
+        self.assertEqual(self.total("A1"), 1)
+
+    def test_reconcile_discards_movements_of_missing_items(self):
+        movement = InventoryLedger.mark_pending([InventoryLedger.movement(2, 0)])
+        InventoryLedger.write(InventoryLedger.record_operations('inventory', 'INV_T', 'GONE', movement))
+
+        self.assertEqual(InventoryLedger.reconcile(older_than=-1)['discarded'], 1)
+        self.assertEqual(self.ledger_total("GONE"), 0)
+
+    def test_reconcile_leaves_recent_movements_alone(self):
+        movement = InventoryLedger.mark_pending([InventoryLedger.movement(1, 0)])
+        InventoryLedger.write(InventoryLedger.record_operations('inventory', 'INV_T', 'A1', movement))
+        self.assertEqual(InventoryLedger.reconcile(), {"applied": 0, "settled": 0, "discarded": 0})
+
+
+@unittest.skipUnless(mongod_available(), "needs a mongod on localhost:27017")
+class ConcurrentInventoryTest(unittest.TestCase):
+    def test_no_lost_updates(self):
+        from utils.stress_inventory import run
+        failed, report = run(threads=8, rounds=50)
+        self.assertFalse(failed, "\n".join(report))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import sys
+import os
+import shutil
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+import app.search.routes as search_routes
+from app.search.routes import search_bp
+from app.storage import BlobStore
+from app.thumbnails import Thumbnail
+
+# usage (from the server/ directory, no database needed):
+# >> python utils/bench_image_cache.py [images] [visits]
+# a search page showing `images` sample images is opened `visits` times by one browser; bytes over the wire for
+# - baseline:  no validators, every visit downloads every image again (the behaviour before ETag / Cache-Control)
+# - images/:   legacy paths, revalidated on every visit (If-None-Match -> 304), a worst case for max-age=300
+# - blobs/:    content addressed paths, immutable: after the first visit the browser does not ask again
+# - thumbnail: ?w=200&fmt=webp of the blob paths, as search results link them (needs Pillow)
+# plus one Range request to show partial transfers; synthetic images are written to a temporary folder
+
+IMAGES = 24
+VISITS = 5
+WIDTH, HEIGHT = 1600, 1200
+
+
+def make_images(folder, count):
+    os.makedirs(folder, exist_ok=True)
+    names = []
+    for i in range(count):
+        name = f"sample_{i}.jpg"
+        path = os.path.join(folder, name)
+        try:
+            from PIL import Image
+            # noise does not compress, close to the size of real photos
+            Image.frombytes('RGB', (WIDTH, HEIGHT), os.urandom(WIDTH * HEIGHT * 3)).save(path, 'JPEG', quality=85)
+        except ImportError:
+            with open(path, 'wb') as output:
+                output.write(b'\xff\xd8\xff' + os.urandom(400 * 1024))
+        names.append(name)
+    return names
+
+
+def wire_bytes(response):
+    # status line and headers as sent, plus the body
+    headers = sum(len(name) + len(value) + 4 for name, value in response.headers.items())
+    return headers + 17 + len(response.get_data())
+
+
+def browse(client, urls, visits, immutable):
+    # a browser cache keyed by url: ETag from the last full response
+    etags = {}
+    total, statuses = 0, {}
+    for visit in range(visits):
+        for url in urls:
+            if immutable and url in etags:
+                continue
+            headers = {"If-None-Match": etags[url]} if url in etags else {}
+            response = client.get(url, headers=headers)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.headers.get('ETag'):
+                etags[url] = response.headers['ETag']
+            total += wire_bytes(response)
+    return total, statuses
+
+
+def main(count, visits):
+    workspace = tempfile.mkdtemp(prefix="bench_image_cache_")
+    try:
+        search_routes.IMAGE_FOLDER = os.path.join(workspace, 'images')
+        BlobStore.FOLDER = os.path.join(workspace, BlobStore.PREFIX)
+        Thumbnail.FOLDER = os.path.join(workspace, 'thumbnails')
+
+        names = make_images(search_routes.IMAGE_FOLDER, count)
+        blob_names = []
+        for name in names:
+            with open(os.path.join(search_routes.IMAGE_FOLDER, name), 'rb') as source:
+                sha256 = hashlib.sha256(source.read()).hexdigest()
+            target = os.path.join(BlobStore.FOLDER, sha256[:2], sha256[2:4], sha256)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(search_routes.IMAGE_FOLDER, name), target)
+            blob_names.append(f"{sha256[:2]}/{sha256[2:4]}/{sha256}")
+
+        app = Flask(__name__)
+        app.register_blueprint(search_bp, url_prefix='/search')
+        client = app.test_client()
+
+        image_urls = [f"/search/api/images/{name}" for name in names]
+        blob_urls = [f"/search/api/blobs/{name}" for name in blob_names]
+        full = sum(wire_bytes(client.get(url)) for url in image_urls)
+        runs = [("baseline", full * visits, {200: count * visits})]
+        runs.append(("images/",) + browse(client, image_urls, visits, immutable=False))
+        runs.append(("blobs/",) + browse(client, blob_urls, visits, immutable=True))
+        if Thumbnail.available():
+            runs.append(("thumbnail",) + browse(client, [f"{url}?w=200&fmt=webp" for url in blob_urls], visits, immutable=True))
+
+        print(f"{count} images x {visits} visits, {full / count / 1024:.0f} KiB per image")
+        print(f"{'':<10} {'bytes':>14} {'saved':>8}  responses")
+        for name, total, statuses in runs:
+            saved = 1 - total / runs[0][1]
+            print(f"{name:<10} {total:>14,} {saved:>8.1%}  {statuses}")
+
+        response = client.get(image_urls[0], headers={"Range": "bytes=0-65535"})
+        print(f"Range bytes=0-65535: {response.status_code}, {len(response.get_data()):,} bytes, "
+              f"Content-Range {response.headers.get('Content-Range')}")
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    try:
+        arguments = [int(argument) for argument in sys.argv[1:3]]
+    except ValueError:
+        arguments = None
+    if arguments is None or len(sys.argv) > 3:
+        print("Usage: python utils/bench_image_cache.py [images] [visits]")
+    else:
+        defaults = [IMAGES, VISITS]
+        main(*(arguments + defaults[len(arguments):]))
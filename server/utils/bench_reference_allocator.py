@@ -0,0 +1,67 @@
+import sys
+import os
+import time
+import uuid
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# usage (from the server/ directory, needs a running mongod):
+# >> python utils/bench_reference_allocator.py [processes] [threads] [per_thread]
+# every thread of every process allocates per_thread reference numbers for the same prefix at once,
+# the run fails when any number is handed out twice; the prefix's counter is removed afterwards
+
+PROCESSES = 4
+THREADS = 8
+PER_THREAD = 500
+
+
+def allocate_many(prefix, threads, per_thread):
+    from app.upload.models import ReferenceAllocator
+    numbers = []
+    lock = threading.Lock()
+
+    def worker():
+        allocated = [ReferenceAllocator.allocate(prefix) for _ in range(per_thread)]
+        with lock:
+            numbers.extend(allocated)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return numbers
+
+
+def main(processes, threads, per_thread):
+    prefix = f"BENCH{uuid.uuid4().hex[:6].upper()}"
+    # spawn: every process opens its own connection, pymongo clients are not fork safe
+    context = multiprocessing.get_context('spawn')
+    started = time.perf_counter()
+    with context.Pool(processes) as pool:
+        results = pool.starmap(allocate_many, [(prefix, threads, per_thread)] * processes)
+    elapsed = time.perf_counter() - started
+
+    numbers = [number for result in results for number in result]
+    collisions = len(numbers) - len(set(numbers))
+    print(f"{processes} processes x {threads} threads x {per_thread}: {len(numbers)} numbers in {elapsed:.2f}s "
+          f"({len(numbers) / elapsed:.0f}/s, includes process start up)")
+    print(f"collisions: {collisions}")
+
+    from app.database import db
+    db.counters.delete_one({"_id": f"reference_no:{prefix}"})
+    return 1 if collisions else 0
+
+
+if __name__ == "__main__":
+    try:
+        arguments = [int(argument) for argument in sys.argv[1:4]]
+    except ValueError:
+        arguments = None
+    if arguments is None or len(sys.argv) > 4:
+        print("Usage: python utils/bench_reference_allocator.py [processes] [threads] [per_thread]")
+    else:
+        defaults = [PROCESSES, THREADS, PER_THREAD]
+        sys.exit(main(*(arguments + defaults[len(arguments):])))
@@ -0,0 +1,83 @@
+import sys
+import os
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from app.database import db
+from app.versions import CollectionVersion
+from app.search.models import Collection
+
+# usage (from the server/ directory, needs a running mongod):
+# >> python utils/bench_search_cache.py [samples] [runs]
+# what a cached search page costs next to an uncached one: a hit still reads the collection's write version
+# (CollectionVersion.get, one find_one by _id) so other workers' writes are seen at once, the version lookup
+# is timed on its own as well. synthetic rows go to a throwaway identifier of samples_list, removed afterwards
+
+SAMPLES = 50000
+RUNS = 200
+BATCH_SIZE = 5000
+IDENTIFIER = "BENCH_SEARCH_CACHE"
+WORDS = ["granite", "basalt", "quartz", "feldspar", "mica", "shale", "marble", "slate", "gneiss", "schist"]
+
+
+def seed(count):
+    rng = random.Random(7)
+    for start in range(0, count, BATCH_SIZE):
+        db.samples_list.insert_many([
+            {"identifier": IDENTIFIER, "reference_no": f"BSC{i:07d}", "tags": rng.sample(WORDS, 2),
+             "total_inventory": rng.randint(0, 100)}
+            for i in range(start, min(start + BATCH_SIZE, count))
+        ], ordered=False)
+
+
+def timed(function, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main(count, runs):
+    seed(count)
+    app = Flask(__name__)
+    app.config['IMAGE_BASE_URL'] = "http://localhost:5000/search/api/images"
+    criteria = [{"key": "identifier", "value": IDENTIFIER}, {"key": "tags", "value": "quartz"}]
+    search = lambda: Collection.search_by_multiple_criteria('samples_list', criteria)
+
+    def uncached():
+        Collection._result_cache.invalidate()
+        search()
+
+    try:
+        with app.app_context():
+            rows = [("version lookup", timed(lambda: CollectionVersion.get('samples_list'), runs)),
+                    ("uncached page", timed(uncached, runs))]
+            search()
+            rows.append(("cached page", timed(search, runs)))
+            print(f"{count:,} rows, first page of {Collection.PAGE_SIZE}")
+            print(f"{'':<16} {'median ms':>10} {'p95 ms':>10}")
+            for name, (median, p95) in rows:
+                print(f"{name:<16} {median:>10.3f} {p95:>10.3f}")
+            print(f"cache: {Collection.cache_stats()}")
+    finally:
+        db.samples_list.delete_many({"identifier": IDENTIFIER})
+        CollectionVersion.bump('samples_list')
+
+
+if __name__ == "__main__":
+    try:
+        arguments = [int(argument) for argument in sys.argv[1:3]]
+    except ValueError:
+        arguments = None
+    if arguments is None or len(sys.argv) > 3:
+        print("Usage: python utils/bench_search_cache.py [samples] [runs]")
+    else:
+        defaults = [SAMPLES, RUNS]
+        main(*(arguments + defaults[len(arguments):]))
@@ -0,0 +1,98 @@
+import sys
+import os
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from pymongo import IndexModel, ASCENDING
+from app.database import db
+from app.indexes import search_text_index
+from app.search.models import Collection
+
+# usage (from the server/ directory, needs a running mongod):
+# >> python utils/bench_text_search.py [samples] [runs]
+# fills a scratch collection with synthetic samples (indexed like db.samples: search_text and reference_no),
+# then times the first page (PAGE_SIZE results and the capped count) of text, prefix and exact searches
+# through Collection.search_by_multiple_criteria, result cache bypassed; the collection is dropped afterwards
+
+SAMPLES = 500000
+RUNS = 30
+COLLECTION = "bench_text_search"
+BATCH_SIZE = 5000
+
+WORDS = ["granite", "basalt", "quartz", "feldspar", "mica", "shale", "marble", "slate", "gneiss", "schist",
+         "limestone", "sandstone", "obsidian", "pumice", "jade", "onyx", "agate", "jasper", "opal", "topaz"]
+PREFIXES = ["AB", "CD", "EF", "GH", "KL", "MN", "PQ", "RS"]
+
+
+def sample(i, rng):
+    attributes = {"color": rng.choice(WORDS), "finish": rng.choice(WORDS), "origin": f"site {rng.randint(1, 400)}"}
+    return {
+        "reference_no": f"{rng.choice(PREFIXES)}{i:07d}x",
+        "side_reference_nos": [f"S{i:08d}"],
+        "tags": rng.sample(WORDS, 2),
+        "categories": [rng.choice(WORDS)],
+        "source": f"supplier {rng.randint(1, 50)}",
+        "additional_fields": attributes,
+        "search_text": " ".join(str(value) for value in attributes.values()),
+        "total_inventory": rng.randint(0, 100),
+    }
+
+
+def seed(count):
+    rng = random.Random(7)
+    collection = db[COLLECTION]
+    collection.drop()
+    started = time.perf_counter()
+    for start in range(0, count, BATCH_SIZE):
+        collection.insert_many([sample(i, rng) for i in range(start, min(start + BATCH_SIZE, count))], ordered=False)
+    collection.create_indexes([search_text_index(), IndexModel([("reference_no", ASCENDING)], name="reference_no")])
+    print(f"seeded {count:,} samples with indexes in {time.perf_counter() - started:.1f}s")
+
+
+def measure(criteria, runs):
+    samples, returned = [], 0
+    for _ in range(runs):
+        Collection._result_cache.invalidate()
+        started = time.perf_counter()
+        results, count, _ = Collection.search_by_multiple_criteria(COLLECTION, criteria)
+        samples.append((time.perf_counter() - started) * 1000)
+        returned = count
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1], returned
+
+
+def main(count, runs):
+    seed(count)
+    app = Flask(__name__)
+    app.config['IMAGE_BASE_URL'] = "http://localhost:5000/search/api/images"
+    queries = [
+        ("text, one word", [{"key": "any", "value": "obsidian", "operator": "text"}]),
+        ("text, two words", [{"key": "any", "value": "jade slate", "operator": "text"}]),
+        ("text + exact tag", [{"key": "any", "value": "quartz", "operator": "text"}, {"key": "tags", "value": "mica"}]),
+        ("prefix reference_no", [{"key": "reference_no", "value": "AB00012", "operator": "prefix"}]),
+        ("exact tag", [{"key": "tags", "value": "opal"}]),
+    ]
+    try:
+        with app.app_context():
+            print(f"{'query':<22} {'median ms':>10} {'p95 ms':>10} {'matches':>10}")
+            for name, criteria in queries:
+                median, p95, matches = measure(criteria, runs)
+                print(f"{name:<22} {median:>10.1f} {p95:>10.1f} {matches if matches is not None else '-':>10}")
+    finally:
+        db[COLLECTION].drop()
+
+
+if __name__ == "__main__":
+    try:
+        arguments = [int(argument) for argument in sys.argv[1:3]]
+    except ValueError:
+        arguments = None
+    if arguments is None or len(sys.argv) > 3:
+        print("Usage: python utils/bench_text_search.py [samples] [runs]")
+    else:
+        defaults = [SAMPLES, RUNS]
+        main(*(arguments + defaults[len(arguments):]))
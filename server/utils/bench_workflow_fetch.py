@@ -0,0 +1,79 @@
+import sys
+import os
+import time
+import uuid
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database import db
+from app.upload.models import Workflow
+
+# usage (from the server/ directory, needs a running mongod):
+# >> python utils/bench_workflow_fetch.py [runs]
+# builds synthetic workflows of growing size and times assembling the full tree (uncached) and the
+# cached get_workflow_by_id; the query count is fixed, so latency should grow with the data only,
+# not with one round trip per node / section. the synthetic documents are removed afterwards
+
+RUNS = 20
+SIZES = [(5, 2), (50, 4), (200, 4), (500, 4)]      # (nodes, sections per node), 2 files per section
+FILES_PER_SECTION = 2
+
+
+def seed(workflow_id, node_count, sections_per_node):
+    nodes, sections, files = [], [], []
+    for n in range(node_count):
+        node_id = f"{workflow_id}_n{n}"
+        nodes.append({"workflow_id": workflow_id, "node_id": node_id, "label": f"Node {n}", "status": "Sleep", "sections": []})
+        for s in range(sections_per_node):
+            section_id = f"{node_id}_s{s}"
+            file_ids = [f"{section_id}_f{f}" for f in range(FILES_PER_SECTION)]
+            sections.append({"workflow_id": workflow_id, "node_id": node_id, "section_id": section_id,
+                             "label": f"Section {s}", "file_ids": file_ids})
+            files.extend({"file_id": file_id, "name": f"{file_id}.pdf", "type": "application/pdf",
+                          "size": 1024, "path": f"files/{file_id}.pdf"} for file_id in file_ids)
+    edges = [{"from": nodes[i]['node_id'], "to": nodes[i + 1]['node_id']} for i in range(len(nodes) - 1)]
+    db.workflows.insert_one({"workflow_id": workflow_id, "name": workflow_id, "is_locked": False, "status": "Active",
+                             "owner": [], "version": 1, "edges": edges, "timestamp": int(time.time() * 1000)})
+    db.nodes.insert_many(nodes)
+    db.sections.insert_many(sections)
+    db.files.insert_many(files)
+    return [file['file_id'] for file in files]
+
+
+def cleanup(workflow_id, file_ids):
+    db.workflows.delete_many({"workflow_id": workflow_id})
+    db.nodes.delete_many({"workflow_id": workflow_id})
+    db.sections.delete_many({"workflow_id": workflow_id})
+    db.files.delete_many({"file_id": {"$in": file_ids}})
+
+
+def timed(function, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main(runs):
+    print(f"{'nodes':>6} {'sections':>9} {'files':>6} {'assemble ms':>12} {'per node ms':>12} {'cached ms':>10}")
+    for node_count, sections_per_node in SIZES:
+        workflow_id = f"BENCH_{uuid.uuid4().hex[:8]}"
+        file_ids = seed(workflow_id, node_count, sections_per_node)
+        try:
+            assemble = timed(lambda: Workflow._assemble_workflow(workflow_id), runs)
+            Workflow.get_workflow_by_id(workflow_id)
+            cached = timed(lambda: Workflow.get_workflow_by_id(workflow_id), runs)
+            print(f"{node_count:>6} {node_count * sections_per_node:>9} {len(file_ids):>6} "
+                  f"{assemble:>12.2f} {assemble / node_count:>12.3f} {cached:>10.3f}")
+        finally:
+            cleanup(workflow_id, file_ids)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and not sys.argv[1].isdigit()):
+        print("Usage: python utils/bench_workflow_fetch.py [runs]")
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) == 2 else RUNS)
@@ -0,0 +1,37 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.upload.models import FileGarbageCollector
+
+# usage (from the server/ directory):
+# >> python utils/file_gc.py report     orphan file documents / files on disk and the reclaimable bytes
+# >> python utils/file_gc.py collect    delete them, in throttled batches
+
+
+def report():
+    summary = FileGarbageCollector.collect(dry_run=True)
+    print(f"orphan file documents: {summary['orphan_documents']}")
+    print(f"orphan files on disk:  {summary['orphan_files']}")
+    print(f"reclaimable:           {summary['reclaimable_bytes'] / (1024 * 1024):.1f} MiB")
+
+
+def collect():
+    summary = FileGarbageCollector.collect()
+    print(f"removed {summary['removed_documents']} file documents, {summary['removed_files']} files "
+          f"({summary['reclaimable_bytes'] / (1024 * 1024):.1f} MiB), expired {summary['expired_uploads']} resumable uploads, "
+          f"removed {summary['removed_temporaries']} stale temporary blobs")
+
+
+COMMANDS = {
+    "report": report,
+    "collect": collect,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
+        print(f"Usage: python utils/file_gc.py <{'|'.join(COMMANDS)}>")
+    else:
+        COMMANDS[sys.argv[1]]()
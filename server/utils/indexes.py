@@ -0,0 +1,39 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.indexes import ensure_indexes, index_report
+
+# usage (from the server/ directory):
+# >> python utils/indexes.py report     missing / unused / unregistered indexes and index sizes per collection
+# >> python utils/indexes.py apply      create every index of the registry in app/indexes.py
+# note: "unused" comes from $indexStats, which resets when mongod restarts
+
+
+def print_report():
+    for collection_name, info in index_report().items():
+        print(f"{collection_name}")
+        print(f"  missing:      {', '.join(info['missing']) or '-'}")
+        print(f"  unused:       {', '.join(info['unused']) or '-'}")
+        print(f"  unregistered: {', '.join(info['unregistered']) or '-'}")
+        for name, size in info['sizes'].items():
+            print(f"  {name:<40} {size / 1024:>10.1f} KiB")
+
+
+def apply():
+    created, failed = ensure_indexes()
+    print(f"applied {len(created)} indexes, {len(failed)} failed: {', '.join(failed) or '-'}")
+
+
+COMMANDS = {
+    "report": print_report,
+    "apply": apply,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
+        print(f"Usage: python utils/indexes.py <{'|'.join(COMMANDS)}>")
+    else:
+        COMMANDS[sys.argv[1]]()
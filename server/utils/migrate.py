@@ -0,0 +1,82 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.upload.models import Item, ItemBatch, InventoryLedger
+from app.storage import BlobStore
+from app.similarity import ImageIndex
+from app.catalog import FieldCatalog
+from app.facets import FacetCounts
+
+# usage (from the server/ directory, safe to re-run):
+# >> python utils/migrate.py inventory     move embedded "inventory" arrays into the inventory_movements ledger
+# >> python utils/migrate.py references    split the single reference_table document into reference_abbreviations
+# >> python utils/migrate.py identifiers   build the identifiers registry from samples_list / inventory
+# >> python utils/migrate.py storage       move files/ and images/ paths into the content addressed blob store
+# >> python utils/migrate.py image_hashes  compute perceptual hashes of sample images that have none (needs Pillow)
+# >> python utils/migrate.py field_catalog rebuild the searchable field catalog of samples / samples_list / inventory
+# >> python utils/migrate.py search_text   fill search_text (text indexed additional_fields values) on existing items
+# >> python utils/migrate.py facets        recount the categories / tags / source / identifier facet counts
+
+
+def migrate_inventory():
+    for collection_name in ['samples', 'samples_list', 'inventory']:
+        count = InventoryLedger.migrate_embedded(collection_name)
+        print(f"{collection_name}: migrated {count} documents")
+
+
+def migrate_references():
+    migrated, skipped = Item.migrate_reference_table()
+    print(f"reference_abbreviations: migrated {migrated}, skipped {skipped} conflicting full names")
+
+
+def migrate_identifiers():
+    count = ItemBatch.backfill_identifier_registry()
+    print(f"identifiers: registered {count} identifiers")
+
+
+def migrate_storage():
+    migrated, missing = BlobStore.migrate_legacy_paths()
+    print(f"blobs: migrated {migrated} paths, {missing} missing on disk")
+
+
+def migrate_image_hashes():
+    count = ImageIndex.backfill()
+    print(f"image_hashes: hashed {count} images")
+
+
+def migrate_field_catalog():
+    for collection_name in ['samples', 'samples_list', 'inventory']:
+        count = FieldCatalog.rebuild(collection_name)
+        print(f"field_catalog: {collection_name} rebuilt from {count} documents")
+
+
+def migrate_search_text():
+    count = Item.backfill_search_text()
+    print(f"search_text: updated {count} items")
+
+
+def migrate_facets():
+    for collection_name in ['samples', 'samples_list', 'inventory']:
+        count = FacetCounts.rebuild(collection_name)
+        print(f"facet_counts: {collection_name} rebuilt with {count} values")
+
+
+MIGRATIONS = {
+    "inventory": migrate_inventory,
+    "references": migrate_references,
+    "identifiers": migrate_identifiers,
+    "storage": migrate_storage,
+    "image_hashes": migrate_image_hashes,
+    "field_catalog": migrate_field_catalog,
+    "search_text": migrate_search_text,
+    "facets": migrate_facets,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in MIGRATIONS:
+        print(f"Usage: python utils/migrate.py <{'|'.join(MIGRATIONS)}>")
+    else:
+        MIGRATIONS[sys.argv[1]]()
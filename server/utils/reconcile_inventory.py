@@ -0,0 +1,19 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.upload.models import InventoryLedger
+
+# usage (from the server/ directory, safe to re-run):
+# >> python utils/reconcile_inventory.py [seconds]
+# finishes or drops inventory movements left pending (ledger written, item $inc not confirmed) for longer
+# than `seconds` (default InventoryLedger.RECONCILE_AFTER); only deployments without transactions leave any
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and not sys.argv[1].isdigit()):
+        print("Usage: python utils/reconcile_inventory.py [seconds]")
+    else:
+        summary = InventoryLedger.reconcile(int(sys.argv[1]) if len(sys.argv) == 2 else None)
+        print(f"applied {summary['applied']}, settled {summary['settled']}, discarded {summary['discarded']} pending movements")
@@ -0,0 +1,91 @@
+import sys
+import os
+import uuid
+import random
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database import db
+from app.upload.models import ItemBatch
+
+# usage (from the server/ directory, needs a running mongod):
+# >> python utils/stress_inventory.py [threads] [rounds]
+# many threads put in / take out on the same few rows through ItemBatch.update_inventory and
+# update_inventories at once; every movement must end up in total_inventory and in the ledger.
+# runs on a throwaway identifier removed afterwards; tests/test_inventory.py runs it smaller
+
+THREADS = 16
+ROUNDS = 200
+REFERENCES = ['STRESS1', 'STRESS2', 'STRESS3']
+
+
+def run(threads, rounds):
+    # returns (failed, report lines)
+    identifier = f"STRESS_{uuid.uuid4().hex[:8]}"
+    batch = ItemBatch([{"reference_no": reference_no} for reference_no in REFERENCES], mode='inventory', identifier=identifier)
+    batch.save_items()
+
+    expected = {reference_no: 0 for reference_no in REFERENCES}
+    expected_lock = threading.Lock()
+    errors = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        worker_batch = ItemBatch([], mode='inventory', identifier=identifier)
+        for _ in range(rounds):
+            try:
+                if rng.random() < 0.5:
+                    reference_no = rng.choice(REFERENCES)
+                    put_in, take_out = rng.randint(0, 5), rng.randint(0, 5)
+                    worker_batch.update_inventory(reference_no, put_in, take_out, f"worker{seed}")
+                    changes = [(reference_no, put_in - take_out)]
+                else:
+                    picked = [{"reference_no": reference_no, "putIn": rng.randint(0, 5), "takeOut": rng.randint(0, 5)}
+                              for reference_no in rng.sample(REFERENCES, 2)]
+                    worker_batch.update_inventories(picked)
+                    changes = [(change['reference_no'], change['putIn'] - change['takeOut']) for change in picked]
+            except Exception as e:
+                errors.append(e)
+                continue
+            with expected_lock:
+                for reference_no, delta in changes:
+                    expected[reference_no] += delta
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    failed = bool(errors)
+    report = []
+    try:
+        for reference_no in REFERENCES:
+            item = db.inventory.find_one({"identifier": identifier, "reference_no": reference_no})
+            ledger = sum(bucket.get('put_in', 0) - bucket.get('take_out', 0) for bucket in db.inventory_movements.find(
+                {"collection": "inventory", "identifier": identifier, "reference_no": reference_no}))
+            ok = item['total_inventory'] == expected[reference_no] == ledger
+            failed = failed or not ok
+            report.append(f"{reference_no}: expected {expected[reference_no]}, total_inventory {item['total_inventory']}, "
+                          f"ledger {ledger} {'ok' if ok else 'LOST UPDATES'}")
+        report.append(f"{threads} threads x {rounds} rounds, {len(errors)} errors")
+    finally:
+        db.inventory.delete_many({"identifier": identifier})
+        db.inventory_movements.delete_many({"identifier": identifier})
+        db.identifiers.delete_many({"identifier": identifier})
+    return failed, report
+
+
+if __name__ == "__main__":
+    try:
+        arguments = [int(argument) for argument in sys.argv[1:3]]
+    except ValueError:
+        arguments = None
+    if arguments is None or len(sys.argv) > 3:
+        print("Usage: python utils/stress_inventory.py [threads] [rounds]")
+    else:
+        defaults = [THREADS, ROUNDS]
+        failed, report = run(*(arguments + defaults[len(arguments):]))
+        print("\n".join(report))
+        sys.exit(1 if failed else 0)